@@ -9,6 +9,9 @@ from .commands import (
     delete_tests,
     download_submissions,
     test_results,
+    grade_worker,
+    grading_report,
+    calibrate,
 )
 
 
@@ -30,11 +33,14 @@ main.add_command(new_assignment.main, name="new-assignment")
 main.add_command(bundle_java.main, name="bundle-java")
 main.add_command(bundle_python.main, name="bundle-python")
 main.add_command(update_points.main, name="update-points")
+main.add_command(calibrate.main, name="calibrate")
 
 main.add_command(download_submissions.main, name="download-submissions")
 main.add_command(create_tests.main, name="create-tests")
 main.add_command(delete_tests.main, name="delete-tests")
 main.add_command(run_external.main, name="run-external")
 main.add_command(test_results.main, name="test-results")
+main.add_command(grade_worker.main, name="grade-worker")
+main.add_command(grading_report.main, name="grading-report")
 
 main(prog_name="agni")
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+
+def hash_paths(*paths) -> str:
+    """Hash names and contents of the given files and directory trees."""
+    h = hashlib.sha256()
+    for root in paths:
+        root = Path(root)
+        if not root.exists():
+            continue
+        if root.is_file():
+            files = [(root.name, root)]
+        else:
+            files = sorted(
+                (str(p.relative_to(root)), p) for p in root.glob("**/*") if p.is_file()
+            )
+        for name, p in files:
+            h.update(name.encode())
+            h.update(b"\0")
+            h.update(p.read_bytes())
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def hash_tests(
+    entries: Dict[str, bytes],
+    paths: Dict[str, str],
+    infos: Dict[str, dict],
+    **settings,
+) -> Dict[str, str]:
+    """Hash of each test by test id, under which its results are cached.
+
+    entries are the files of the bundle archive by name, and paths the name of each
+    test's files without the suffix, e.g. t/Test1 for t/Test1.class and
+    t/Test1$1.class. A test's hash covers its files and its info (metadata and
+    settings such as its timeout), the files of no test (helpers and the
+    autograder), the files of the tests whose names its files mention, the hashes
+    of the tests it requires, and the settings, which are JSON values.
+    """
+    owners = {path: test_id for test_id, path in paths.items()}
+    files: Dict[str, Dict[str, bytes]] = {test_id: {} for test_id in paths}
+    shared = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for name in sorted(entries):
+        owner = owners.get(name.rsplit(".", 1)[0].split("$")[0])
+        if owner is None:
+            _update(shared, name, entries[name])
+        else:
+            files[owner][name] = entries[name]
+
+    def mentioned(test_id: str) -> List[str]:
+        data = list(files[test_id].values())
+        return [
+            other
+            for other, path in paths.items()
+            if other != test_id and any(path.split("/")[-1].encode() in d for d in data)
+        ]
+
+    hashes: Dict[str, str] = {}
+
+    def test_hash(test_id: str) -> str:
+        if test_id not in hashes:
+            used = {test_id}
+            todo = [test_id]
+            while todo:
+                for other in mentioned(todo.pop()):
+                    if other not in used:
+                        used.add(other)
+                        todo.append(other)
+            h = shared.copy()
+            h.update(json.dumps([test_id, infos[test_id]], sort_keys=True).encode())
+            for other in sorted(used):
+                for name, data in sorted(files[other].items()):
+                    _update(h, name, data)
+            # Prerequisites cannot form cycles, bundling checks that.
+            for other in infos[test_id].get("requires", []):
+                if other in paths:
+                    h.update(test_hash(other).encode())
+            hashes[test_id] = h.hexdigest()
+        return hashes[test_id]
+
+    return {test_id: test_hash(test_id) for test_id in paths}
+
+
+def _update(h, name: str, data: bytes):
+    h.update(name.encode())
+    h.update(b"\0")
+    h.update(data)
+    h.update(b"\0")
+
+
+class ResultCache:
+    """Test results by submission hash, for the tests with the given hashes.
+
+    Results are the JSON lines produced by the autograder. Each is kept with the
+    hash of its test, so that changing a test only drops the results of that test.
+    """
+
+    def __init__(self, cachedir: Path, test_hashes: Dict[str, str]):
+        self.dir = Path(cachedir) / "results"
+        self.test_hashes = test_hashes
+
+    def _read(self, submission_hash: str) -> Dict[str, list]:
+        path = self.dir / f"{submission_hash}.json"
+        if not path.exists():
+            return {}
+        return json.loads(path.read_text())
+
+    def load(self, submission_hash: str) -> Dict[str, str]:
+        return {
+            test_id: line
+            for test_id, (test_hash, line) in self._read(submission_hash).items()
+            if self.test_hashes.get(test_id) == test_hash
+        }
+
+    def save(self, submission_hash: str, results: Dict[str, str]):
+        """Add the results of the tests with hashes, e.g. not compile errors."""
+        stored = self._read(submission_hash)
+        for test_id, line in results.items():
+            if test_id in self.test_hashes:
+                stored[test_id] = [self.test_hashes[test_id], line]
+        self.dir.mkdir(parents=True, exist_ok=True)
+        path = self.dir / f"{submission_hash}.json"
+        tmppath = path.with_suffix(f".tmp{os.getpid()}")
+        tmppath.write_text(json.dumps(stored))
+        os.replace(str(tmppath), str(path))
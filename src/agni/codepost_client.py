@@ -0,0 +1,291 @@
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+from . import config
+
+
+# Seconds for which cached Codepost ids are used, unless set in [codepost] cache_ttl.
+DEFAULT_CACHE_TTL = 3600
+
+# Seconds before the first retry of a failed call; it doubles with each retry.
+RETRY_BACKOFF = 1.0
+
+
+def _settings() -> dict:
+    d = config.get("codepost")
+    assert d and isinstance(d, dict)
+    assignment_name = d.get("assignment_name")
+    course_name = d.get("course_name")
+    course_period = d.get("course_period")
+    api_key_path = d.get("api_key_path")
+    assert assignment_name and course_name and course_period and api_key_path
+    return d
+
+
+def _cachefile() -> Path:
+    return config.dirs.cache / "codepost.json"
+
+
+def _load_cache() -> dict:
+    """Cached ids of the configured assignment, or {} if missing or expired."""
+    d = _settings()
+    path = _cachefile()
+    if not path.exists():
+        return {}
+    cached = json.loads(path.read_text())
+    key = [d["course_name"], d["course_period"], d["assignment_name"]]
+    ttl = d.get("cache_ttl", DEFAULT_CACHE_TTL)
+    if cached.get("key") != key or time.time() - cached.get("saved", 0) > ttl:
+        return {}
+    return cached
+
+
+def _write_cache(cached: dict):
+    path = _cachefile()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmppath = path.with_suffix(".tmp")
+    tmppath.write_text(json.dumps(cached, indent=4))
+    os.replace(str(tmppath), str(path))
+
+
+def _save_cache(**values):
+    cached = _load_cache()
+    if not cached:
+        d = _settings()
+        cached = {
+            "key": [d["course_name"], d["course_period"], d["assignment_name"]],
+            "saved": time.time(),
+        }
+    cached.update(values)
+    _write_cache(cached)
+
+
+def invalidate():
+    """Forget cached test cases; call after creating, changing or deleting them."""
+    cached = _load_cache()
+    if cached.pop("tests", None) is not None:
+        _write_cache(cached)
+
+
+def get_assignment():
+    """Configure the API key and return the assignment set in config.toml."""
+    import codepost
+
+    d = _settings()
+    codepost.configure_api_key(Path(d["api_key_path"]).expanduser().read_text().strip())
+
+    cached = _load_cache()
+    if "assignment_id" in cached:
+        assignment = codepost.assignment.retrieve(id=cached["assignment_id"])
+        print(f"Course: {d['course_name']}, {d['course_period']}")
+    else:
+        mycourse = codepost.course.list_available(
+            name=d["course_name"], period=d["course_period"]
+        )[0]
+        print(f"Course: {mycourse.name}, {mycourse.period}")
+        assignment = {x.name: x for x in mycourse.assignments}[d["assignment_name"]]
+        _save_cache(course_id=mycourse.id, assignment_id=assignment.id)
+    print(f"Assignment: {assignment.name}")
+    return assignment
+
+
+def _fetch_tests(assignment) -> dict:
+    cached = _load_cache()
+    if "tests" in cached:
+        return cached
+
+    categories = {}
+    tests = {}
+    for cat in assignment.testCategories:
+        categories[cat.name] = cat.id
+        for test in cat.testCases:
+            tests[f"{cat.name}_@_{test.description}"] = {
+                "id": test.id,
+                "category_id": cat.id,
+                "pointsPass": test.pointsPass,
+                "pointsFail": test.pointsFail,
+            }
+    _save_cache(categories=categories, tests=tests)
+    return {"categories": categories, "tests": tests}
+
+
+def get_tests(assignment) -> dict:
+    """Test cases of the assignment by testcaseID ("<category>_@_<description>").
+
+    Each value has the ids and points of the test case.
+    """
+    return _fetch_tests(assignment)["tests"]
+
+
+def get_categories(assignment) -> dict:
+    """Test category ids of the assignment by name."""
+    return _fetch_tests(assignment)["categories"]
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    # codepost errors have status_code, requests' HTTPError a response.
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def is_transient(exc: Exception, idempotent: bool = True) -> bool:
+    """Whether a failed call may succeed if made again.
+
+    Rate limiting (429) and failures to connect are retried for all calls. Server
+    errors and other connection errors are retried only for idempotent calls, as a
+    create that failed this way may have been made, and retrying it would make a
+    duplicate.
+    """
+    try:
+        from requests import exceptions as http_errors
+
+        not_sent: tuple = (http_errors.ConnectTimeout,)
+        dropped: tuple = (http_errors.ConnectionError, http_errors.Timeout)
+    except ImportError:
+        not_sent = dropped = ()
+    status = _status_code(exc)
+    if status is not None:
+        return status == 429 or (idempotent and status >= 500)
+    if isinstance(exc, (ConnectionRefusedError, *not_sent)):
+        return True
+    connection_errors = (ConnectionError, TimeoutError, socket.timeout, *dropped)
+    return idempotent and isinstance(exc, connection_errors)
+
+
+def with_retry(
+    func, retries: int = 4, backoff: Optional[float] = None, idempotent: bool = True
+):
+    """Call func, retrying transient failures with exponential backoff."""
+    if backoff is None:
+        backoff = RETRY_BACKOFF
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as exc:
+            if attempt == retries or not is_transient(exc, idempotent):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+class _RateLimiter:
+    def __init__(self, max_rate: Optional[float]):
+        self.interval = 1.0 / max_rate if max_rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_concurrently(
+    funcs: List[Callable],
+    num_threads: int = 8,
+    max_rate: Optional[float] = None,
+    idempotent: Union[bool, List[bool]] = True,
+) -> Iterator[Tuple[int, object, Optional[Exception]]]:
+    """Call funcs from a thread pool, with retries, at most max_rate calls a second.
+
+    idempotent tells with_retry which calls are safe to repeat, for all funcs or
+    for each one. Yields (index, result, exception) in the order the calls complete.
+    """
+    limiter = _RateLimiter(max_rate)
+    if isinstance(idempotent, bool):
+        idempotent = [idempotent] * len(funcs)
+
+    def call(func, is_idempotent):
+        def limited():
+            limiter.wait()
+            return func()
+
+        return with_retry(limited, idempotent=is_idempotent)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = {
+            pool.submit(call, func, is_idempotent): i
+            for i, (func, is_idempotent) in enumerate(zip(funcs, idempotent))
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as exc:
+                yield futures[future], None, exc
+
+
+def send_all(
+    calls: List[Callable],
+    labels: List[str],
+    num_threads: int = 8,
+    max_rate: Optional[float] = None,
+    idempotent: bool = True,
+) -> list:
+    """Make calls with run_concurrently, printing the outcome of each by its label.
+
+    Returns the results in the order of calls, with None for failed calls.
+    """
+    results = [None] * len(calls)
+    calls_made = run_concurrently(calls, num_threads, max_rate, idempotent)
+    for i, result, exc in calls_made:
+        if exc or not result:
+            print(f"[FAILED] {labels[i]}: {exc!r}" if exc else f"[FAILED] {labels[i]}")
+        else:
+            print(f"[OK] {labels[i]}")
+        results[i] = result if not exc else None
+    return results
+
+
+def plan_tests(metadata: dict, tests: dict, categories: dict) -> dict:
+    """Compare tests in bundle metadata with those on Codepost.
+
+    Returns the categories and test cases to create, the point updates to make and
+    the number of test cases that are already up to date.
+    """
+    plan = {"categories": [], "create": [], "update": [], "unchanged": 0}
+    for i, info in enumerate(metadata.values()):
+        test_id = info.get("testcaseID")
+        category, description = test_id.split("_@_")
+        points = info.get("points")
+        field = "pointsFail" if points < 0 else "pointsPass"
+
+        test = tests.get(test_id)
+        if test is None:
+            if category not in categories and category not in plan["categories"]:
+                plan["categories"].append(category)
+            plan["create"].append(
+                {
+                    "testcaseID": test_id,
+                    "category": category,
+                    "description": description,
+                    "sortKey": i,
+                    "pointsPass": 0,
+                    "pointsFail": 0,
+                    field: points,
+                }
+            )
+        elif test[field] != points:
+            plan["update"].append(
+                {"testcaseID": test_id, "id": test["id"], field: points}
+            )
+        else:
+            plan["unchanged"] += 1
+    return plan
+
+
+def print_plan(plan: dict):
+    print(f"Test categories to create: {len(plan['categories'])}")
+    print(f"Test cases to create: {len(plan['create'])}")
+    print(f"Test cases with points to update: {len(plan['update'])}")
+    print(f"Test cases up to date: {plan['unchanged']}")
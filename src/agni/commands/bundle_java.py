@@ -1,18 +1,23 @@
 import click
 from pathlib import Path
-from .. import config
+from .. import config, prerequisites, scanner
 import shutil
 import tempfile
 import importlib.resources as resources
 import json
-import re
 import toml
 from textwrap import dedent
-from typing import Iterable, List
-from ..proc_util import run_process
+from typing import Dict, Iterable, List, Optional
+from ..proc_util import JAVA_LIMITS, run_process
+from ..cache import hash_paths
+from ..javac_server import javac_server, run_javac
 import asyncio
 import os
-import sys
+import re
+
+
+# Changed when the build cache changes, so that older caches are rebuilt.
+MANIFEST_VERSION = 2
 
 
 @click.command()
@@ -23,6 +28,12 @@ import sys
 )
 @click.option("--prefix", default=None)
 @click.option("--gen-single-file", default=None)
+@click.option(
+    "--clean",
+    is_flag=True,
+    default=False,
+    help="Compile everything again instead of only the changed tests.",
+)
 @click.argument(
     "testcase-dir",
     nargs=1,
@@ -41,6 +52,7 @@ import sys
 def main(
     prefix: str,
     gen_single_file: str,
+    clean: bool,
     testcase_dir: Path,
     solution_dir: Path,
     bundle_dir: Path,
@@ -50,7 +62,8 @@ def main(
         bundle_dir.mkdir()
     if not prefix:
         prefix = f"[{testcase_dir.name}] "
-    bundle(prefix, testcase_dir, solution_dir, bundle_dir)
+    with javac_server():
+        bundle(prefix, testcase_dir, solution_dir, bundle_dir, clean)
     if gen_single_file:
         generate_single_file(testcase_dir, bundle_dir, gen_single_file)
 
@@ -73,9 +86,10 @@ def _build(
     classpaths: List[Path] = None,
     dest: Path = None,
     cwd=None,
+    options: List[str] = None,
 ):
     with tempfile.NamedTemporaryFile(mode="wt", suffix=".txt") as argfile:
-        lines = []
+        lines = [f"{option}\n" for option in options or []]
         if classpaths:
             cp = os.pathsep.join(str(p) for p in classpaths)
             lines.append(f'-cp "{cp}"\n')
@@ -85,31 +99,36 @@ def _build(
 
         argfile.write("".join(lines))
         argfile.flush()
-        proc_result = asyncio.run(run_process([*cmd, f"@{argfile.name}"], cwd=cwd))
-        if proc_result.returncode != 0:
-            print(proc_result.stdout)
-            print(proc_result.stderr)
-            sys.exit(1)
+        if cmd == ["javac"]:
+            proc_result = asyncio.run(run_javac([f"@{argfile.name}"], cwd=cwd))
+        else:
+            proc_result = asyncio.run(run_process([*cmd, f"@{argfile.name}"], cwd=cwd))
+        if proc_result.returncode != 0 or proc_result.error:
+            raise click.ClickException(
+                f"{cmd[0]} failed:\n{proc_result.stdout}"
+                f"{proc_result.stderr}{proc_result.error}"
+            )
+
+
+def _config(p: Path, scanned: scanner.ScannedFile) -> dict:
+    if scanned.config is None:
+        return {}
+    try:
+        return toml.loads(scanned.config)
+    except toml.TomlDecodeError as exc:
+        raise click.ClickException(f"Invalid config in {p}: {exc}")
 
 
 def get_test_metadata(testdir: Path, test_paths: Iterable[Path], prefix: str):
     result: dict = {}
-    code_pattern = "begin_code.*?\n(.*\n).*?end_code"
-    config_pattern = r"/\*\s*config\s*(.*?)\*/"
-    # replace_config_pattern = r"/\*\s*_begin_config_.*?\n(.*\n).*?_end_config_\s*\*/"
-    for p in sorted(test_paths):
+    for p, scanned in scanner.scan_files(sorted(test_paths), scanner.scan_java):
         relative_path = p.relative_to(testdir)
-        contents = p.read_text()
         dotted_name = ".".join([*relative_path.parent.parts, relative_path.stem])
-        info: dict = {}
-        match = re.search(config_pattern, contents, re.DOTALL)
-        if match:
-            info.update(toml.loads(match.group(1)))  # TODO error checks
-        match = re.search(code_pattern, contents, re.DOTALL)
-        if match:
-            info["code"] = dedent(match.group(1))
+        info = _config(p, scanned)
+        if scanned.code is not None:
+            info["code"] = dedent(scanned.code)
         else:
-            info["code"] = re.sub(config_pattern, "", contents, flags=re.DOTALL)
+            info["code"] = scanned.without_config
 
         if not info.get("show_code", True):
             info["code"] = ""
@@ -126,24 +145,23 @@ def get_test_metadata(testdir: Path, test_paths: Iterable[Path], prefix: str):
 
 
 def generate_single_file(testcase_dir: Path, bundle_dir: Path, single_filename: str):
-    config_pattern = r"/\*\s*config\s*(.*?)\*/"
-    package_regex = re.compile("^\s*package")
-    import_regex = re.compile("^\s*import")
+    package = ""
     imports = set()
     testnames = []
     classes = []
-    for p in sorted(testcase_dir.glob("**/*.java")):
+    params = []
+    paths = sorted(testcase_dir.glob("**/*.java"))
+    for p, scanned in scanner.scan_files(paths, scanner.scan_java):
         relp = p.relative_to(testcase_dir)
         tname = "{}.{}".format(".".join(relp.parent.parts), relp.stem)
         testnames.append(tname)
-        content = re.sub(config_pattern, "", p.read_text(), flags=re.DOTALL)
-        lines = re.sub("\n\s*public\s+class", "\nclass", content).splitlines()
-        package = next(filter(package_regex.match, lines), "")
-        imports.update(filter(import_regex.match, lines))
-        testclass = "\n".join(
-            l for l in lines if not package_regex.match(l) and not import_regex.match(l)
-        )
-        classes.append(testclass.strip())
+        info = _config(p, scanned)
+        if "params" in info:
+            rows = _java_params(info["params"], tname)
+            params.append(_params_line(tname, rows))
+        package = scanned.package
+        imports.update(scanned.imports)
+        classes.append("\n".join(scanned.body).strip())
 
     with resources.path(f"agni.resources.java", "MinitesterTemplate.java") as mtfile:
         text = Path(mtfile).read_text()
@@ -151,105 +169,293 @@ def generate_single_file(testcase_dir: Path, bundle_dir: Path, single_filename:
     text = text.replace("//imports", "{}\n\n{}".format(package, "\n".join(imports)))
     text = text.replace("//classes", "\n\n\n".join(classes))
     text = text.replace("//tests", ",\n".join(f'"{t}"' for t in sorted(testnames)))
+    text = text.replace("//params", "".join(params))
     (bundle_dir / single_filename).write_text(text)
 
 
-def _show_files(tmpdir):
-    print([str(p.relative_to(tmpdir)) for p in tmpdir.glob("**/*")])
+def _check_limits(limits: dict, where: str):
+    unknown = sorted(set(limits) - set(JAVA_LIMITS))
+    if unknown:
+        raise click.ClickException(
+            f"Unknown limits in {where}: {', '.join(unknown)}. "
+            f"Supported limits for Java: {', '.join(JAVA_LIMITS)}."
+        )
 
 
-def bundle(prefix: str, testcase_dir: Path, solution_dir: Path, bundle_dir: Path):
-    ignore = shutil.ignore_patterns("*.class")
-    with tempfile.TemporaryDirectory() as t1, tempfile.TemporaryDirectory() as t2:
-        tmpbundle = Path(t1)
-        tmpsolution = Path(t2)
-        
-        classpaths = [config.dirs.helpers, solution_dir]
-        files = [
-            *Path(solution_dir).glob("**/*.java"),
-        ]
-        _build(
-            ["javac"], files, classpaths=classpaths, dest=Path(tmpsolution),
-        )
+def _java_params(params, where: str) -> List[List[str]]:
+    """Rows of params as the String[] arguments of the test's constructor."""
+    if not isinstance(params, list) or not params:
+        raise click.ClickException(f"params in {where} must be a non-empty list.")
+    if not all(isinstance(row, list) for row in params):
+        raise click.ClickException(f"Each row of params in {where} must be a list.")
+    return [
+        [json.dumps(v) if isinstance(v, bool) else str(v) for v in row]
+        for row in params
+    ]
 
-        # _show_files(tmpsolution)
 
-        classpaths = [config.dirs.helpers, Path(tmpsolution)]
-        files = [
-            *config.dirs.helpers.glob("**/*.java"),
-        ]
-        _build(
-            ["javac"], files, classpaths=classpaths, dest=tmpbundle,
-        )
+def _params_line(class_name: str, rows: List[List[str]]) -> str:
+    # A statement adding the rows to the params map of TestCode or the Minitester.
+    java_rows = ", ".join(
+        "{{ {} }}".format(", ".join(json.dumps(v) for v in row)) for row in rows
+    )
+    return f'params.put("{class_name}", new String[][] {{ {java_rows} }});\n'
 
-        # _show_files(tmpbundle)
 
-        classpaths = [tmpbundle, Path(tmpsolution), testcase_dir]
-        files = [*testcase_dir.glob("**/*.java")]
-        _build(["javac"], files, classpaths=classpaths, dest=tmpbundle)
+def _show_files(tmpdir):
+    print([str(p.relative_to(tmpdir)) for p in tmpdir.glob("**/*")])
 
-        # _show_files(tmpbundle)
 
-        with resources.path(f"agni.resources.java", "autograder") as agdir:
-            _copytree(agdir, tmpbundle, keep_parent=False, ignore=ignore)
-        genfile = tmpbundle / "_autograder" / "TestCode.java"
+def _with_dependents(testcase_dir: Path, changed: List[str], tests: List[str]):
+    """The changed tests and the tests that use their classes, directly or not.
 
-        metadata = get_test_metadata(
-            testcase_dir, testcase_dir.glob("**/*.java"), prefix
-        )
+    A test is taken to use a class if its source mentions the class name.
+    """
+    texts = {rel: (testcase_dir / rel).read_text() for rel in tests}
+    result = set(changed)
+    todo = list(changed)
+    while todo:
+        name = re.compile(r"\b{}\b".format(re.escape(Path(todo.pop()).stem)))
+        for rel, text in texts.items():
+            if rel not in result and name.search(text):
+                result.add(rel)
+                todo.append(rel)
+    return sorted(result)
 
-        lines = [
-            '{{ "{}", {} }},\n'.format(mod, json.dumps(info["code"]))
-            for mod, info in metadata.items()
+
+def _source_of(class_path: str) -> str:
+    # Test file of a class and its nested classes, e.g. a/B.java of a/B$1.class
+    p = Path(class_path)
+    return str(p.with_name(p.stem.split("$")[0] + ".java"))
+
+
+def _compile_tests(
+    testcase_dir: Path,
+    tests: List[str],
+    classpaths: List[Path],
+    classdir: Path,
+    old_classes: List[str],
+    incremental: bool,
+) -> Optional[Dict[str, List[str]]]:
+    """Compile the tests into classdir, replacing old_classes; return their classes.
+
+    If incremental and a class is not named after its file, e.g. a second top-level
+    class, its stale versions cannot be told apart, so None is returned and
+    classdir is left as it was.
+    """
+    with tempfile.TemporaryDirectory(dir=str(classdir.parent)) as t:
+        _build(
+            ["javac"],
+            (testcase_dir / rel for rel in tests),
+            classpaths=classpaths,
+            dest=Path(t),
+            # Other tests are compiled into classdir already.
+            options=["-implicit:none"],
+        )
+        compiled = sorted(str(c.relative_to(t)) for c in Path(t).glob("**/*.class"))
+        if incremental and any(_source_of(c) not in tests for c in compiled):
+            return None
+        for c in old_classes:
+            if (classdir / c).exists():
+                (classdir / c).unlink()
+        for c in compiled:
+            (classdir / c).parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(Path(t, c)), str(classdir / c))
+    classes: Dict[str, List[str]] = {rel: [] for rel in tests}
+    for c in compiled:
+        if _source_of(c) in classes:
+            classes[_source_of(c)].append(c)
+    return classes
+
+
+def bundle(
+    prefix: str,
+    testcase_dir: Path,
+    solution_dir: Path,
+    bundle_dir: Path,
+    clean: bool = False,
+):
+    """Compile the tests and write the jar and the other bundle files.
+
+    Compiled classes are kept in autograder/cache/bundle-java/<bundle>, with a
+    manifest of the hashes of their sources, so that only changed tests and the
+    tests that use them are compiled, only changed tests are parsed again, and the
+    jar is updated in place. The classes a test no longer has are removed.
+    Everything is rebuilt if the helpers, solution or autograder change, a test is
+    deleted, or a changed test has classes not named after its file.
+    """
+    builddir = config.dirs.cache / "bundle-java" / bundle_dir.name
+    manifestpath = builddir / "manifest.json"
+    classdir = builddir / "classes"
+    solution_classdir = builddir / "solution"
+    jarfile = bundle_dir / f"{bundle_dir.name}.jar"
+
+    with resources.path(f"agni.resources.java", "autograder") as agdir:
+        base = [
+            MANIFEST_VERSION,
+            hash_paths(config.dirs.helpers, solution_dir, agdir),
+            prefix,
+            str(testcase_dir.resolve()),
+            str(solution_dir.resolve()),
+        ]
+        template = (agdir / "_autograder" / "TestCode.java").read_text()
+        manifest = {}
+        if manifestpath.exists() and not clean:
+            manifest = json.loads(manifestpath.read_text())
+        tests = {
+            str(p.relative_to(testcase_dir)): hash_paths(p)
+            for p in sorted(testcase_dir.glob("**/*.java"))
+        }
+        cached_tests = manifest.get("tests", {})
+        if manifest.get("base") != base or set(cached_tests) - set(tests):
+            manifest, cached_tests = {}, {}
+            shutil.rmtree(str(builddir), ignore_errors=True)
+            classdir.mkdir(parents=True)
+            solution_classdir.mkdir()
+            _build(
+                ["javac"],
+                Path(solution_dir).glob("**/*.java"),
+                classpaths=[config.dirs.helpers, solution_dir],
+                dest=solution_classdir,
+            )
+            _build(
+                ["javac"],
+                config.dirs.helpers.glob("**/*.java"),
+                classpaths=[config.dirs.helpers, solution_classdir],
+                dest=classdir,
+            )
+            ignore = shutil.ignore_patterns("*.class")
+            _copytree(agdir, builddir / "autograder", keep_parent=False, ignore=ignore)
+
+    changed = [
+        rel for rel, h in tests.items() if cached_tests.get(rel, {}).get("hash") != h
+    ]
+    # Metadata of each test file is parsed again only if the file changed.
+    entries = {rel: cached_tests.get(rel) for rel in tests}
+    for rel in changed:
+        entries[rel] = {
+            "hash": tests[rel],
+            "metadata": get_test_metadata(testcase_dir, [testcase_dir / rel], prefix),
+        }
+    if changed:
+        recompile = _with_dependents(testcase_dir, changed, list(tests))
+        print(f"Compiling {len(recompile)} of {len(tests)} tests.")
+        old_classes = [
+            c for rel in recompile for c in cached_tests.get(rel, {}).get("classes", [])
         ]
-        text = genfile.read_text().replace("//_replace_me_", "".join(lines))
+        classes_by_test = _compile_tests(
+            testcase_dir,
+            recompile,
+            [classdir, solution_classdir, testcase_dir],
+            classdir,
+            old_classes,
+            incremental=bool(cached_tests),
+        )
+        if classes_by_test is None:
+            print("Some classes are not named after their file, compiling everything.")
+            bundle(prefix, testcase_dir, solution_dir, bundle_dir, clean=True)
+            return
+        for rel, test_classes in classes_by_test.items():
+            entries[rel] = {**entries[rel], "classes": test_classes}
+    metadata = {}
+    for entry in entries.values():
+        metadata.update(entry["metadata"])
+    # resolve() changes the metadata, and the manifest keeps it as parsed.
+    metadata = json.loads(json.dumps(metadata))
+    try:
+        prerequisites.resolve(metadata)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+    lines = [
+        '{{ "{}", {} }},\n'.format(mod, json.dumps(info["code"]))
+        for mod, info in metadata.items()
+    ]
+    text = template.replace("//_replace_me_", "".join(lines))
+    lines = [
+        _params_line(mod, _java_params(info["params"], info["testcaseID"]))
+        for mod, info in metadata.items()
+        if "params" in info
+    ]
+    text = text.replace("//_replace_params_", "".join(lines))
+    genfile = builddir / "autograder" / "_autograder" / "TestCode.java"
+    if genfile.read_text() != text or manifest.get("testcode") != hash_paths(genfile):
         genfile.write_text(text)
         _build(
             ["javac"],
             genfile.parent.glob("**/*.java"),
-            classpaths=[tmpbundle],
-            dest=tmpbundle,
+            classpaths=[classdir],
+            dest=classdir,
         )
 
-        _build(
-            ["jar", "cf", str((bundle_dir / f"{bundle_dir.name}.jar").resolve())],
-            (p.relative_to(tmpbundle) for p in tmpbundle.glob("**/*.class")),
-            cwd=tmpbundle,
+    classes = {
+        str(p.relative_to(classdir)): hash_paths(p)
+        for p in sorted(classdir.glob("**/*.class"))
+    }
+    cached_classes = manifest.get("classes", {})
+    updated = [rel for rel, h in classes.items() if cached_classes.get(rel) != h]
+    if (
+        not jarfile.exists()
+        or manifest.get("jar") != hash_paths(jarfile)
+        or set(cached_classes) - set(classes)
+    ):
+        _build(["jar", "cf", str(jarfile.resolve())], classes, cwd=classdir)
+    elif updated:
+        _build(["jar", "uf", str(jarfile.resolve())], updated, cwd=classdir)
+
+    manifest = {
+        "base": base,
+        "tests": entries,
+        "testcode": hash_paths(genfile),
+        "classes": classes,
+        "jar": hash_paths(jarfile),
+    }
+    manifestpath.write_text(json.dumps(manifest))
+
+    metadatapath = bundle_dir / f"{bundle_dir.name}_metadata.json"
+    metadatapath.write_text(json.dumps(metadata, indent=4))
+
+    lines = []
+    batch_lines = []
+    default_timeout = config.get("autograder", {}).get("default-timeout", 3000)
+    default_limits = config.get("autograder", {}).get("limits", {})
+    _check_limits(default_limits, "[autograder.limits]")
+    for class_name, info in metadata.items():
+        timeout = info.get("timeout", default_timeout)
+        _check_limits(info.get("limits", {}), info["testcaseID"])
+        limits = {**default_limits, **info.get("limits", {})}
+        # RLIMIT_AS does not work with the JVM's address space reservations.
+        heap = f"-Xmx{limits['memory']}m " if "memory" in limits else ""
+        lines.append(
+            f"""java {heap}-DclassName="{class_name}" """
+            f"""-DtestcaseID="{info["testcaseID"]}" """
+            f"""-Dtimeout={timeout} _autograder.Executor\n"""
         )
-
-        metadatapath = bundle_dir / f"{bundle_dir.name}_metadata.json"
-        metadatapath.write_text(json.dumps(metadata, indent=4))
-
-        lines = []
-        default_timeout = config.get("autograder", {}).get("default-timeout", 3000)
-        for class_name, info in metadata.items():
-            timeout = info.get("timeout", default_timeout)
-            lines.append(
-                f"""java -DclassName="{class_name}" -DtestcaseID="{info["testcaseID"]}" """
-                f"""-Dtimeout={timeout} _autograder.Executor\n"""
-            )
-        (bundle_dir / f"{bundle_dir.name}_commands.sh").write_text("".join(lines))
-
-        pkgname = next((p.name for p in Path(solution_dir).glob("*") if p.is_dir()), "")
-        contents = dedent(
-            f"""
-            ls *.java &> /dev/null || {{
-                echo 'No java files were not found.'
-                exit 1
-            }}
-
-            # On codepost, students can submit files and not directories.
-            # So here we move java files to their respective package directory.
-            # Change the package name below if needed.
-            PKGNAME={pkgname}
-            mkdir -p $PKGNAME
-            mv *.java $PKGNAME
-
-            javac -cp . $PKGNAME/*.java || exit 1
-
-            export CLASSPATH="{bundle_dir.name}.jar:."
-            bash "{bundle_dir.name}_commands.sh" > "/outputs/user_tests.txt"
-            """
-        )
-
-        (bundle_dir / f"{bundle_dir.name}_codepost_runscript.sh").write_text(contents)
+        batch_lines.append(f"{class_name}\t{info['testcaseID']}\t{timeout}\n")
+    (bundle_dir / f"{bundle_dir.name}_commands.sh").write_text("".join(lines))
+    # Same tests for running in a single JVM: java -Dbatch=<file> _autograder.Executor
+    (bundle_dir / f"{bundle_dir.name}_batch.txt").write_text("".join(batch_lines))
+
+    pkgname = next((p.name for p in Path(solution_dir).glob("*") if p.is_dir()), "")
+    contents = dedent(
+        f"""
+        ls *.java &> /dev/null || {{
+            echo 'No java files were not found.'
+            exit 1
+        }}
+
+        # On codepost, students can submit files and not directories.
+        # So here we move java files to their respective package directory.
+        # Change the package name below if needed.
+        PKGNAME={pkgname}
+        mkdir -p $PKGNAME
+        mv *.java $PKGNAME
+
+        javac -cp . $PKGNAME/*.java || exit 1
+
+        export CLASSPATH="{bundle_dir.name}.jar:."
+        bash "{bundle_dir.name}_commands.sh" > "/outputs/user_tests.txt"
+        """
+    )
+
+    (bundle_dir / f"{bundle_dir.name}_codepost_runscript.sh").write_text(contents)
@@ -1,16 +1,26 @@
 import click
 from pathlib import Path
-from .. import config
-import shutil
+from .. import config, prerequisites, scanner
+from ..proc_util import LIMITS, run_process
+from ..cache import hash_paths
+import asyncio
+import filecmp
+import os
 import tempfile
 import importlib.resources as resources
-import zipapp
+import zipfile
 import json
-import re
 import toml
 from textwrap import dedent
 import base64
-from typing import Iterable
+from typing import Dict, Iterable, Union
+
+
+# Time of all entries of the .pyz, so that the same contents give the same bytes.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Bytes of the .pyz encoded at a time; a multiple of 3, so that chunks join up.
+BASE64_CHUNK_SIZE = 3 * 2 ** 16
 
 
 @click.command()
@@ -20,6 +30,13 @@ from typing import Iterable
     callback=lambda ctx, param, value: config.load(value),
 )
 @click.option("--prefix", default=None)
+@click.option(
+    "--compile",
+    "compile_bytecode",
+    is_flag=True,
+    default=False,
+    help="Add bytecode compiled by run_command, so that tests start faster.",
+)
 @click.argument(
     "testcase-dir",
     nargs=1,
@@ -30,48 +47,65 @@ from typing import Iterable
     "bundle-dir", nargs=1, callback=lambda ctx, key, val: Path(val),
 )
 def main(
-    prefix: str, testcase_dir: Path, bundle_dir: Path,
+    prefix: str, compile_bytecode: bool, testcase_dir: Path, bundle_dir: Path,
 ):
-    """[Python] Bundle tests into a zip file and create runscript."""
+    """[Python] Bundle tests into a zip file and create runscript.
+
+    With AGNI_UNPACK_DIR set when running the tests, the bundle is extracted there
+    once and imported from that directory.
+    """
     if not bundle_dir.exists():
         bundle_dir.mkdir()
     if not prefix:
         prefix = f"[{testcase_dir.name}] "
-    bundle(prefix, testcase_dir, bundle_dir)
+    bundle(prefix, testcase_dir, bundle_dir, compile_bytecode)
 
 
-def _copytree(src, dest, keep_parent=False, ignore=None):
-    src, dest = Path(src), Path(dest)
-    if keep_parent:
-        shutil.copytree(str(src), str(dest / src.name), ignore=ignore)
-        return
-    for s in src.glob("*"):
-        if s.is_dir():
-            shutil.copytree(str(s), str(dest / s.name), ignore=ignore)
-        else:
-            shutil.copy2(str(s), str(dest / s.name))
+def _check_limits(limits: dict, where: str):
+    unknown = sorted(set(limits) - set(LIMITS))
+    if unknown:
+        raise click.ClickException(
+            f"Unknown limits in {where}: {', '.join(unknown)}. "
+            f"Supported limits: {', '.join(LIMITS)}."
+        )
+
+
+def _check_params(params, where: str):
+    # Rows are lists of positional or tables of keyword arguments of test().
+    if not isinstance(params, list) or not params:
+        raise click.ClickException(f"params in {where} must be a non-empty list.")
+    if not all(isinstance(row, (list, dict)) for row in params):
+        raise click.ClickException(
+            f"Each row of params in {where} must be a list or a table."
+        )
+
+
+def _config(p: Path, scanned: scanner.ScannedFile) -> dict:
+    if scanned.config is None:
+        return {}
+    try:
+        return toml.loads(scanned.config)
+    except toml.TomlDecodeError as exc:
+        hint = ""
+        if "homogeneous" in str(exc):
+            # The toml parser rejects arrays with values of different types.
+            hint = (
+                "\nValues in an array must have one type; write rows of params "
+                "with different types as tables, e.g. {n = 2, expected = true}."
+            )
+        raise click.ClickException(f"Invalid config in {p}: {exc}{hint}")
 
 
 def get_test_metadata(testdir: Path, test_paths: Iterable[Path], prefix: str):
     result: dict = {}
-    code_pattern = "_begin_code_.*?\n(.*\n).*?_end_code_"
-    config_pattern = "_begin_config_.*?\n(.*\n).*?_end_config_"
-    replace_config_pattern = (
-        r'''(\'\'\'|""")\s*_begin_config_.*?\n(.*\n).*?_end_config_\s*(\'\'\'|""")'''
-    )
-    for p in sorted(test_paths):
+    for p, scanned in scanner.scan_files(sorted(test_paths), scanner.scan_python):
         relative_path = p.relative_to(testdir)
-        contents = p.read_text()
         dotted_name = ".".join((relative_path.parent / relative_path.stem).parts)
-        info: dict = {}
-        match = re.search(config_pattern, contents, re.DOTALL)
-        if match:
-            info.update(toml.loads(match.group(1)))
-        match = re.search(code_pattern, contents, re.DOTALL)
-        if match:
-            info["code"] = dedent(match.group(1))
+        info = _config(p, scanned)
+        if scanned.code is not None:
+            info["code"] = dedent(scanned.code)
         else:
-            info["code"] = re.sub(replace_config_pattern, "", contents)
+            info["code"] = scanned.without_config
 
         category, testname = dotted_name.split(".")[1:]
         info["testcaseID"] = f"{prefix}{category}_@_{testname}"
@@ -79,28 +113,150 @@ def get_test_metadata(testdir: Path, test_paths: Iterable[Path], prefix: str):
     return result
 
 
-def bundle(prefix: str, testcase_dir: Path, bundle_dir: Path):
-    ignore = shutil.ignore_patterns("__pycache__", "*.pyc")
+def _zip_entries(root: Path, prefix: str = "") -> Dict[str, Path]:
+    """Files and directories under root by their name in the archive."""
+    entries = {}
+    for p in root.glob("**/*"):
+        rel = p.relative_to(root)
+        if "__pycache__" in rel.parts or p.suffix == ".pyc":
+            continue
+        entries[f"{prefix}{rel.as_posix()}{'/' if p.is_dir() else ''}"] = p
+    return entries
+
+
+def _write_zip(path: Path, entries: Dict[str, Union[Path, bytes]]):
+    # Sorted entries with fixed times and modes give the same bytes for the same
+    # contents.
+    with zipfile.ZipFile(path, "w") as z:
+        for name in sorted(entries):
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            if name.endswith("/"):
+                info.external_attr = (0o40755 << 16) | 0x10
+                z.writestr(info, b"")
+                continue
+            info.external_attr = 0o644 << 16
+            data = entries[name]
+            z.writestr(info, data if isinstance(data, bytes) else data.read_bytes())
+
+
+def _write_base64(src: Path, dest: Path):
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        for chunk in iter(lambda: fin.read(BASE64_CHUNK_SIZE), b""):
+            fout.write(base64.b64encode(chunk))
+
+
+def _compile(entries: Dict[str, Union[Path, bytes]]) -> Dict[str, bytes]:
+    """Bytecode of the .py entries by name, for zipimport to load instead.
+
+    Compiled by run_command, so that it matches the Python that runs the tests, as
+    unchecked-hash .pyc files, which zipimport uses without looking at the source.
+    """
     with tempfile.TemporaryDirectory() as t:
-        tmpdir = Path(t)
-        _copytree(testcase_dir, tmpdir, keep_parent=True, ignore=ignore)
-        _copytree(config.dirs.helpers, tmpdir, keep_parent=False, ignore=ignore)
-        with resources.path(f"agni.resources.python", "autograder") as agdir:
-            _copytree(agdir, tmpdir, keep_parent=False, ignore=ignore)
-
-        metadata = get_test_metadata(
-            testcase_dir.parent,
-            (p for p in testcase_dir.glob("**/*.py") if not str(p).endswith("__init__.py")),
-            prefix,
-        )
-        genfile = tmpdir / "_autograder" / "testinfo.py"
-        genfile.write_text(
-            genfile.read_text().replace("_replace_me_", json.dumps(metadata, indent=4))
+        sources = [name for name in entries if name.endswith(".py")]
+        for name in sources:
+            data = entries[name]
+            path = Path(t, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data if isinstance(data, bytes) else data.read_bytes())
+        cmd = [
+            config.get("run_command", "python3"),
+            "-m",
+            "compileall",
+            "-q",
+            "-b",
+            "--invalidation-mode",
+            "unchecked-hash",
+            # File names in tracebacks relative to the archive, without the tempdir.
+            "-d",
+            "",
+            t,
+        ]
+        proc_result = asyncio.run(run_process(cmd))
+        if proc_result.returncode != 0 or proc_result.error:
+            raise click.ClickException(
+                f"Could not compile the bundle:\n{proc_result.stdout}"
+                f"{proc_result.stderr}{proc_result.error}"
+            )
+        return {f"{name}c": Path(t, f"{name}c").read_bytes() for name in sources}
+
+
+def bundle(
+    prefix: str, testcase_dir: Path, bundle_dir: Path, compile_bytecode: bool = False
+):
+    """Write the .pyz of the tests and autograder, and the other bundle files.
+
+    Metadata of test files is kept in autograder/cache/bundle-python/<bundle>, so
+    only changed files are parsed again, and an unchanged .pyz is not rewritten.
+    """
+    builddir = config.dirs.cache / "bundle-python" / bundle_dir.name
+    manifestpath = builddir / "manifest.json"
+    base = [prefix, str(testcase_dir.resolve())]
+    cached_tests = {}
+    if manifestpath.exists():
+        manifest = json.loads(manifestpath.read_text())
+        if manifest.get("base") == base:
+            cached_tests = manifest["tests"]
+
+    tests = {}
+    for p in sorted(testcase_dir.glob("**/*.py")):
+        if str(p).endswith("__init__.py"):
+            continue
+        rel = str(p.relative_to(testcase_dir))
+        file_hash = hash_paths(p)
+        entry = cached_tests.get(rel)
+        if not entry or entry["hash"] != file_hash:
+            metadata = get_test_metadata(testcase_dir.parent, [p], prefix)
+            entry = {"hash": file_hash, "metadata": metadata}
+        tests[rel] = entry
+    metadata = {}
+    for entry in tests.values():
+        metadata.update(entry["metadata"])
+    # resolve() changes the metadata, and the manifest keeps it as parsed.
+    metadata = json.loads(json.dumps(metadata))
+
+    # Student modules that warm workers import once before forking tests.
+    preload = [Path(f).stem for f in config.get("filenames", []) if f.endswith(".py")]
+    limits = config.get("autograder", {}).get("limits", {})
+    _check_limits(limits, "[autograder.limits]")
+    for info in metadata.values():
+        _check_limits(info.get("limits", {}), info["testcaseID"])
+        if "params" in info:
+            _check_params(info["params"], info["testcaseID"])
+    try:
+        prerequisites.resolve(metadata)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+    pyzfile = bundle_dir / f"{bundle_dir.name}.pyz"
+    b64file = Path(f"{pyzfile}.b64")
+    tmpfile = Path(f"{pyzfile}.tmp")
+    # Same layout as copying the tests, helpers and autograder into one directory.
+    entries: Dict[str, Union[Path, bytes]] = {f"{testcase_dir.name}/": testcase_dir}
+    entries.update(_zip_entries(testcase_dir, f"{testcase_dir.name}/"))
+    entries.update(_zip_entries(config.dirs.helpers))
+    with resources.path(f"agni.resources.python", "autograder") as agdir:
+        entries.update(_zip_entries(agdir))
+        genfile = agdir / "_autograder" / "testinfo.py"
+        entries["_autograder/testinfo.py"] = (
+            genfile.read_text()
+            .replace("_replace_me_", repr(metadata))
+            .replace("_replace_preload_", json.dumps(preload))
+            .replace("_replace_limits_", json.dumps(limits))
+            .encode()
         )
+        if compile_bytecode:
+            entries.update(_compile(entries))
+        _write_zip(tmpfile, entries)
+
+    if pyzfile.exists() and b64file.exists() and filecmp.cmp(tmpfile, pyzfile, False):
+        tmpfile.unlink()
+        print(f"{pyzfile} is up to date.")
+    else:
+        os.replace(str(tmpfile), str(pyzfile))
+        _write_base64(pyzfile, b64file)
 
-        pyzfile = bundle_dir / f"{bundle_dir.name}.pyz"
-        zipapp.create_archive(tmpdir, pyzfile)
-        Path(f"{pyzfile}.b64").write_bytes(base64.b64encode(pyzfile.read_bytes()))
+    metadatapath = bundle_dir / f"{bundle_dir.name}_metadata.json"
+    metadatapath.write_text(json.dumps(metadata, indent=4))
 
-        metadatapath = bundle_dir / f"{bundle_dir.name}_metadata.json"
-        metadatapath.write_text(json.dumps(metadata, indent=4))
+    builddir.mkdir(parents=True, exist_ok=True)
+    manifestpath.write_text(json.dumps({"base": base, "tests": tests}))
@@ -0,0 +1,116 @@
+from pathlib import Path
+import click
+from .. import config, telemetry
+from ..telemetry import percentile
+from . import run_external
+import asyncio
+import json
+import math
+import sys
+import tempfile
+from collections import defaultdict
+
+
+# As in _autograder/main.py, in seconds.
+PYTHON_DEFAULT_TIMEOUT = 5
+
+
+def dir_must_exist(ctx, param, value):
+    value = Path(value)
+    if value.exists() and value.is_dir():
+        return value
+    else:
+        raise click.BadParameter(f'Path "{value}" must be an existing directory.')
+
+
+@click.command()
+@click.option(
+    "--config",
+    expose_value=False,
+    callback=lambda ctx, param, value: config.load(value),
+)
+@click.option("--runs", type=int, default=5, help="Number of runs of each solution.")
+@click.option(
+    "--factor",
+    type=float,
+    default=3.0,
+    help="Timeout of a test as a multiple of the p99 of its runtimes.",
+)
+@click.option("--floor", type=float, default=1.0, help="Minimum timeout in seconds.")
+@click.option("--num-procs", type=int, default=1)
+@click.argument(
+    "bundle-dir", nargs=1, callback=dir_must_exist,
+)
+def main(runs: int, factor: float, floor: float, num_procs: int, bundle_dir: Path):
+    """Set test timeouts from runtimes of the solutions in src/solutions.
+
+    Calibrated timeouts are written to the bundle metadata, never exceed the
+    configured ones and are used by run-external. Bundling again removes them.
+    """
+    asyncio.run(_main(runs, factor, floor, num_procs, bundle_dir))
+
+
+async def _main(
+    runs: int, factor: float, floor: float, num_procs: int, bundle_dir: Path
+):
+    solutions = sorted(p for p in config.dirs.solutions.glob("*") if p.is_dir())
+    if not solutions:
+        print(f"No solutions found in {config.dirs.solutions}")
+        sys.exit(1)
+    print("Running tests on the following solutions:")
+    for p in solutions:
+        print(p.name)
+
+    commands = run_external.load_commands(bundle_dir)
+    durations = defaultdict(list)
+    failures = defaultdict(int)
+    with tempfile.TemporaryDirectory() as t:
+        eventsfile = Path(t) / telemetry.FILENAME
+        with telemetry.recording(eventsfile):
+            for i in range(runs):
+                print(f"Run {i + 1} of {runs}")
+                outdir = Path(t) / f"outputs{i}"
+                outdir.mkdir()
+                await run_external.grade(
+                    solutions, bundle_dir, commands, outdir, num_procs
+                )
+        for line in eventsfile.read_text().splitlines():
+            event = json.loads(line)
+            if event["kind"] != "test":
+                continue
+            if event.get("duration") is not None:
+                durations[event["test"]].append(event["duration"])
+            if not event.get("passed") or event.get("is_timeout"):
+                failures[event["test"]] += 1
+
+    metadatapath = bundle_dir / f"{bundle_dir.name}_metadata.json"
+    metadata = json.loads(metadatapath.read_text())
+    # Java timeouts are in milliseconds, Python timeouts in seconds.
+    if config.get("language") == "java":
+        scale = 1000
+        default_timeout = config.get("autograder", {}).get("default-timeout", 3000)
+    else:
+        scale = 1
+        default_timeout = PYTHON_DEFAULT_TIMEOUT
+
+    print(f"{'p99 (s)':>8} {'timeout':>8} {'calibrated':>11}  test")
+    for info in metadata.values():
+        test_id = info["testcaseID"]
+        info.pop("calibrated_timeout", None)
+        configured = info.get("timeout", default_timeout)
+        if failures[test_id] or not durations[test_id]:
+            # Keep the configured timeout; the test needs fixing first.
+            print(f"{'-':>8} {configured:>8} {'-':>11}  {test_id} [FAILED]")
+            continue
+        p99 = percentile(sorted(durations[test_id]), 99)
+        timeout = max(floor, factor * p99) * scale
+        timeout = math.ceil(timeout) if scale > 1 else math.ceil(timeout * 10) / 10
+        timeout = min(timeout, configured)
+        info["calibrated_timeout"] = timeout
+        print(f"{p99:>8.2f} {configured:>8} {timeout:>11}  {test_id}")
+
+    answer = input(f"Write calibrated timeouts to {metadatapath}? [yes/no]: ")
+    if answer != "yes":
+        print("Not continuing further, bye.")
+        sys.exit(1)
+    metadatapath.write_text(json.dumps(metadata, indent=4))
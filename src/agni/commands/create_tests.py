@@ -1,8 +1,10 @@
 from pathlib import Path
 import click
-from .. import config
+from .. import config, codepost_client
+import functools
 import sys
 import json
+import time
 
 
 def dir_must_exist(ctx, param, value):
@@ -19,58 +21,77 @@ def dir_must_exist(ctx, param, value):
     expose_value=False,
     callback=lambda ctx, param, value: config.load(value),
 )
+@click.option("--num-threads", type=int, default=8)
+@click.option(
+    "--max-rate", type=float, default=10.0, help="Maximum requests per second."
+)
 @click.argument(
     "bundle-dir", nargs=1, callback=dir_must_exist,
 )
-def main(bundle_dir: Path):
-    """Create external tests on Codepost."""
-    import codepost
+def main(num_threads: int, max_rate: float, bundle_dir: Path):
+    """Create external tests on Codepost.
 
-    d = config.get("codepost")
-    assert d and isinstance(d, dict)
-    assignment_name = d.get("assignment_name")
-    course_name = d.get("course_name")
-    course_period = d.get("course_period")
-    api_key_path = d.get("api_key_path")
-    assert assignment_name and course_name and course_period and api_key_path
+    Only test cases missing from Codepost are created, so this can be run again
+    after adding tests to the bundle.
+    """
+    import codepost
 
-    codepost.configure_api_key(Path(api_key_path).expanduser().read_text().strip())
+    assignment = codepost_client.get_assignment()
 
-    mycourse = codepost.course.list_available(name=course_name, period=course_period)[0]
-    print(f"Course: {mycourse.name}, {mycourse.period}")
-    assignment = {x.name: x for x in mycourse.assignments}[assignment_name]
-    print(f"Assignment: {assignment.name}")
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    categories = dict(codepost_client.get_categories(assignment))
+    plan = codepost_client.plan_tests(
+        metadata, codepost_client.get_tests(assignment), categories
+    )
+    codepost_client.print_plan(plan)
+    if plan["update"]:
+        print("Run update-points to update the points of existing test cases.")
 
     answer = input("Continue? [yes/no]: ")
     if answer != "yes":
         print("Not continuing further, bye.")
         sys.exit(1)
 
-    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
-
-    cat2id = {info.get("testcaseID").split("_@_")[0]: None for info in metadata.values()}
-    for cat in cat2id.keys():
-        obj = codepost.test_category.create(assignment=assignment.id, name=cat)
-        cat2id[cat] = obj.id
-        print(f"{cat}: {obj.id}")
+    start = time.monotonic()
+    calls = [
+        functools.partial(
+            codepost.test_category.create, assignment=assignment.id, name=cat
+        )
+        for cat in plan["categories"]
+    ]
+    created = codepost_client.send_all(
+        calls, plan["categories"], num_threads, max_rate, idempotent=False
+    )
+    for cat, obj in zip(plan["categories"], created):
+        if obj:
+            categories[cat] = obj.id
 
     print("-" * 80)
 
-    for i, info in enumerate(metadata.values()):
-        pointsPass = pointsFail = 0
-        points = info.get("points")
-        if points < 0:
-            pointsFail = points
-        else:
-            pointsPass = points
-
-        test_category, test_name = info.get("testcaseID").split("_@_")
-        test_obj = codepost.test_case.create(
-            testCategory=cat2id[test_category],
+    tests = [test for test in plan["create"] if test["category"] in categories]
+    calls = [
+        functools.partial(
+            codepost.test_case.create,
+            testCategory=categories[test["category"]],
             type="external",
-            description=test_name,
-            sortKey=i,
-            pointsFail=pointsFail,
-            pointsPass=pointsPass,
+            description=test["description"],
+            sortKey=test["sortKey"],
+            pointsFail=test["pointsFail"],
+            pointsPass=test["pointsPass"],
         )
-        print(f"{test_category} :: {test_name} : {test_obj.id}")
+        for test in tests
+    ]
+    created = codepost_client.send_all(
+        calls,
+        [test["testcaseID"] for test in tests],
+        num_threads,
+        max_rate,
+        idempotent=False,
+    )
+
+    codepost_client.invalidate()
+    num_created = sum(1 for obj in created if obj)
+    num_failed = len(plan["create"]) - num_created
+    print(f"Created {num_created} test cases in {time.monotonic() - start:.1f}s.")
+    if num_failed:
+        print(f"Failed to create {num_failed} test cases, run again to retry.")
@@ -1,6 +1,6 @@
 from pathlib import Path
 import click
-from .. import config
+from .. import config, codepost_client
 import sys
 import json
 
@@ -24,22 +24,7 @@ def dir_must_exist(ctx, param, value):
 )
 def main(bundle_dir: Path):
     """Delete test cases on Codepost."""
-    import codepost
-
-    d = config.get("codepost")
-    assert d and isinstance(d, dict)
-    assignment_name = d.get("assignment_name")
-    course_name = d.get("course_name")
-    course_period = d.get("course_period")
-    api_key_path = d.get("api_key_path")
-    assert assignment_name and course_name and course_period and api_key_path
-
-    codepost.configure_api_key(Path(api_key_path).expanduser().read_text().strip())
-
-    mycourse = codepost.course.list_available(name=course_name, period=course_period)[0]
-    print(f"Course: {mycourse.name}, {mycourse.period}")
-    assignment = {x.name: x for x in mycourse.assignments}[assignment_name]
-    print(f"Assignment: {assignment.name}")
+    assignment = codepost_client.get_assignment()
 
     answer = input("Continue? [yes/no]: ")
     if answer != "yes":
@@ -74,3 +59,5 @@ def main(bundle_dir: Path):
         print(f"Deleting category id:{cat.id}, name: {cat.name}")
         response = cat.delete() 
         print(f"Response from delete: {response}")
+
+    codepost_client.invalidate()
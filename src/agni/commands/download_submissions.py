@@ -1,8 +1,16 @@
 from pathlib import Path
 import click
-from .. import config
-import pandas as pd
+from .. import config, codepost_client
 import sys
+import os
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+
+
+MANIFEST_NAME = ".download_manifest.json"
 
 
 @click.command()
@@ -12,29 +20,15 @@ import sys
     callback=lambda ctx, param, value: config.load(value),
 )
 @click.option("--students", required=False, default=None)
-def main(students):
+@click.option("--num-threads", type=int, default=8)
+def main(students, num_threads):
     """Download student submissions from Codepost."""
     filenames = config.get("filenames")
     if not filenames:
         print("Please set filenames in config.toml")
         sys.exit(1)
 
-    import codepost
-
-    d = config.get("codepost")
-    assert d and isinstance(d, dict)
-    assignment_name = d.get("assignment_name")
-    course_name = d.get("course_name")
-    course_period = d.get("course_period")
-    api_key_path = d.get("api_key_path")
-    assert assignment_name and course_name and course_period and api_key_path
-
-    codepost.configure_api_key(Path(api_key_path).expanduser().read_text().strip())
-
-    mycourse = codepost.course.list_available(name=course_name, period=course_period)[0]
-    print(f"Course: {mycourse.name}, {mycourse.period}")
-    assignment = {x.name: x for x in mycourse.assignments}[assignment_name]
-    print(f"Assignment: {assignment.name}")
+    assignment = codepost_client.get_assignment()
 
     answer = input("Continue? [yes/no]: ")
     if answer != "yes":
@@ -45,35 +39,81 @@ def main(students):
         config.dirs.submissions.mkdir()
 
     if students:
-        all_submissions = [
-            assignment.list_submissions(student=student)[0]
-            for student in students.split(",")
-        ]
+        jobs = [dict(student=student) for student in students.split(",")]
     else:
-        all_submissions = assignment.list_submissions()
+        jobs = [dict(submission=s) for s in assignment.list_submissions()]
+
+    manifestpath = config.dirs.project_root / MANIFEST_NAME
+    num_failed = download(
+        assignment, jobs, filenames, config.dirs.submissions, manifestpath, num_threads
+    )
+    if num_failed:
+        print(f"{num_failed} submissions failed, run the command again to retry them.")
+        sys.exit(1)
+
 
-    for submission in all_submissions:
+def latest_files(files) -> dict:
+    """Latest file for each name; on equal timestamps the later one wins."""
+    latest = {}
+    for obj in files:
+        current = latest.get(obj.name)
+        if current is None or obj.created >= current.created:
+            latest[obj.name] = obj
+    return latest
+
+
+def download(
+    assignment,
+    jobs: List[dict],
+    filenames: List[str],
+    submissions_dir: Path,
+    manifestpath: Path,
+    num_threads: int = 8,
+) -> int:
+    """Download the files of the submissions in a thread pool.
+
+    Jobs give a student or a submission. Returns the number of failed jobs.
+    """
+    # Submission id -> "created" timestamp of each downloaded file, so that an
+    # interrupted or repeated download skips what is already on disk.
+    manifest = json.loads(manifestpath.read_text()) if manifestpath.exists() else {}
+    lock = threading.Lock()
+
+    def download_one(student=None, submission=None):
+        if submission is None:
+            submission = assignment.list_submissions(student=student)[0]
         student_name = submission.students[0]  # .split("@")[0]
-        print(f"Processing submission {submission.id} for {student_name}")
-        files = pd.DataFrame(
-            {
-                field: getattr(obj, field)
-                for field in ("id", "name", "code", "submission", "created")
-            }
-            for obj in submission.files
-        )
-        latest_files = (
-            files.sort_values("created").drop_duplicates("name", keep="last")
-            .set_index("name")
-        )
-        sub_dir = (
-            config.dirs.submissions
-            / f"{student_name}__{assignment.id}__{submission.id}"
-        )
+        files = latest_files(submission.files)
+        sub_dir = submissions_dir / f"{student_name}__{assignment.id}__{submission.id}"
+        created = {fname: str(files[fname].created) for fname in filenames}
+        if manifest.get(str(submission.id)) == created and all(
+            (sub_dir / fname).exists() for fname in filenames
+        ):
+            return f"Skipping submission {submission.id} for {student_name}"
+
         sub_dir.mkdir(exist_ok=True)
         for fname in filenames:
-            file_info = latest_files.loc[fname]
+            file_info = files[fname]
             (sub_dir / file_info.name).write_text(file_info.code)
 
-        # for _, row in latest_files.iterrows():
-        #     (sub_dir / row["name"]).write_text(row["code"])
+        with lock:
+            manifest[str(submission.id)] = created
+            _write_manifest(manifestpath, manifest)
+        return f"Downloaded submission {submission.id} for {student_name}"
+
+    num_failed = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = [pool.submit(download_one, **job) for job in jobs]
+        for future in as_completed(futures):
+            try:
+                print(future.result())
+            except Exception:
+                num_failed += 1
+                traceback.print_exc()
+    return num_failed
+
+
+def _write_manifest(manifestpath: Path, manifest: dict):
+    tmppath = manifestpath.with_suffix(".tmp")
+    tmppath.write_text(json.dumps(manifest, indent=4))
+    os.replace(str(tmppath), str(manifestpath))
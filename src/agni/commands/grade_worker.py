@@ -0,0 +1,15 @@
+import asyncio
+import click
+from ..distributed import serve
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Use 0.0.0.0 to accept other hosts.")
+@click.option("--port", type=int, default=7777)
+def main(host: str, port: int):
+    """Run tests sent by run-external --workers.
+
+    Anyone who can connect can run code on this machine, so only listen on
+    trusted networks.
+    """
+    asyncio.run(serve(host, port))
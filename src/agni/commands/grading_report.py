@@ -0,0 +1,131 @@
+from pathlib import Path
+import click
+from .. import config, telemetry
+from ..telemetry import percentile
+import json
+import sys
+from collections import defaultdict
+from typing import List, Optional
+
+
+def dir_must_exist(ctx, param, value):
+    if not value:
+        return None
+    value = Path(value)
+    if value.exists() and value.is_dir():
+        return value
+    else:
+        raise click.BadParameter(f'Path "{value}" must be an existing directory.')
+
+
+@click.command()
+@click.option(
+    "--config",
+    expose_value=False,
+    callback=lambda ctx, param, value: config.load(value),
+)
+@click.option("--top", type=int, default=10, help="Number of slowest tests to show.")
+@click.argument("run-dir", nargs=1, required=False, callback=dir_must_exist)
+def main(top: int, run_dir: Optional[Path]):
+    """Summarize the telemetry of a run-external run (the latest one by default)."""
+    if run_dir is None:
+        runs = sorted(
+            p.parent for p in config.dirs.autograder.glob(f"*/{telemetry.FILENAME}")
+        )
+        if not runs:
+            print(f"No {telemetry.FILENAME} found in {config.dirs.autograder}")
+            sys.exit(1)
+        run_dir = runs[-1]
+
+    path = run_dir / telemetry.FILENAME
+    if not path.exists():
+        print(f"{path} does not exist.")
+        sys.exit(1)
+    events = defaultdict(list)
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                event = json.loads(line)
+                events[event["kind"]].append(event)
+
+    print(f"Run: {run_dir}")
+    _print_totals(events)
+    _print_slowest_tests(events["test"], top)
+
+
+def _total(events: List[dict], key: str = "duration") -> float:
+    return sum(e.get(key) or 0.0 for e in events)
+
+
+def _print_totals(events: dict):
+    for run in events["run"]:
+        workers = f", workers: {run['workers']}" if run.get("workers") else ""
+        print(
+            f"Wall time: {run['duration']:.1f}s for {run['students']} students and "
+            f"{run['tests']} tests ({run['num_procs']} processes{workers})"
+        )
+    students = sorted(e["duration"] for e in events["student"])
+    if students:
+        print(
+            f"Time per student: p50 {percentile(students, 50):.2f}s, "
+            f"p95 {percentile(students, 95):.2f}s, max {students[-1]:.2f}s"
+        )
+
+    compiles = events["compile"]
+    compile_time = _total(compiles)
+    # With --jvm-reuse, tests run in batches and have no timings of their own.
+    run_time = _total(events["test"]) + _total(events["batch"])
+    if compile_time or run_time:
+        share = 100 * compile_time / (compile_time + run_time)
+        print(
+            f"Process time: compile {compile_time:.1f}s ({share:.0f}%), "
+            f"run {run_time:.1f}s ({100 - share:.0f}%)"
+        )
+    if compiles:
+        errors = sum(1 for e in compiles if e.get("error"))
+        print(f"Compilations: {len(compiles)}, with errors: {errors}")
+
+
+def _print_slowest_tests(tests: List[dict], top: int):
+    by_test = defaultdict(list)
+    for e in tests:
+        by_test[e["test"]].append(e)
+    if not by_test:
+        print("No per-test timings recorded.")
+        return
+
+    rows = []
+    for test_id, runs in by_test.items():
+        durations = sorted(e.get("duration") or 0.0 for e in runs)
+        rss = [e["peak_rss_kb"] for e in runs if e.get("peak_rss_kb")]
+        timeouts = sum(1 for e in runs if e.get("is_timeout"))
+        rows.append(
+            (
+                test_id,
+                len(runs),
+                percentile(durations, 50),
+                percentile(durations, 95),
+                durations[-1],
+                timeouts / len(runs),
+                max(rss) // 1024 if rss else None,
+            )
+        )
+    rows.sort(key=lambda row: row[3], reverse=True)
+
+    print()
+    print(f"Slowest tests by p95 (top {min(top, len(rows))} of {len(rows)}):")
+    header = ("p50", "p95", "max", "timeouts", "RSS MB", "runs")
+    print("{:>8} {:>8} {:>8} {:>9} {:>7} {:>5}  test".format(*header))
+    for test_id, n, p50, p95, longest, timeout_rate, rss_mb in rows[:top]:
+        rss_text = str(rss_mb) if rss_mb is not None else "-"
+        print(
+            f"{p50:>7.2f}s {p95:>7.2f}s {longest:>7.2f}s {timeout_rate:>8.0%} "
+            f"{rss_text:>7} {n:>5}  {test_id}"
+        )
+
+    timed_out = [row for row in rows if row[5]]
+    if timed_out:
+        print()
+        print("Tests with timeouts:")
+        for row in sorted(timed_out, key=lambda row: row[5], reverse=True):
+            print(f"{row[5]:>5.0%} of {row[1]} runs  {row[0]}")
@@ -1,17 +1,35 @@
 from pathlib import Path
 import click
-from .. import config
-from ..proc_util import run_process, concurrent
+from .. import config, telemetry
+from ..prerequisites import levels, skip_message
+from ..proc_util import JAVA_LIMITS, run_process, concurrent, limit_message
+from ..cache import ResultCache, hash_paths, hash_tests
+from ..javac_server import javac_server, run_javac
+from ..distributed import coordinate
 import asyncio
+import contextlib
 import tempfile
 import json
 import os
 import sys
 import shutil
+from dataclasses import dataclass, field
 from datetime import datetime
 import re
 import shlex
-from typing import List
+import time
+import hashlib
+import zipfile
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Bytes of stdout (per line when streamed) and of stderr kept from a test process,
+# so that a submission printing in a loop cannot fill the grader's memory.
+MAX_OUTPUT = 2 ** 20
+
+# Same as RESTART_LINE and RESTART_STATUS in Executor.java.
+BATCH_RESTART_LINE = "_agni_restart_"
+BATCH_RESTART_STATUS = 75
 
 
 def dir_must_exist(ctx, param, value):
@@ -53,17 +71,97 @@ def _copytree(src, dest, keep_parent=False, ignore=None):
 @click.option("--num-procs", type=int, default=1)
 @click.option("--students", default=None, callback=file_must_exist)
 @click.option("--tests", default=None, callback=file_must_exist)
+@click.option(
+    "--jvm-reuse",
+    is_flag=True,
+    default=False,
+    help="[Java] Run all tests of a submission in one JVM instead of one JVM per test.",
+)
+@click.option(
+    "--cache",
+    "use_cache",
+    is_flag=True,
+    default=False,
+    help="Reuse results of earlier runs for unchanged submissions and tests.",
+)
+@click.option(
+    "--recompile",
+    is_flag=True,
+    default=False,
+    help="[Java] Forget the compiled submissions and compile errors of earlier runs.",
+)
+@click.option(
+    "--workers",
+    default=None,
+    help="Comma-separated host:port of grade-worker processes to run the tests on.",
+)
+@click.option(
+    "--shard-size",
+    type=int,
+    default=10,
+    help="With --workers, number of submissions sent to a worker at a time.",
+)
+@click.option(
+    "--worker-timeout",
+    type=float,
+    default=60,
+    help="With --workers, seconds after which a silent worker's shard is reassigned.",
+)
+@click.option(
+    "--configured-timeouts",
+    is_flag=True,
+    default=False,
+    help="Ignore the timeouts set by agni calibrate.",
+)
 @click.argument(
     "bundle-dir", nargs=1, callback=dir_must_exist,
 )
-def main(num_procs: int, students: Path, tests: Path, bundle_dir: Path):
+def main(
+    num_procs: int,
+    students: Path,
+    tests: Path,
+    jvm_reuse: bool,
+    use_cache: bool,
+    recompile: bool,
+    workers: str,
+    shard_size: int,
+    worker_timeout: float,
+    configured_timeouts: bool,
+    bundle_dir: Path,
+):
     """Run external tests on student submissions."""
     language = config.get("language")
-    if language == "java":
-        asyncio.run(_main(num_procs, students, tests, bundle_dir))
+    if recompile:
+        shutil.rmtree(str(config.dirs.cache / "build"), ignore_errors=True)
+    if language in ("java", "python"):
+        asyncio.run(
+            _main(
+                num_procs,
+                students,
+                tests,
+                jvm_reuse,
+                use_cache,
+                workers,
+                shard_size,
+                worker_timeout,
+                configured_timeouts,
+                bundle_dir,
+            )
+        )
 
 
-async def _main(num_procs: int, students: Path, testsfile: Path, bundle_dir: Path):
+async def _main(
+    num_procs: int,
+    students: Path,
+    testsfile: Path,
+    jvm_reuse: bool,
+    use_cache: bool,
+    workers: Optional[str],
+    shard_size: int,
+    worker_timeout: float,
+    configured_timeouts: bool,
+    bundle_dir: Path,
+):
     if students:
         student_list = {
             s.strip().split("__")[0] for s in students.read_text().strip().splitlines()
@@ -85,24 +183,20 @@ async def _main(num_procs: int, students: Path, testsfile: Path, bundle_dir: Pat
         print("Not continuing further, bye.")
         sys.exit(1)
 
-    commandfile = bundle_dir / f"{bundle_dir.name}_commands.sh"
+    tests = None
     if testsfile:
         tests = set(s.strip() for s in testsfile.read_text().splitlines())
-        commands = []
-        for line in commandfile.read_text().splitlines():
-            if re.search(r'testcaseID="(.*?)"', line).group(1) in tests:
-                args = shlex.split(line)
-                commands.append([args[0], "-DisExternal=true", *args[1:]])
-    else:
-        commands = []
-        for line in commandfile.read_text().splitlines():
-            args = shlex.split(line)
-            commands.append([args[0], "-DisExternal=true", *args[1:]])
 
+    timeouts = {} if configured_timeouts else calibrated_timeouts(bundle_dir)
+    if timeouts:
+        print(f"Using calibrated timeouts of {len(timeouts)} tests.")
+    commands = load_commands(bundle_dir, jvm_reuse, tests, timeouts)
+
+    if not tests:
         print("Running ALL tests.")
 
     print("Running the following tests:")
-    for cmd in commands:
+    for cmd in commands.values():
         # print(" ".join(cmd))
         print(cmd)
 
@@ -114,70 +208,914 @@ async def _main(num_procs: int, students: Path, testsfile: Path, bundle_dir: Pat
     graderdir = config.dirs.autograder / datetime.now().strftime("%Y-%m-%dT%H%M%S")
     outdir = graderdir / "outputs"
     outdir.mkdir(parents=True, exist_ok=True)
-    jarfile = bundle_dir / f"{bundle_dir.name}.jar"
 
-    coros = [
-        run(subdir, jarfile, commands, outdir / f"{subdir.name}.json")
-        for subdir in subdirs
-    ]
+    start = time.monotonic()
+    with telemetry.recording(graderdir / telemetry.FILENAME):
+        if workers:
+            if use_cache:
+                print("--cache is not used with --workers.")
+            await coordinate(
+                workers.split(","),
+                subdirs,
+                bundle_dir,
+                commands,
+                outdir,
+                num_procs,
+                jvm_reuse,
+                shard_size,
+                timeouts,
+                worker_timeout,
+            )
+        else:
+            await grade(
+                subdirs,
+                bundle_dir,
+                commands,
+                outdir,
+                num_procs,
+                jvm_reuse,
+                use_cache,
+                timeouts=timeouts,
+            )
+        telemetry.record(
+            "run",
+            duration=time.monotonic() - start,
+            students=len(subdirs),
+            tests=len(commands),
+            num_procs=num_procs,
+            workers=workers or "",
+        )
+
+
+def load_commands(
+    bundle_dir: Path,
+    jvm_reuse: bool = False,
+    tests: Optional[set] = None,
+    timeouts: Optional[Dict[str, float]] = None,
+) -> Dict[str, Any]:
+    """Commands (or batch file lines, or test modules) by test id, in bundle order.
+
+    Java commands get the given timeouts instead of those they were bundled with.
+    """
+    language = config.get("language")
+    commandfile = bundle_dir / f"{bundle_dir.name}_commands.sh"
+    batchfile = bundle_dir / f"{bundle_dir.name}_batch.txt"
+    timeouts = timeouts or {}
+    commands: Dict[str, Any] = {}
+    if language == "python":
+        metadata = json.loads(
+            (bundle_dir / f"{bundle_dir.name}_metadata.json").read_text()
+        )
+        for module, info in metadata.items():
+            test_id = info["testcaseID"]
+            if not tests or test_id in tests:
+                commands[test_id] = module
+    elif jvm_reuse:
+        for line in batchfile.read_text().splitlines():
+            class_name, test_id, timeout = line.split("\t")
+            if not tests or test_id in tests:
+                timeout = timeouts.get(test_id, timeout)
+                commands[test_id] = f"{class_name}\t{test_id}\t{timeout}"
+    else:
+        for line in commandfile.read_text().splitlines():
+            test_id = re.search(r'testcaseID="(.*?)"', line).group(1)
+            if not tests or test_id in tests:
+                args = shlex.split(line)
+                if test_id in timeouts:
+                    args = [
+                        f"-Dtimeout={timeouts[test_id]}"
+                        if arg.startswith("-Dtimeout=")
+                        else arg
+                        for arg in args
+                    ]
+                commands[test_id] = [args[0], "-DisExternal=true", *args[1:]]
+    return commands
 
-    with click.progressbar(length=len(coros), width=50) as bar:
-        async for _ in concurrent(coros, num_procs):
-            bar.update(1)
+
+def calibrated_timeouts(bundle_dir: Path) -> Dict[str, float]:
+    """Timeouts set by agni calibrate by test id, in the units of the metadata."""
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    return {
+        info["testcaseID"]: info["calibrated_timeout"]
+        for info in metadata.values()
+        if "calibrated_timeout" in info
+    }
+
+
+async def grade(
+    subdirs: List[Path],
+    bundle_dir: Path,
+    commands: Dict[str, Any],
+    outdir: Path,
+    num_procs: int,
+    jvm_reuse: bool = False,
+    use_cache: bool = False,
+    on_done: Optional[Callable[[Path], None]] = None,
+    timeouts: Optional[Dict[str, float]] = None,
+):
+    """Run the tests on the submissions, writing <outdir>/<submission>.json.
+
+    on_done is called with each submission directory once its output is complete.
+    Python tests get the given timeouts (in seconds) instead of those in the bundle;
+    Java commands already have theirs.
+    """
+    language = config.get("language")
+    if language == "python":
+        pyzfile = bundle_dir / f"{bundle_dir.name}.pyz"
+        cache = None
+        if use_cache:
+            hashes = _python_test_hashes(bundle_dir, timeouts or {})
+            cache = ResultCache(config.dirs.cache, hashes)
+        coros = [
+            run_python(
+                subdir,
+                pyzfile,
+                commands,
+                outdir / f"{subdir.name}.json",
+                cache,
+                timeouts,
+            )
+            for subdir in subdirs
+        ]
+    else:
+        jarfile = bundle_dir / f"{bundle_dir.name}.jar"
+        limits = _java_limits(bundle_dir)
+        requires = _java_requires(bundle_dir)
+        test_timeouts = {**_java_timeouts(bundle_dir), **(timeouts or {})}
+        cache = None
+        if use_cache:
+            hashes = _java_test_hashes(bundle_dir, jvm_reuse, test_timeouts, limits)
+            cache = ResultCache(config.dirs.cache, hashes)
+        if not jvm_reuse:
+            with javac_server():
+                await run_scheduled(
+                    subdirs,
+                    jarfile,
+                    commands,
+                    outdir,
+                    num_procs,
+                    cache,
+                    limits,
+                    test_timeouts,
+                    requires,
+                    on_done,
+                )
+            return
+        coros = [
+            run(
+                subdir,
+                jarfile,
+                commands,
+                outdir / f"{subdir.name}.json",
+                jvm_reuse,
+                cache,
+                limits,
+                requires,
+            )
+            for subdir in subdirs
+        ]
+
+    with javac_server() if language == "java" else contextlib.nullcontext():
+        with click.progressbar(length=len(coros), width=50) as bar:
+            async for i, _ in concurrent(coros, num_procs):
+                if on_done:
+                    on_done(subdirs[i])
+                bar.update(1)
+
+
+def _archive_entries(archive: Path) -> Dict[str, bytes]:
+    with zipfile.ZipFile(archive) as z:
+        return {
+            info.filename: z.read(info) for info in z.infolist() if not info.is_dir()
+        }
+
+
+def _test_paths(metadata: dict) -> Dict[str, str]:
+    # Names of the test files in the archive without the suffix, by test id.
+    return {
+        info["testcaseID"]: module.replace(".", "/")
+        for module, info in metadata.items()
+    }
+
+
+def _python_test_hashes(bundle_dir: Path, timeouts: Dict[str, float]) -> Dict[str, str]:
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    entries = {}
+    for name, data in _archive_entries(bundle_dir / f"{bundle_dir.name}.pyz").items():
+        if name.endswith(".pyc"):
+            # Compiled from the .py entries by run_command, which is a setting.
+            continue
+        if name == "_autograder/testinfo.py":
+            # Without the metadata of all tests; that of each test is in its info.
+            lines = data.splitlines(keepends=True)
+            data = b"".join(line for line in lines if not line.startswith(b"data = "))
+        entries[name] = data
+    infos = {
+        info["testcaseID"]: {**info, "run_timeout": timeouts.get(info["testcaseID"])}
+        for info in metadata.values()
+    }
+    return hash_tests(
+        entries,
+        _test_paths(metadata),
+        infos,
+        run_command=config.get("run_command", "python3"),
+    )
+
+
+def _java_test_hashes(
+    bundle_dir: Path,
+    jvm_reuse: bool,
+    timeouts: Dict[str, int],
+    limits: Dict[str, dict],
+) -> Dict[str, str]:
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    jarfile = bundle_dir / f"{bundle_dir.name}.jar"
+    # TestCode holds the code and params of all tests, which are in their metadata.
+    entries = {
+        name: data
+        for name, data in _archive_entries(jarfile).items()
+        if not name.startswith("_autograder/TestCode")
+    }
+    infos = {}
+    for info in metadata.values():
+        test_id = info["testcaseID"]
+        infos[test_id] = {
+            **info,
+            "run_timeout": timeouts.get(test_id),
+            "run_limits": limits.get(test_id),
+        }
+    hashes = hash_tests(
+        entries,
+        _test_paths(metadata),
+        infos,
+        jvm_reuse=jvm_reuse,
+        default_limits=config.get("autograder", {}).get("limits", {}),
+    )
+    if jvm_reuse:
+        # Tests share a JVM, so a result also depends on the tests before it.
+        previous = ""
+        for test_id, test_hash in hashes.items():
+            previous = hashlib.sha256(f"{previous}{test_hash}".encode()).hexdigest()
+            hashes[test_id] = previous
+    return hashes
 
 
 def _show_files(dir):
     print([str(p.relative_to(dir)) for p in dir.glob("**/*")])
 
 
-async def run(subdir: Path, jarfile: Path, commands: List, outputfile: Path):
-    with tempfile.TemporaryDirectory() as t:
-        tmpdir = Path(t)
-        if config.dirs.input_files.exists():
-            _copytree(config.dirs.input_files, tmpdir, keep_parent=False)
+def _java_limits(bundle_dir: Path) -> Dict[str, dict]:
+    """Resource limits by test id, from [autograder.limits] and each test's [limits]."""
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    default_limits = config.get("autograder", {}).get("limits", {})
+    # Checked again here, since [autograder.limits] may change after bundling.
+    unsupported = sorted(set(default_limits) - set(JAVA_LIMITS))
+    if unsupported:
+        raise click.ClickException(
+            f"Limits in [autograder.limits] not supported for Java: "
+            f"{', '.join(unsupported)}."
+        )
+    return {
+        info["testcaseID"]: {**default_limits, **info.get("limits", {})}
+        for info in metadata.values()
+    }
 
-        if config.dirs.helpers.exists():
-            _copytree(config.dirs.helpers, tmpdir, keep_parent=False)
 
-        _copytree(subdir, tmpdir, keep_parent=False)
+def _java_timeouts(bundle_dir: Path) -> Dict[str, int]:
+    """Timeouts in milliseconds by test id, as in the generated commands."""
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    default_timeout = config.get("autograder", {}).get("default-timeout", 3000)
+    return {
+        info["testcaseID"]: info.get("timeout", default_timeout)
+        for info in metadata.values()
+    }
+
+
+def _java_requires(bundle_dir: Path) -> Dict[str, List[str]]:
+    """Test ids of the prerequisites of each test by test id."""
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    return {info["testcaseID"]: info.get("requires", []) for info in metadata.values()}
+
+
+def _failed_requirements(
+    test_id: str, requires: Dict[str, List[str]], results: Dict[str, str], selected
+) -> List[str]:
+    """Prerequisites of the test that are among the selected tests and did not pass.
+
+    A prerequisite that was run but has no result (e.g. its JVM died) did not pass.
+    """
+    failed = []
+    for tid in requires.get(test_id, []):
+        if tid not in selected and tid not in results:
+            continue
+        try:
+            passed = json.loads(results[tid]).get("passed") is True
+        except (KeyError, ValueError):
+            passed = False
+        if not passed:
+            failed.append(tid)
+    return failed
+
+
+def _skipped_line(test_id: str, failed: List[str]) -> str:
+    log = "********* {} ********* [FAILED]\n{}\n\n\n".format(
+        test_id.replace("_@_", " : "), skip_message(failed)
+    )
+    return json.dumps({"id": test_id, "passed": False, "log": log, "skipped": True})
+
+
+def _limit_line(test_id: str, limit: str, limits: dict) -> str:
+    log = "********* {} ********* [FAILED]\n{}\n\n\n".format(
+        test_id.replace("_@_", " : "), limit_message(limit, limits)
+    )
+    return json.dumps(
+        {"id": test_id, "passed": False, "log": log, "limit_exceeded": limit}
+    )
+
+
+def _exited_line(test_id: str) -> str:
+    log = "********* {} ********* [FAILED]\n{}\n\n\n".format(
+        test_id.replace("_@_", " : "),
+        "The test process exited before reporting a result, "
+        "e.g. because the code called System.exit.",
+    )
+    return json.dumps({"id": test_id, "passed": False, "log": log})
+
 
-        for p in tmpdir.glob("*.java"):
-            match = re.search(r"package\s+(\w+)\s*;", p.read_text())
-            if match and match.group(1):
-                pkgdir = Path(tmpdir, *match.group(1).split("."))
-                pkgdir.mkdir(exist_ok=True)
-                shutil.move(str(p), str(pkgdir))
-                # (pkgdir / p.name).write_text(code)
+def _error_line(test_id: str, error: str) -> str:
+    log = "********* {} ********* [FAILED]\n{}\n\n\n".format(
+        test_id.replace("_@_", " : "),
+        f"Autograder Error (please contact TA):\n{error}",
+    )
+    return json.dumps({"id": test_id, "passed": False, "log": log})
 
+
+class JavacError(Exception):
+    """javac could not be run, which says nothing about the submission."""
+
+
+def _load_cached(cache: Optional[ResultCache], subdir: Path):
+    """Return the submission hash and cached results of the submission."""
+    if not cache:
+        return None, {}
+    submission_hash = hash_paths(config.dirs.input_files, config.dirs.helpers, subdir)
+    return submission_hash, cache.load(submission_hash)
+
+
+def _record_line(fout, results: Dict[str, str], line: str) -> Optional[dict]:
+    """Write a result line and return it parsed, or None if it is not a result."""
+    fout.write(f"{line}\n")
+    try:
+        result = json.loads(line)
+        results[result["id"]] = line
+    except (ValueError, KeyError, TypeError):
+        return None
+    return result
+
+
+def _record_test(student: str, test_id: str, proc_result, lines: List[str]):
+    # Java tests time out inside the JVM, which reports a TimeoutException.
+    passed = False
+    is_timeout = proc_result.is_timeout
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        passed = bool(result.get("passed"))
+        is_timeout |= str(result.get("error_type")).endswith("TimeoutException")
+    telemetry.record(
+        "test",
+        student=student,
+        test=test_id,
+        duration=proc_result.duration,
+        peak_rss_kb=proc_result.peak_rss_kb,
+        is_timeout=is_timeout,
+        passed=passed,
+    )
+
+
+async def _run_batch(
+    cmd: List[str],
+    test_ids: List[str],
+    fout,
+    results,
+    limits: dict,
+    student: str,
+    **kwargs,
+):
+    # One line is printed per test. If the JVM exits during a test (e.g. the student
+    # code calls System.exit, even with status 0), that test is recorded as failed
+    # and a new JVM continues with the next one. A JVM that cannot stop a test's
+    # thread prints BATCH_RESTART_LINE after the result and exits with
+    # BATCH_RESTART_STATUS, and a new JVM continues with the next test.
+    start = 0
+    num_lines = 0
+    restart = False
+
+    def record(line):
+        nonlocal num_lines, restart
+        if line == BATCH_RESTART_LINE:
+            restart = True
+            return
+        num_lines += 1
+        _record_line(fout, results, line)
+
+    while start < len(test_ids):
+        num_lines = 0
+        restart = False
         proc_result = await run_process(
-            ["javac", "-cp", ".", *(str(p) for p in tmpdir.glob("**/*.java"))],
-            cwd=tmpdir,
+            [*cmd[:-1], f"-DbatchStart={start}", cmd[-1]],
+            max_output=MAX_OUTPUT,
+            on_stdout_line=record,
+            limits=limits,
+            **kwargs,
         )
+        telemetry.record(
+            "batch",
+            student=student,
+            duration=proc_result.duration,
+            peak_rss_kb=proc_result.peak_rss_kb,
+            tests=num_lines,
+        )
+        if proc_result.error:
+            print(" ".join(cmd))
+            print(proc_result.error)
+            return
+        start += num_lines
+        if start >= len(test_ids):
+            return
+        if restart and proc_result.returncode == BATCH_RESTART_STATUS:
+            continue
+        if proc_result.limit_exceeded:
+            line = _limit_line(test_ids[start], proc_result.limit_exceeded, limits)
+        else:
+            line = _exited_line(test_ids[start])
+        _record_line(fout, results, line)
+        if proc_result.returncode != 0:
+            print(" ".join(cmd))
+            print(proc_result.stderr)
+        start += 1
 
-        # _show_files(tmpdir)
 
-        if proc_result.returncode != 0:
-            result = {"compile_error": f"{proc_result.stdout}{proc_result.stderr}"}
-            outputfile.write_text(json.dumps(result))
+async def run(
+    subdir: Path,
+    jarfile: Path,
+    commands: Dict[str, Any],
+    outputfile: Path,
+    jvm_reuse: bool = False,
+    cache: Optional[ResultCache] = None,
+    limits: Optional[Dict[str, dict]] = None,
+    requires: Optional[Dict[str, List[str]]] = None,
+):
+    start = time.monotonic()
+    submission_hash, cached = _load_cached(cache, subdir)
+    results = {tid: line for tid, line in cached.items() if tid in commands}
+    commands = {tid: cmd for tid, cmd in commands.items() if tid not in results}
+    with open(outputfile, "wt") as fout:
+        fout.write("".join(f"{line}\n" for line in results.values()))
+        if commands:
+            await _run_java(
+                subdir,
+                jarfile,
+                commands,
+                fout,
+                results,
+                jvm_reuse,
+                limits or {},
+                requires or {},
+            )
+            _record_student(subdir, start)
+    if cache:
+        cache.save(submission_hash, {**cached, **results})
+
+
+def _record_student(subdir: Path, start: float):
+    telemetry.record("student", student=subdir.name, duration=time.monotonic() - start)
+
+
+async def _compile_java(subdir: Path, tmpdir: Path) -> str:
+    start = time.monotonic()
+    compile_error = await _build_java(subdir, tmpdir)
+    telemetry.record(
+        "compile",
+        student=subdir.name,
+        duration=time.monotonic() - start,
+        error=bool(compile_error),
+    )
+    return compile_error
+
+
+async def _build_java(subdir: Path, tmpdir: Path) -> str:
+    """Copy and compile the submission into tmpdir, returning compiler errors if any.
+
+    Compiled trees and compiler errors are cached by the hash of the sources, so
+    javac runs only once per submission across all invocations. Raises JavacError
+    if javac could not be run; that is not cached.
+    """
+    builddir = config.dirs.cache / "build" / hash_paths(
+        config.dirs.input_files, config.dirs.helpers, subdir
+    )
+    errorfile = builddir / "compile_error.txt"
+    if errorfile.exists():
+        return errorfile.read_text()
+    if (builddir / "tree").exists():
+        _copytree(builddir / "tree", tmpdir, keep_parent=False)
+        return ""
+
+    if config.dirs.input_files.exists():
+        _copytree(config.dirs.input_files, tmpdir, keep_parent=False)
+
+    if config.dirs.helpers.exists():
+        _copytree(config.dirs.helpers, tmpdir, keep_parent=False)
+
+    _copytree(subdir, tmpdir, keep_parent=False)
+
+    for p in tmpdir.glob("*.java"):
+        match = re.search(r"package\s+(\w+)\s*;", p.read_text())
+        if match and match.group(1):
+            pkgdir = Path(tmpdir, *match.group(1).split("."))
+            pkgdir.mkdir(exist_ok=True)
+            shutil.move(str(p), str(pkgdir))
+            # (pkgdir / p.name).write_text(code)
+
+    proc_result = await run_javac(
+        ["-cp", str(tmpdir), *(str(p) for p in tmpdir.glob("**/*.java"))], cwd=tmpdir,
+    )
+
+    # _show_files(tmpdir)
+
+    # javac exits with 1 for errors in the code, and with other codes if it could
+    # not compile at all, e.g. for bad arguments or a crash.
+    if proc_result.error or proc_result.returncode not in (0, 1):
+        raise JavacError(
+            proc_result.error
+            or f"javac exited with {proc_result.returncode}:\n"
+            f"{proc_result.stdout}{proc_result.stderr}"
+        )
+
+    builddir.mkdir(parents=True, exist_ok=True)
+    if proc_result.returncode != 0:
+        compile_error = f"{proc_result.stdout}{proc_result.stderr}" or "javac failed."
+        errorfile.write_text(compile_error)
+        return compile_error
+
+    # Copy first and rename, so that an interrupted run never leaves a partial tree.
+    tmptree = Path(tempfile.mkdtemp(dir=builddir))
+    _copytree(tmpdir, tmptree, keep_parent=False)
+    try:
+        os.rename(str(tmptree), str(builddir / "tree"))
+    except OSError:
+        # Another identical submission got there first.
+        shutil.rmtree(str(tmptree))
+    return ""
+
+
+async def _run_java(
+    subdir: Path,
+    jarfile: Path,
+    commands: Dict[str, Any],
+    fout,
+    results: Dict[str, str],
+    jvm_reuse: bool,
+    limits: Dict[str, dict],
+    requires: Dict[str, List[str]],
+):
+    with tempfile.TemporaryDirectory() as t:
+        tmpdir = Path(t)
+        try:
+            compile_error = await _compile_java(subdir, tmpdir)
+        except JavacError as exc:
+            # Not kept in results, so that it is neither cached nor uploaded as a
+            # compile error.
+            print(f"Could not compile {subdir.name}:\n{exc}")
+            fout.write("".join(f"{_error_line(tid, str(exc))}\n" for tid in commands))
             return
+        if compile_error:
+            result = {"compile_error": compile_error}
+            results["compile_error"] = json.dumps(result)
+            fout.write(results["compile_error"])
+            return
+
+        env = {
+            **os.environ,
+            "CLASSPATH": f".{os.pathsep}{jarfile.resolve()}",
+        }
+        if jvm_reuse:
+            # All tests share one JVM, so only [autograder.limits] apply, and CPU
+            # time would add up over the tests.
+            default_limits = config.get("autograder", {}).get("limits", {})
+            batch_limits = {
+                k: v for k, v in default_limits.items() if k not in ("memory", "cpu")
+            }
+            heap = default_limits.get("memory")
+            # One batch per level, so that tests whose prerequisites failed are
+            # skipped; without prerequisites, all tests are in one batch.
+            level = levels({tid: requires.get(tid, []) for tid in commands})
+            for current in sorted(set(level.values())):
+                test_ids = []
+                for tid in commands:
+                    if level[tid] != current:
+                        continue
+                    failed = _failed_requirements(tid, requires, results, commands)
+                    if failed:
+                        _record_line(fout, results, _skipped_line(tid, failed))
+                    else:
+                        test_ids.append(tid)
+                if not test_ids:
+                    continue
+                with tempfile.NamedTemporaryFile("wt", suffix=".txt") as batchfile:
+                    batchfile.write("".join(f"{commands[t]}\n" for t in test_ids))
+                    batchfile.flush()
+                    cmd = [
+                        "java",
+                        *([f"-Xmx{heap}m"] if heap else []),
+                        "-DisExternal=true",
+                        f"-Dbatch={batchfile.name}",
+                        "_autograder.Executor",
+                    ]
+                    await _run_batch(
+                        cmd,
+                        test_ids,
+                        fout,
+                        results,
+                        batch_limits,
+                        subdir.name,
+                        cwd=tmpdir,
+                        env=env,
+                    )
+            return
+
+        for test_id, cmd in commands.items():
+            lines = await _run_java_test(
+                subdir.name, test_id, cmd, tmpdir, env, limits
+            )
+            for line in lines:
+                _record_line(fout, results, line)
+
+
+async def _run_java_test(
+    student: str,
+    test_id: str,
+    cmd: List[str],
+    tmpdir: Path,
+    env: dict,
+    limits: Dict[str, dict],
+) -> List[str]:
+    """Run one test in its own JVM and return the result lines it printed."""
+    # Memory is limited with -Xmx in the command.
+    test_limits = {k: v for k, v in limits.get(test_id, {}).items() if k != "memory"}
+    lines: List[str] = []
+    proc_result = await run_process(
+        cmd,
+        cwd=tmpdir,
+        env=env,
+        max_output=MAX_OUTPUT,
+        on_stdout_line=lines.append,
+        limits=test_limits,
+    )
+    _record_test(student, test_id, proc_result, lines)
+    if proc_result.limit_exceeded:
+        return [_limit_line(test_id, proc_result.limit_exceeded, test_limits)]
+    if proc_result.error:
+        print(" ".join(cmd))
+        print(proc_result.error)
+        return []
+    if proc_result.returncode != 0:
+        print(" ".join(cmd))
+        print("\n".join(lines))
+        print(proc_result.stderr)
+        return []
+    return lines
+
+
+@dataclass
+class _Student:
+    subdir: Path
+    outputfile: Path
+    submission_hash: Optional[str]
+    cached: Dict[str, str]
+    results: Dict[str, str]
+    pending: List[str]
+    start: float
+    tmpdir: Optional[Path] = None
+    env: dict = field(default_factory=dict)
+    # Resolved once the result of a pending test is recorded.
+    finished: Dict[str, asyncio.Future] = field(default_factory=dict)
+
+
+async def _prepare(
+    subdir: Path,
+    jarfile: Path,
+    commands: Dict[str, Any],
+    outputfile: Path,
+    cache: Optional[ResultCache],
+) -> Optional[_Student]:
+    """Write cached results and compile the submission.
+
+    Returns None if nothing is left to run for this student.
+    """
+    start = time.monotonic()
+    submission_hash, cached = _load_cached(cache, subdir)
+    results = {tid: line for tid, line in cached.items() if tid in commands}
+    outputfile.write_text("".join(f"{line}\n" for line in results.values()))
+    student = _Student(
+        subdir,
+        outputfile,
+        submission_hash,
+        cached,
+        results,
+        pending=[tid for tid in commands if tid not in results],
+        start=start,
+    )
+    if not student.pending:
+        return None
+
+    tmpdir = Path(tempfile.mkdtemp())
+    try:
+        compile_error = await _compile_java(subdir, tmpdir)
+    except JavacError as exc:
+        shutil.rmtree(str(tmpdir))
+        print(f"Could not compile {subdir.name}:\n{exc}")
+        with open(outputfile, "at") as fout:
+            fout.write(
+                "".join(f"{_error_line(tid, str(exc))}\n" for tid in student.pending)
+            )
+        _record_student(subdir, start)
+        return None
+    if compile_error:
+        shutil.rmtree(str(tmpdir))
+        results["compile_error"] = json.dumps({"compile_error": compile_error})
+        outputfile.write_text(results["compile_error"])
+        _record_student(subdir, start)
+        return None
+
+    student.tmpdir = tmpdir
+    loop = asyncio.get_running_loop()
+    student.finished = {tid: loop.create_future() for tid in student.pending}
+    student.env = {
+        **os.environ,
+        "CLASSPATH": f".{os.pathsep}{jarfile.resolve()}",
+    }
+    return student
+
+
+def _save_results(student: _Student, cache: Optional[ResultCache]):
+    if cache:
+        cache.save(student.submission_hash, {**student.cached, **student.results})
+
 
-        with open(outputfile, "wt") as fout:
-            for cmd in commands:
-                proc_result = await run_process(
-                    cmd,
-                    cwd=tmpdir,
-                    env={
-                        **os.environ,
-                        "CLASSPATH": f".{os.pathsep}{jarfile.resolve()}",
-                    },
+async def run_scheduled(
+    subdirs: List[Path],
+    jarfile: Path,
+    commands: Dict[str, Any],
+    outdir: Path,
+    num_procs: int,
+    cache: Optional[ResultCache],
+    limits: Dict[str, dict],
+    timeouts: Dict[str, int],
+    requires: Optional[Dict[str, List[str]]] = None,
+    on_done: Optional[Callable[[Path], None]] = None,
+):
+    """Run one JVM per test, scheduling (student, test) pairs rather than students.
+
+    All submissions are compiled first. Then tests of all students share one queue,
+    longest timeout first, so that slow tests start early and a few slow students
+    do not leave the other processes idle at the end of the run. Tests come after
+    their prerequisites in the queue, and are skipped if one of them failed.
+    """
+    requires = requires or {}
+    level = levels({tid: requires.get(tid, []) for tid in commands})
+    students: List[_Student] = []
+    coros = [
+        _prepare(subdir, jarfile, commands, outdir / f"{subdir.name}.json", cache)
+        for subdir in subdirs
+    ]
+    with click.progressbar(length=len(coros), width=50, label="Compiling") as bar:
+        async for i, student in concurrent(coros, num_procs):
+            if student:
+                students.append(student)
+            elif on_done:
+                on_done(subdirs[i])
+            bar.update(1)
+
+    jobs = [(student, tid) for student in students for tid in student.pending]
+    # sorted() is stable, so ties keep the student and bundle order.
+    jobs = sorted(jobs, key=lambda job: (level[job[1]], -timeouts.get(job[1], 0)))
+
+    async def run_job(student: _Student, test_id: str):
+        try:
+            for tid in requires.get(test_id, []):
+                if tid in student.finished:
+                    await student.finished[tid]
+            failed = _failed_requirements(test_id, requires, student.results, commands)
+            if failed:
+                lines = [_skipped_line(test_id, failed)]
+            else:
+                lines = await _run_java_test(
+                    student.subdir.name,
+                    test_id,
+                    commands[test_id],
+                    student.tmpdir,
+                    student.env,
+                    limits,
                 )
-                if proc_result.error:
-                    print(" ".join(cmd))
-                    print(proc_result.error)
-                elif proc_result.returncode != 0:
-                    print(" ".join(cmd))
-                    print(proc_result.stdout)
-                    print(proc_result.stderr)
-                else:
-                    fout.write(proc_result.stdout)
+            with open(student.outputfile, "at") as fout:
+                for line in lines:
+                    _record_line(fout, student.results, line)
+        finally:
+            student.finished[test_id].set_result(None)
+        student.pending.remove(test_id)
+        if not student.pending:
+            shutil.rmtree(str(student.tmpdir))
+            _save_results(student, cache)
+            _record_student(student.subdir, student.start)
+            if on_done:
+                on_done(student.subdir)
+
+    try:
+        coros = [run_job(student, tid) for student, tid in jobs]
+        with click.progressbar(length=len(coros), width=50, label="Running") as bar:
+            async for _ in concurrent(coros, num_procs):
+                bar.update(1)
+    finally:
+        for student in students:
+            if student.tmpdir.exists():
+                shutil.rmtree(str(student.tmpdir))
+
+
+async def run_python(
+    subdir: Path,
+    pyzfile: Path,
+    modules: Dict[str, str],
+    outputfile: Path,
+    cache: Optional[ResultCache] = None,
+    timeouts: Optional[Dict[str, float]] = None,
+):
+    start = time.monotonic()
+    submission_hash, cached = _load_cached(cache, subdir)
+    results = {tid: line for tid, line in cached.items() if tid in modules}
+    test_ids = [tid for tid in modules if tid not in results]
+    with open(outputfile, "wt") as fout:
+        fout.write("".join(f"{line}\n" for line in results.values()))
+        if test_ids:
+            await _run_python(subdir, pyzfile, test_ids, fout, results, timeouts)
+            _record_student(subdir, start)
+    if cache:
+        cache.save(submission_hash, {**cached, **results})
 
+
+async def _run_python(
+    subdir: Path,
+    pyzfile: Path,
+    test_ids: List[str],
+    fout,
+    results: Dict[str, str],
+    timeouts: Optional[Dict[str, float]] = None,
+):
+    with tempfile.TemporaryDirectory() as t, tempfile.TemporaryDirectory() as c:
+        tmpdir = Path(t)
+        if config.dirs.input_files.exists():
+            _copytree(config.dirs.input_files, tmpdir, keep_parent=False)
+
+        _copytree(subdir, tmpdir, keep_parent=False)
+
+        # Control files are kept out of the directory the student code runs in.
+        testsfile = Path(c) / "tests.txt"
+        testsfile.write_text("".join(f"{tid}\n" for tid in test_ids))
+        resultfile = Path(c) / "results.json"
+        env = {
+            **os.environ,
+            "PYTHONPATH": str(pyzfile.resolve()),
+            "AGNI_OUTPUTPATH": str(resultfile),
+            "AGNI_TESTS": str(testsfile),
+        }
+        if timeouts:
+            timeoutsfile = Path(c) / "timeouts.json"
+            timeoutsfile.write_text(json.dumps(timeouts))
+            env["AGNI_TIMEOUTS"] = str(timeoutsfile)
+        cmd = [config.get("run_command", "python3"), "-m", "_autograder"]
+        proc_result = await run_process(
+            cmd, cwd=tmpdir, env=env, max_output=MAX_OUTPUT
+        )
+        if proc_result.error:
+            print(" ".join(cmd))
+            print(proc_result.error)
+        elif proc_result.returncode != 0:
+            print(" ".join(cmd))
+            print(proc_result.stdout)
+            print(proc_result.stderr)
+        if resultfile.exists():
+            with open(resultfile) as fresults:
+                for line in fresults:
+                    result = _record_line(fout, results, line.rstrip("\n"))
+                    if result:
+                        telemetry.record(
+                            "test",
+                            student=subdir.name,
+                            test=result["id"],
+                            duration=result.get("duration"),
+                            peak_rss_kb=result.get("peak_rss_kb"),
+                            is_timeout=result.get("is_timeout"),
+                            passed=result.get("passed"),
+                        )
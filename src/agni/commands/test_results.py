@@ -1,9 +1,13 @@
 from pathlib import Path
 import click
-from .. import config
+from .. import config, codepost_client
 import sys
 import json
-import pandas as pd
+import csv
+import functools
+import hashlib
+import time
+import traceback
 from typing import List
 
 
@@ -42,10 +46,31 @@ def file_to_path(ctx, param, value):
 @click.option("--students", default=None, callback=file_must_exist)
 @click.option("--download", default=None, callback=file_to_path)
 @click.option("--update", default=None, callback=dir_must_exist)
+@click.option("--num-threads", type=int, default=8)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    default=False,
+    help="With --update, only send results that differ from those on Codepost.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="With --update, build the requests and report their rate without sending.",
+)
 @click.argument(
     "bundle-dir", nargs=1, callback=dir_must_exist,
 )
-def main(students: Path, download: Path, update: Path, bundle_dir: Path):
+def main(
+    students: Path,
+    download: Path,
+    update: Path,
+    num_threads: int,
+    upsert: bool,
+    dry_run: bool,
+    bundle_dir: Path,
+):
     """Manage test results on Codepost."""
     if students:
         student_list = sorted(
@@ -71,28 +96,13 @@ def main(students: Path, download: Path, update: Path, bundle_dir: Path):
     if download:
         save_results(student_list, download)
     elif update:
-        update_results(student_list, update, bundle_dir)
+        update_results(student_list, update, bundle_dir, num_threads, upsert, dry_run)
     else:
         print("Invalid options")  # TODO
 
 
 def get_assignment():
-    import codepost
-
-    d = config.get("codepost")
-    assert d and isinstance(d, dict)
-    assignment_name = d.get("assignment_name")
-    course_name = d.get("course_name")
-    course_period = d.get("course_period")
-    api_key_path = d.get("api_key_path")
-    assert assignment_name and course_name and course_period and api_key_path
-
-    codepost.configure_api_key(Path(api_key_path).expanduser().read_text().strip())
-
-    mycourse = codepost.course.list_available(name=course_name, period=course_period)[0]
-    print(f"Course: {mycourse.name}, {mycourse.period}")
-    assignment = {x.name: x for x in mycourse.assignments}[assignment_name]
-    print(f"Assignment: {assignment.name}")
+    assignment = codepost_client.get_assignment()
 
     answer = input("Continue? [yes/no]: ")
     if answer != "yes":
@@ -111,18 +121,19 @@ def save_results(students: List[str], csvfile: Path):
     else:
         all_submissions = assignment.list_submissions()
 
-    def genr():
+    fields = ("submission", "testCase", "logs", "passed", "isError")
+    with open(csvfile, "wt", newline="") as fout:
+        writer = csv.DictWriter(fout, fieldnames=["student", *fields])
+        writer.writeheader()
         for submission in all_submissions:
             student_name = submission.students[0]
             print(f"Processing submission {submission.id} for {student_name}")
             for obj in submission.tests:
                 d = {"student": student_name}
-                for field in ("submission", "testCase", "logs", "passed", "isError"):
+                for field in fields:
                     d[field] = getattr(obj, field)
-                yield d
-
-    df = pd.DataFrame(genr())
-    df.to_csv(csvfile, index=False)
+                writer.writerow(d)
+            fout.flush()
 
 
 control_translator = str.maketrans(
@@ -134,16 +145,17 @@ control_translator = str.maketrans(
 )
 
 
-def update_results(students: List[str], outdir: Path, bundle_dir: Path):
-    import codepost
-
+def update_results(
+    students: List[str],
+    outdir: Path,
+    bundle_dir: Path,
+    num_threads: int = 8,
+    upsert: bool = False,
+    dry_run: bool = False,
+):
     assignment = get_assignment()
 
-    tests_on_codepost = {
-        f"{cat.name}_@_{test.description}": test
-        for cat in assignment.testCategories
-        for test in cat.testCases
-    }
+    tests_on_codepost = codepost_client.get_tests(assignment)
 
     print(tests_on_codepost.keys())
     metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
@@ -165,38 +177,214 @@ def update_results(students: List[str], outdir: Path, bundle_dir: Path):
         print("Not continuing further, bye.")
         sys.exit(1)
 
+    jobs = []
     for resultfile in outdir.glob("*.json"):
         if resultfile.name.strip().split("__")[0] not in students:
             continue
 
-        lines = resultfile.read_text().splitlines()
-        compile_error = None
-
-        print(resultfile.name)
-
-        if len(lines) == 1 and "compile_error" in json.loads(lines[0]):
-            compile_error = json.loads(lines[0])["compile_error"]
-            for testobj in test_to_update.values():
-                args = {
-                    "submission": int(resultfile.stem.split("__")[-1]),
-                    "testCase": testobj.id,
-                    "passed": False,
-                    "logs": compile_error,
-                }
-                # print(json.dumps(args))
-                subtestobj = codepost.submission_test.create(**args)
-                print(subtestobj)
+        results = [json.loads(line) for line in resultfile.read_text().splitlines()]
+        submission_id = int(resultfile.stem.split("__")[-1])
+
+        if len(results) == 1 and "compile_error" in results[0]:
+            compile_error = results[0]["compile_error"]
+            for test in test_to_update.values():
+                jobs.append(
+                    {
+                        "submission": submission_id,
+                        "testCase": test["id"],
+                        "passed": False,
+                        "logs": compile_error,
+                    }
+                )
         else:
-            for line in lines:
-                data = json.loads(line)
-                testobj = test_to_update[data["id"]]
+            for data in results:
+                test = test_to_update[data["id"]]
                 logs = data["log"][:5000].translate(control_translator)
-                args = {
-                    "submission": int(resultfile.stem.split("__")[-1]),
-                    "testCase": testobj.id,
-                    "passed": data["passed"],
-                    "logs": logs,
-                }
-                # print(json.dumps(args))
-                subtestobj = codepost.submission_test.create(**args)
-                print("[OK]" if subtestobj else "[FAILED]")
+                jobs.append(
+                    {
+                        "submission": submission_id,
+                        "testCase": test["id"],
+                        "passed": data["passed"],
+                        "logs": logs,
+                    }
+                )
+
+    # The manifest lives next to outputs/ and records what was uploaded, so that a
+    # re-run resumes the upload and --upsert compares against it. Results on
+    # Codepost are only fetched for submissions it has no record of.
+    manifest = outdir.parent / f"{outdir.name}_uploaded.json"
+    if upsert:
+        uploaded = _load_manifest(manifest)
+        known = {key[0] for key, record in uploaded.items() if record[0] is not None}
+        unsure = {key[0] for key, record in uploaded.items() if record[0] is None}
+        to_fetch = {job["submission"] for job in jobs} - (known - unsure)
+        if to_fetch:
+            fetched = _existing_results(assignment, to_fetch, num_threads)
+            _record(manifest, fetched)
+            uploaded = {k: v for k, v in uploaded.items() if k[0] not in to_fetch}
+            uploaded.update(fetched)
+        jobs = _changed_jobs(jobs, uploaded)
+    _upload(jobs, manifest, num_threads, dry_run, resume=not upsert)
+
+
+def _log_hash(logs) -> str:
+    return hashlib.sha256((logs or "").encode()).hexdigest()
+
+
+def _load_manifest(manifest: Path) -> dict:
+    """(submission, testCase) -> (id, passed, log hash) of the uploaded results.
+
+    The id is None for a create that failed, which may still have been made.
+    """
+    uploaded = {}
+    if manifest.exists():
+        for line in manifest.read_text().splitlines():
+            record = json.loads(line)
+            uploaded[(record["submission"], record["testCase"])] = (
+                record["id"],
+                record["passed"],
+                record["log_hash"],
+            )
+    return uploaded
+
+
+def _record(manifest: Path, results: dict):
+    with open(manifest, "at") as fout:
+        for key, value in results.items():
+            _write_record(fout, key, *value)
+
+
+def _write_record(fout, key: tuple, result_id, passed, log_hash):
+    submission, test_case = key
+    record = {
+        "submission": submission,
+        "testCase": test_case,
+        "id": result_id,
+        "passed": passed,
+        "log_hash": log_hash,
+    }
+    fout.write(f"{json.dumps(record)}\n")
+    fout.flush()
+
+
+def _existing_results(assignment, submission_ids: set, num_threads: int) -> dict:
+    """(submission, testCase) -> (id, passed, log hash) of results on Codepost.
+
+    Submissions list only the ids of their tests, so the tests of all submissions
+    are fetched together through the concurrent pool used for uploads.
+    """
+    import codepost
+
+    submissions = [
+        sub for sub in assignment.list_submissions() if sub.id in submission_ids
+    ]
+    test_ids = [obj.id for sub in submissions for obj in sub.tests]
+    calls = [
+        functools.partial(codepost.submission_test.retrieve, id=test_id)
+        for test_id in test_ids
+    ]
+    existing = {}
+    num_failed = 0
+    for _, obj, exc in codepost_client.run_concurrently(calls, num_threads):
+        if exc or obj is None:
+            num_failed += 1
+            continue
+        existing[(obj.submission, obj.testCase)] = (
+            obj.id,
+            obj.passed,
+            _log_hash(obj.logs),
+        )
+    if num_failed:
+        # Without them, results on Codepost would be created again.
+        raise click.ClickException(
+            f"Could not fetch {num_failed} results from Codepost, please run again."
+        )
+    print(f"Results on Codepost of {len(submissions)} submissions: {len(existing)}")
+    return existing
+
+
+def _changed_jobs(jobs: List[dict], existing: dict) -> List[dict]:
+    """Drop jobs whose result is already on Codepost; mark the others as updates."""
+    changed = []
+    for job in jobs:
+        current = existing.get((job["submission"], job["testCase"]))
+        if current is None or current[0] is None:
+            changed.append(job)
+        elif current[1:] != (job["passed"], _log_hash(job["logs"])):
+            changed.append({**job, "id": current[0]})
+    print(f"Unchanged results: {len(jobs) - len(changed)}")
+    return changed
+
+
+def _upload(
+    jobs: List[dict],
+    manifest: Path,
+    num_threads: int,
+    dry_run: bool,
+    resume: bool = True,
+):
+    import codepost
+
+    def key(job):
+        return (job["submission"], job["testCase"])
+
+    done = set()
+    if resume:
+        uploaded = _load_manifest(manifest)
+        done = {k for k, record in uploaded.items() if record[0] is not None}
+    pending = [job for job in jobs if key(job) not in done]
+    print(f"Results already uploaded: {len(jobs) - len(pending)}")
+    print(f"Results to upload: {len(pending)}")
+
+    def send(job):
+        if dry_run:
+            # Only build the request body, to time everything but the requests.
+            return bool(json.dumps(job))
+        if "id" in job:
+            return codepost.submission_test.update(**job)
+        return codepost.submission_test.create(**job)
+
+    failed = []
+    start = time.monotonic()
+    calls = [functools.partial(send, job) for job in pending]
+    # Updates can be repeated, but a create that failed may have been made.
+    idempotent = ["id" in job for job in pending]
+    with open(manifest, "at") as fmanifest:
+        with click.progressbar(length=len(pending), width=50) as bar:
+            calls_made = codepost_client.run_concurrently(
+                calls, num_threads, idempotent=idempotent
+            )
+            for i, obj, exc in calls_made:
+                job = pending[i]
+                if exc:
+                    traceback.print_exception(type(exc), exc, exc.__traceback__)
+                if not obj:
+                    failed.append(job)
+                    if not dry_run and "id" not in job:
+                        _write_record(fmanifest, key(job), None, None, None)
+                elif not dry_run:
+                    result_id = job.get("id", getattr(obj, "id", None))
+                    log_hash = _log_hash(job["logs"])
+                    _write_record(
+                        fmanifest, key(job), result_id, job["passed"], log_hash
+                    )
+                bar.update(1)
+    elapsed = time.monotonic() - start
+
+    num_done = len(pending) - len(failed)
+    rate = num_done / elapsed if elapsed else 0.0
+    if dry_run:
+        print(
+            f"Built {num_done} requests in {elapsed:.1f}s ({rate:.1f} per second, "
+            f"{num_threads} threads); nothing was sent."
+        )
+    else:
+        print(
+            f"Uploaded {num_done} results in {elapsed:.1f}s "
+            f"({rate:.1f} per second, {num_threads} threads)."
+        )
+    if failed:
+        print("[FAILED] submission:testCase")
+        for job in failed:
+            print(f"{job['submission']}:{job['testCase']}")
+        print("Run the same command again to retry the failed uploads.")
@@ -1,8 +1,10 @@
 from pathlib import Path
 import click
-from .. import config
+from .. import config, codepost_client
+import functools
 import sys
 import json
+import time
 
 
 def dir_must_exist(ctx, param, value):
@@ -19,56 +21,48 @@ def dir_must_exist(ctx, param, value):
     expose_value=False,
     callback=lambda ctx, param, value: config.load(value),
 )
+@click.option("--num-threads", type=int, default=8)
+@click.option(
+    "--max-rate", type=float, default=10.0, help="Maximum requests per second."
+)
 @click.argument(
     "bundle-dir", nargs=1, callback=dir_must_exist,
 )
-def main(bundle_dir: Path):
+def main(num_threads: int, max_rate: float, bundle_dir: Path):
     """Update points of test cases on Codepost."""
     import codepost
 
-    d = config.get("codepost")
-    assert d and isinstance(d, dict)
-    assignment_name = d.get("assignment_name")
-    course_name = d.get("course_name")
-    course_period = d.get("course_period")
-    api_key_path = d.get("api_key_path")
-    assert assignment_name and course_name and course_period and api_key_path
+    assignment = codepost_client.get_assignment()
 
-    codepost.configure_api_key(Path(api_key_path).expanduser().read_text().strip())
+    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
+    plan = codepost_client.plan_tests(
+        metadata,
+        codepost_client.get_tests(assignment),
+        codepost_client.get_categories(assignment),
+    )
 
-    mycourse = codepost.course.list_available(name=course_name, period=course_period)[0]
-    print(f"Course: {mycourse.name}, {mycourse.period}")
-    assignment = {x.name: x for x in mycourse.assignments}[assignment_name]
-    print(f"Assignment: {assignment.name}")
+    if plan["create"]:
+        print("The following test cases were found locally but not on codepost:")
+        print("\n".join(test["testcaseID"] for test in plan["create"]))
+        sys.exit(1)
 
+    codepost_client.print_plan(plan)
     answer = input("Continue? [yes/no]: ")
     if answer != "yes":
         print("Not continuing further, bye.")
         sys.exit(1)
 
-    tests_on_codepost = {
-        f"{cat.name}_@_{test.description}": test
-        for cat in assignment.testCategories
-        for test in cat.testCases
-    }
-
-    metadata = json.loads((bundle_dir / f"{bundle_dir.name}_metadata.json").read_text())
-    tests_in_metadata = set(info.get("testcaseID") for mod, info in metadata.items())
-    diff = tests_in_metadata.difference(set(tests_on_codepost.keys()))
-
-    if diff:
-        print("The following test cases were found locally but not on codepost:")
-        print("\n".join(f"{cat} : {test}" for cat, test in diff))
-        sys.exit(1)
-
-    for mod, info in metadata.items():
-        key = info.get("testcaseID")
-        testobj = tests_on_codepost[key]
+    start = time.monotonic()
+    calls = []
+    for test in plan["update"]:
+        update = {k: v for k, v in test.items() if k != "testcaseID"}
+        calls.append(functools.partial(codepost.test_case.update, **update))
+    updated = codepost_client.send_all(
+        calls, [test["testcaseID"] for test in plan["update"]], num_threads, max_rate
+    )
 
-        points = info.get("points")
-        if points < 0:
-            testobj.pointsFail = points
-        else:
-            testobj.pointsPass = points
-        response = testobj.save()
-        print("[OK]" if response else "[FAILED]", response)
+    codepost_client.invalidate()
+    num_updated = sum(1 for obj in updated if obj)
+    print(f"Updated {num_updated} test cases in {time.monotonic() - start:.1f}s.")
+    if num_updated < len(updated):
+        print(f"Failed to update {len(updated) - num_updated} test cases, run again.")
@@ -14,6 +14,7 @@ class _Dirs:
         self.input_files = self.project_root / "input_files"
         self.submissions = self.project_root / "submissions"
         self.autograder = self.project_root / "autograder"
+        self.cache = self.autograder / "cache"
         self.logs = self.project_root / "logs"
 
 
@@ -25,6 +26,11 @@ def get(key, default=None):
     return _config.get(key, default)
 
 
+def dumps() -> str:
+    """The loaded configuration as TOML."""
+    return toml.dumps(_config)
+
+
 def load(toml_file):
     if toml_file is None:
         toml_file = "./config.toml"
@@ -0,0 +1,261 @@
+"""Running run-external on several machines.
+
+A coordinator (run-external --workers) connects to grade-worker processes. Each
+worker gets the configuration, bundle, input files and helpers once, and then
+shards of submissions. Results are sent back one submission at a time, and the
+shards of a worker that fails, or that sends nothing for worker_timeout seconds,
+are given to the others. Workers send their telemetry events back, so that they
+end up in the telemetry of the run.
+
+Messages are JSON objects, one per line:
+    -> {"type": "setup", "config": "...", "bundle": "a1", "files": "<zip>",
+        "commands": {...}, "num_procs": 4, "jvm_reuse": false, "timeouts": {...},
+        "heartbeat": 15}
+    <- {"type": "ready"}
+    -> {"type": "shard", "files": "<zip of submission directories>"}
+    <- {"type": "result", "submission": "alice__1__2", "output": "..."}  (repeated)
+    <- {"type": "telemetry", "event": {...}}  (repeated)
+    <- {"type": "heartbeat"}  (every "heartbeat" seconds while grading)
+    <- {"type": "done"}
+Zip archives are sent base64 encoded.
+"""
+import asyncio
+import base64
+import io
+import itertools
+import json
+import tempfile
+import traceback
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import click
+from . import config, telemetry
+
+
+# Setup messages carry the whole bundle on a single line.
+LINE_LIMIT = 2 ** 30
+
+
+def _pack(paths: Dict[str, Path]) -> str:
+    """Zip files and directory trees under the given archive names."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, root in paths.items():
+            if root.is_file():
+                zf.write(str(root), name)
+            elif root.is_dir():
+                for p in sorted(root.glob("**/*")):
+                    if p.is_file():
+                        zf.write(str(p), f"{name}/{p.relative_to(root)}")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def _unpack(data: str, dest: Path):
+    with zipfile.ZipFile(io.BytesIO(base64.b64decode(data))) as zf:
+        zf.extractall(str(dest))
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict):
+    writer.write(f"{json.dumps(message)}\n".encode())
+    await writer.drain()
+
+
+async def _receive(
+    reader: asyncio.StreamReader, timeout: Optional[float] = None
+) -> dict:
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        raise EOFError("Connection closed.")
+    return json.loads(line)
+
+
+async def coordinate(
+    workers: List[str],
+    subdirs: List[Path],
+    bundle_dir: Path,
+    commands: Dict[str, Any],
+    outdir: Path,
+    num_procs: int,
+    jvm_reuse: bool,
+    shard_size: int,
+    timeouts: Optional[Dict[str, float]] = None,
+    worker_timeout: float = 60,
+):
+    """Grade the submissions on the given workers ("host:port").
+
+    A worker that sends nothing for worker_timeout seconds is given up on.
+    """
+    setup = {
+        "type": "setup",
+        "config": config.dumps(),
+        "bundle": bundle_dir.name,
+        "files": _pack(
+            {
+                f"bundle/{bundle_dir.name}": bundle_dir,
+                "input_files": config.dirs.input_files,
+                "src/helpers": config.dirs.helpers,
+            }
+        ),
+        "commands": commands,
+        "num_procs": num_procs,
+        "jvm_reuse": jvm_reuse,
+        "timeouts": timeouts or {},
+        "heartbeat": worker_timeout / 4,
+    }
+
+    shards: asyncio.Queue = asyncio.Queue()
+    for i in range(0, len(subdirs), shard_size):
+        shards.put_nowait(subdirs[i : i + shard_size])
+    remaining = {subdir.name for subdir in subdirs}
+    live = set()
+
+    def finish_if_done():
+        # Wake up idle workers when nothing more can be handed out.
+        if not remaining or not live:
+            for _ in workers:
+                shards.put_nowait(None)
+
+    async def drive(address: str, bar):
+        host, _, port = address.rpartition(":")
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, int(port), limit=LINE_LIMIT
+            )
+            await _send(writer, setup)
+            if (await _receive(reader, worker_timeout))["type"] != "ready":
+                raise ValueError(f"Worker {address} did not get ready.")
+        except Exception:
+            print(f"Could not set up worker {address}:")
+            traceback.print_exc()
+            if writer:
+                writer.close()
+            return
+        live.add(address)
+
+        while True:
+            shard = await shards.get()
+            if shard is None:
+                break
+            try:
+                files = _pack({subdir.name: subdir for subdir in shard})
+                await _send(writer, {"type": "shard", "files": files})
+                while True:
+                    message = await _receive(reader, worker_timeout)
+                    if message["type"] == "done":
+                        break
+                    if message["type"] == "heartbeat":
+                        continue
+                    if message["type"] == "telemetry":
+                        telemetry.write({**message["event"], "worker": address})
+                        continue
+                    name = message["submission"]
+                    (outdir / f"{name}.json").write_text(message["output"])
+                    if name in remaining:
+                        remaining.discard(name)
+                        bar.update(1)
+            except Exception as exc:
+                left = [subdir for subdir in shard if subdir.name in remaining]
+                if isinstance(exc, asyncio.TimeoutError):
+                    print(
+                        f"Worker {address} sent nothing for {worker_timeout}s, "
+                        f"reassigning {len(left)} submissions."
+                    )
+                else:
+                    print(
+                        f"Worker {address} failed, reassigning {len(left)} submissions:"
+                    )
+                    traceback.print_exc()
+                writer.close()
+                live.discard(address)
+                if left:
+                    shards.put_nowait(left)
+                finish_if_done()
+                return
+            finish_if_done()
+        writer.close()
+
+    with click.progressbar(length=len(subdirs), width=50) as bar:
+        await asyncio.gather(*(drive(address, bar) for address in workers))
+        finish_if_done()
+
+    if remaining:
+        print(f"No worker left to grade {len(remaining)} submissions:")
+        for name in sorted(remaining):
+            print(name)
+
+
+async def _heartbeat(writer: asyncio.StreamWriter, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await _send(writer, {"type": "heartbeat"})
+
+
+def _forward(writer: asyncio.StreamWriter, event: dict):
+    writer.write(f"{json.dumps({'type': 'telemetry', 'event': event})}\n".encode())
+
+
+async def _session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Imported here since run_external uses coordinate() from this module.
+    from .commands import run_external
+
+    with tempfile.TemporaryDirectory() as t:
+        root = Path(t)
+        setup = await _receive(reader)
+        (root / "config.toml").write_text(setup["config"])
+        _unpack(setup["files"], root)
+        config.load(root / "config.toml")
+        bundle_dir = config.dirs.bundle / setup["bundle"]
+        await _send(writer, {"type": "ready"})
+
+        for num in itertools.count():
+            try:
+                message = await _receive(reader)
+            except EOFError:
+                return
+            shard_dir = root / "shards" / str(num)
+            _unpack(message["files"], shard_dir)
+            outdir = root / "outputs" / str(num)
+            outdir.mkdir(parents=True)
+
+            def on_done(subdir: Path):
+                output = (outdir / f"{subdir.name}.json").read_text()
+                result = {"type": "result", "submission": subdir.name, "output": output}
+                writer.write(f"{json.dumps(result)}\n".encode())
+
+            beat = asyncio.ensure_future(_heartbeat(writer, setup["heartbeat"]))
+            try:
+                with telemetry.forwarding(lambda event: _forward(writer, event)):
+                    await run_external.grade(
+                        sorted(p for p in shard_dir.iterdir() if p.is_dir()),
+                        bundle_dir,
+                        setup["commands"],
+                        outdir,
+                        setup["num_procs"],
+                        setup["jvm_reuse"],
+                        on_done=on_done,
+                        timeouts=setup.get("timeouts"),
+                    )
+            finally:
+                beat.cancel()
+            await _send(writer, {"type": "done"})
+
+
+async def serve(host: str, port: int):
+    # config is global, so sessions run one at a time.
+    lock = asyncio.Lock()
+
+    async def handle(reader, writer):
+        async with lock:
+            try:
+                await _session(reader, writer)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                writer.close()
+
+    server = await asyncio.start_server(handle, host, port, limit=LINE_LIMIT)
+    print(f"Waiting for run-external --workers on {host}:{port}")
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,91 @@
+import asyncio
+import importlib.resources as resources
+import subprocess
+import traceback
+from contextlib import contextmanager
+from typing import List, Optional
+from .proc_util import ProcessResult, run_process
+
+
+class JavacServer:
+    """javac running in a long-lived JVM, see resources/java/CompileServer.java."""
+
+    def __init__(self):
+        self.proc: Optional[subprocess.Popen] = None
+        self.port: Optional[int] = None
+
+    def start(self):
+        # Needs JDK 11+ to run a single source file without compiling it first.
+        with resources.path("agni.resources.java", "CompileServer.java") as srcfile:
+            self.proc = subprocess.Popen(
+                ["java", str(srcfile)], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            line = self.proc.stdout.readline()
+        try:
+            self.port = int(line)
+        except ValueError:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    async def compile(self, args: List[str]) -> ProcessResult:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            writer.write("".join(f"{arg}\n" for arg in [*args, ""]).encode())
+            await writer.drain()
+            output = (await reader.read()).decode()
+            writer.close()
+        except Exception:
+            return ProcessResult(error=traceback.format_exc())
+        returncode, _, stdout = output.partition("\n")
+        if not returncode.isdigit():
+            # The compiler threw, or the server died before answering.
+            return ProcessResult(error=f"javac server failed:\n{stdout}")
+        return ProcessResult(returncode=int(returncode), stdout=stdout)
+
+
+_server: Optional[JavacServer] = None
+
+
+@contextmanager
+def javac_server():
+    """Send run_javac calls made inside this block to a warm javac.
+
+    Falls back to starting javac for every call if the server cannot be started,
+    e.g. on a JRE without a compiler, and for calls the server fails to answer.
+    """
+    global _server
+    server = JavacServer()
+    try:
+        server.start()
+    except (OSError, ValueError):
+        print("Could not start javac server, using javac directly.")
+        yield
+        return
+
+    _server = server
+    try:
+        yield
+    finally:
+        _server = None
+        server.stop()
+
+
+async def run_javac(args: List[str], cwd=None) -> ProcessResult:
+    """Run javac with args; the server ignores cwd, so args must not depend on it."""
+    if _server:
+        proc_result = await _server.compile(args)
+        if not proc_result.error:
+            return proc_result
+        # The server died or failed, which says nothing about the code; javac may
+        # still work.
+    try:
+        return await run_process(["javac", *args], cwd=cwd)
+    except OSError:
+        # E.g. there is no javac on the PATH.
+        return ProcessResult(error=traceback.format_exc())
@@ -0,0 +1,66 @@
+"""Tests that run only if other tests pass.
+
+A test's config block can set `smoke = true`, so that all tests that are not smoke
+tests are skipped if it fails, or `requires = ["<test>", ...]` to be skipped if one
+of the given tests fails. A test is named by its module or class name, or by its
+end, e.g. "misc.loop_test" or "IsPrime_TestSmall". Bundling replaces the names
+with test ids, so "requires" in the metadata lists all prerequisites of a test.
+"""
+from typing import Dict, List
+
+
+def resolve(metadata: dict):
+    """Replace names in "requires" with test ids and add the smoke tests.
+
+    Raises ValueError for unknown or ambiguous names and for cycles.
+    """
+    smoke = [info["testcaseID"] for info in metadata.values() if info.get("smoke")]
+    for info in metadata.values():
+        requires = []
+        for name in info.get("requires", []):
+            matches = [
+                key for key in metadata if key == name or key.endswith(f".{name}")
+            ]
+            if len(matches) != 1:
+                raise ValueError(
+                    f'{info["testcaseID"]} requires "{name}", '
+                    f"which matches {len(matches)} tests."
+                )
+            requires.append(metadata[matches[0]]["testcaseID"])
+        if not info.get("smoke"):
+            requires += [tid for tid in smoke if tid not in requires]
+        if requires:
+            info["requires"] = requires
+    levels({info["testcaseID"]: info.get("requires", []) for info in metadata.values()})
+
+
+def levels(requires: Dict[str, List[str]]) -> Dict[str, int]:
+    """Level of each test: 0 without prerequisites, else 1 + that of the highest.
+
+    Running tests by level runs every test after its prerequisites.
+    """
+    result: Dict[str, int] = {}
+    visiting = set()
+
+    def level(test_id: str) -> int:
+        if test_id not in result:
+            if test_id in visiting:
+                raise ValueError(f"{test_id} requires itself through other tests.")
+            visiting.add(test_id)
+            result[test_id] = 1 + max(
+                (level(tid) for tid in requires.get(test_id, [])), default=-1
+            )
+            visiting.discard(test_id)
+        return result[test_id]
+
+    for test_id in requires:
+        level(test_id)
+    return result
+
+
+def skip_message(failed: List[str]) -> str:
+    names = ", ".join(tid.replace("_@_", " : ") for tid in failed)
+    return (
+        f"Not run because it depends on {names}, which did not pass. "
+        "Please fix that first."
+    )
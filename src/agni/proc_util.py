@@ -1,7 +1,10 @@
 import sys
+import errno
+import signal
+import time
 import traceback
 import asyncio
-from typing import List, Optional, Iterable
+from typing import Callable, List, Optional, Iterable
 from dataclasses import dataclass, asdict
 
 
@@ -17,23 +20,183 @@ class ProcessResult:
     returncode: int = 0
     stdout: str = ""
     stderr: str = ""
+    limit_exceeded: str = ""
+    # Wall-clock seconds and peak resident set size (0 if it could not be read).
+    duration: float = 0.0
+    peak_rss_kb: int = 0
 
     def to_dict(self):
         return asdict(self)
 
 
+# Limits that can be set in [autograder.limits] or a test's [limits]:
+# name -> (rlimit, multiplier from the configured unit).
+LIMITS = {
+    "memory": ("RLIMIT_AS", 2 ** 20),  # MB
+    "cpu": ("RLIMIT_CPU", 1),  # seconds
+    "file-size": ("RLIMIT_FSIZE", 2 ** 20),  # MB
+    "processes": ("RLIMIT_NPROC", 1),  # counts all processes of the user
+}
+
+# RLIMIT_NPROC counts all processes and threads of the user, so with it a JVM
+# could not start its threads, or at all, when other tests run at the same time.
+JAVA_LIMITS = [name for name in LIMITS if name != "processes"]
+
+LIMIT_MESSAGES = {
+    "memory": "Memory limit exceeded ({} MB).",
+    "cpu": "CPU time limit exceeded ({} seconds).",
+    "file-size": "File size limit exceeded ({} MB).",
+    "processes": "Process limit exceeded ({} processes).",
+}
+
+
+def set_limits(limits: Optional[dict]):
+    """Lower the rlimits of the current process, e.g. in a child before a test runs."""
+    if not limits:
+        return
+    import resource
+
+    for key, value in limits.items():
+        name, scale = LIMITS[key]
+        rlimit = getattr(resource, name)
+        soft = int(value * scale)
+        # SIGXCPU at the soft limit, SIGKILL a second later if it is ignored.
+        hard = soft + 1 if key == "cpu" else soft
+        current = resource.getrlimit(rlimit)[1]
+        if current != resource.RLIM_INFINITY:
+            soft, hard = min(soft, current), min(hard, current)
+        resource.setrlimit(rlimit, (soft, hard))
+
+
+def limit_exceeded(
+    limits: Optional[dict], returncode: Optional[int] = None, exc=None
+) -> str:
+    """Name of the limit that most likely stopped a test, or "" if none did."""
+    if not limits:
+        return ""
+    if "cpu" in limits and returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return "cpu"
+    if "file-size" in limits and returncode == -signal.SIGXFSZ:
+        return "file-size"
+    if "memory" in limits and isinstance(exc, MemoryError):
+        return "memory"
+    if isinstance(exc, OSError):
+        if "file-size" in limits and exc.errno == errno.EFBIG:
+            return "file-size"
+        if "processes" in limits and exc.errno == errno.EAGAIN:
+            return "processes"
+    return ""
+
+
+def limit_message(limit: str, limits: dict) -> str:
+    return LIMIT_MESSAGES[limit].format(limits[limit])
+
+
+# Seconds between reads of a running process's peak memory use.
+RSS_POLL_INTERVAL = 0.05
+
+
+def read_peak_rss_kb(pid: int) -> int:
+    """Peak resident set size of a running process, or 0 if it cannot be read."""
+    try:
+        with open(f"/proc/{pid}/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+async def _watch_peak_rss(pid: int, peak: List[int]):
+    while True:
+        peak[0] = max(peak[0], read_peak_rss_kb(pid))
+        await asyncio.sleep(RSS_POLL_INTERVAL)
+
+
+# Bytes read from a pipe at a time.
+CHUNK_SIZE = 2 ** 16
+
+
+def _decode(kept: bytearray, dropped: int) -> str:
+    if dropped:
+        kept += f"\n[... {dropped} bytes of output truncated ...]\n".encode()
+    return kept.decode(errors="replace")
+
+
+async def _read_stream(
+    stream, max_output: Optional[int], on_line: Optional[Callable[[str], None]]
+) -> str:
+    """Read stream to the end, keeping at most max_output bytes.
+
+    If on_line is given, each line is passed to it as soon as it is complete (and is
+    capped on its own) instead of being returned.
+    """
+    kept = bytearray()
+    dropped = 0
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            end = chunk.find(b"\n") if on_line else -1
+            if end >= 0:
+                part, chunk = chunk[:end], chunk[end + 1 :]
+            else:
+                part, chunk = chunk, b""
+            room = len(part)
+            if max_output is not None:
+                room = min(room, max(0, max_output - len(kept)))
+            kept += part[:room]
+            dropped += len(part) - room
+            if end >= 0:
+                on_line(_decode(kept, dropped))
+                kept, dropped = bytearray(), 0
+    if not on_line:
+        return _decode(kept, dropped)
+    if kept or dropped:
+        on_line(_decode(kept, dropped))
+    return ""
+
+
 async def run_process(
-    command: List[str], timeout: Optional[int] = None, cwd=None, env=None
+    command: List[str],
+    timeout: Optional[int] = None,
+    cwd=None,
+    env=None,
+    max_output: Optional[int] = None,
+    on_stdout_line: Optional[Callable[[str], None]] = None,
+    limits: Optional[dict] = None,
 ) -> ProcessResult:
+    """Run command, capturing at most max_output bytes of stdout and of stderr.
+
+    Output beyond the cap is read and dropped, and a note of how much was dropped
+    is appended. With on_stdout_line, stdout is passed on line by line as it is
+    produced rather than returned in the result. limits (see LIMITS) are set in
+    the child before it starts the command.
+    """
+    start = time.monotonic()
     proc = await asyncio.create_subprocess_exec(
         *command,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
         cwd=cwd,
+        preexec_fn=(lambda: set_limits(limits)) if limits else None,
         env=env
     )
+    peak = [0]
+    watcher = None
+    if sys.platform.startswith("linux"):
+        watcher = asyncio.ensure_future(_watch_peak_rss(proc.pid, peak))
     try:
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        stdout, stderr, _ = await asyncio.wait_for(
+            asyncio.gather(
+                _read_stream(proc.stdout, max_output, on_stdout_line),
+                _read_stream(proc.stderr, max_output, None),
+                proc.wait(),
+            ),
+            timeout=timeout,
+        )
     except Exception as exc:
         proc.kill()
         await proc.wait()
@@ -41,14 +204,22 @@ async def run_process(
             is_timeout=isinstance(exc, asyncio.TimeoutError),
             timeout=timeout,
             error=traceback.format_exc(),
+            duration=time.monotonic() - start,
+            peak_rss_kb=peak[0],
         )
     else:
         return ProcessResult(
             returncode=proc.returncode,
             timeout=timeout,
-            stdout=stdout.decode(),
-            stderr=stderr.decode(),
+            stdout=stdout,
+            stderr=stderr,
+            limit_exceeded=limit_exceeded(limits, returncode=proc.returncode),
+            duration=time.monotonic() - start,
+            peak_rss_kb=peak[0],
         )
+    finally:
+        if watcher:
+            watcher.cancel()
 
 
 async def concurrent(coroutines: Iterable, num: int):
@@ -58,7 +229,7 @@ async def concurrent(coroutines: Iterable, num: int):
         async with sem:
             return i, await aw
 
-    for fut in asyncio.as_completed(
-        {inner(i, coro) for i, coro in enumerate(coroutines)}
-    ):
+    # Tasks are created in order, so coroutines start in the order given.
+    tasks = [asyncio.ensure_future(inner(i, coro)) for i, coro in enumerate(coroutines)]
+    for fut in asyncio.as_completed(tasks):
         yield await fut
@@ -0,0 +1,94 @@
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+/**
+ * Long-lived javac used by agni, so that compiles run in a warm JVM.
+ *
+ * Prints the port it listens on (loopback only) and exits when stdin is closed.
+ * Exits without printing a port if there is no system compiler.
+ * Each connection sends javac arguments, one per line, followed by an empty line.
+ * The reply is the javac exit code on the first line followed by the compiler output,
+ * or "error" followed by the stack trace if the compiler threw.
+ * Relative paths are resolved against the directory the server was started in.
+ */
+public class CompileServer {
+    public static void main(String[] args) throws IOException {
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        if (compiler == null) {
+            // A JRE without javac; agni falls back to running javac itself.
+            System.err.println("No system Java compiler found.");
+            System.exit(1);
+        }
+        ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress());
+        System.out.println(server.getLocalPort());
+        System.out.flush();
+
+        Thread watcher = new Thread(() -> {
+            try {
+                while (System.in.read() != -1) {
+                    // wait for agni to close stdin
+                }
+            } catch (IOException e) {
+                // exit below
+            }
+            System.exit(0);
+        });
+        watcher.setDaemon(true);
+        watcher.start();
+
+        ExecutorService service = Executors.newCachedThreadPool((Runnable r) -> {
+            Thread t = new Thread(r);
+            t.setDaemon(true);
+            return t;
+        });
+        while (true) {
+            Socket socket = server.accept();
+            service.submit(() -> handle(compiler, socket));
+        }
+    }
+
+    private static void handle(JavaCompiler compiler, Socket socket) {
+        try (Socket s = socket) {
+            BufferedReader in = new BufferedReader(
+                    new InputStreamReader(s.getInputStream(), StandardCharsets.UTF_8));
+            List<String> javacArgs = new ArrayList<>();
+            String line;
+            while ((line = in.readLine()) != null && !line.isEmpty()) {
+                javacArgs.add(line);
+            }
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            String status;
+            try {
+                String[] javacArgv = javacArgs.toArray(new String[0]);
+                status = Integer.toString(compiler.run(null, output, output, javacArgv));
+            } catch (Throwable exc) {
+                // Not a compile error of the code, so agni runs javac itself.
+                output.reset();
+                exc.printStackTrace(new PrintStream(output, true));
+                status = "error";
+            }
+
+            OutputStream out = s.getOutputStream();
+            out.write(String.format("%s%n", status).getBytes(StandardCharsets.UTF_8));
+            output.writeTo(out);
+            out.flush();
+        } catch (IOException e) {
+            e.printStackTrace();
+        }
+    }
+}
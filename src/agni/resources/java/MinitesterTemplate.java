@@ -9,21 +9,43 @@ public class MinitesterTemplate {
     static String[] tests = {
         //tests
     };
+    // Rows of arguments of parameterized tests, each run with a row as String[].
+    static java.util.HashMap<String, String[][]> params = new java.util.HashMap<>();
+    static {
+        //params
+    }
     public static void main(String[] args) {
         int numPassed = 0;
         for(String className: tests)    {
             System.out.printf("%n======= %s =======%n", className);
             System.out.flush();
-            try {
-                Runnable testCase = (Runnable) Class.forName(className).getDeclaredConstructor().newInstance();
-                testCase.run();
+            String[][] rows = params.getOrDefault(className, new String[][] { null });
+            int numCasesPassed = 0;
+            for (String[] row : rows) {
+                try {
+                    Runnable testCase = row == null
+                            ? (Runnable) Class.forName(className).getDeclaredConstructor().newInstance()
+                            : (Runnable) Class.forName(className).getDeclaredConstructor(String[].class).newInstance((Object) row);
+                    testCase.run();
+                    numCasesPassed++;
+                } catch (AssertionError e) {
+                    printCase(row);
+                    System.out.println(e);
+                } catch (Exception e) {
+                    printCase(row);
+                    e.printStackTrace(System.out);
+                }
+            }
+            if (numCasesPassed == rows.length) {
                 numPassed++;
-            } catch (AssertionError e) {
-                System.out.println(e);
-            } catch (Exception e) {
-                e.printStackTrace(System.out);
             }
         }
         System.out.printf("%n%n%d of %d tests passed.%n", numPassed, tests.length);
     }
+
+    private static void printCase(String[] row) {
+        if (row != null) {
+            System.out.printf("Case: %s%n", String.join(", ", row));
+        }
+    }
 }
@@ -3,6 +3,10 @@ package _autograder;
 import java.io.ByteArrayOutputStream;
 import java.io.IOException;
 import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.nio.file.Files;
+import java.nio.file.Paths;
+import java.util.List;
 import java.util.concurrent.*;
 
 public class Executor {
@@ -62,30 +66,127 @@ public class Executor {
         return sb.toString();
     }
 
-    public static void main(String[] args) throws IOException {
-        ByteArrayOutputStream newBaos = new ByteArrayOutputStream();
+    // Milliseconds to wait for a timed out test thread to stop after interrupting it.
+    private static final long STOP_WAIT = 200;
+
+    private static final PrintStream STDOUT = System.out;
+
+    // Printed and exit status of a batch JVM that leaves the rest of the batch to a
+    // fresh JVM; see runBatch.
+    private static final String RESTART_LINE = "_agni_restart_";
+    private static final int RESTART_STATUS = 75;
+
+    // Bytes of test output kept in the log; the rest is counted and dropped.
+    private static final int MAX_OUTPUT = 1 << 16;
+
+    /** ByteArrayOutputStream that keeps at most limit bytes. */
+    private static class BoundedOutputStream extends ByteArrayOutputStream {
+        private final int limit;
+        private long dropped = 0;
+
+        BoundedOutputStream(int limit) {
+            this.limit = limit;
+        }
+
+        @Override
+        public synchronized void write(int b) {
+            if (count < limit) {
+                super.write(b);
+            } else {
+                dropped++;
+            }
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) {
+            int room = Math.max(0, Math.min(len, limit - count));
+            super.write(b, off, room);
+            dropped += len - room;
+        }
+
+        @Override
+        public synchronized String toString() {
+            String s = super.toString();
+            if (dropped > 0) {
+                s += String.format("%n[... %d bytes of output truncated ...]%n", dropped);
+            }
+            return s;
+        }
+    }
+
+    // Failed cases of a parameterized test that are logged.
+    private static final int MAX_FAILED_CASES = 10;
+
+    /**
+     * Runs a parameterized test once per row of its arguments, each time constructed
+     * with the row as its String[] argument, and logs the output of failed cases.
+     */
+    private static void runCases(Class<?> testClass, String[][] rows, boolean[] cases, PrintStream log) {
+        int failed = 0;
+        for (int i = 0; i < rows.length && !Thread.currentThread().isInterrupted(); i++) {
+            ByteArrayOutputStream caseBaos = new BoundedOutputStream(MAX_OUTPUT);
+            PrintStream casePS = new PrintStream(caseBaos);
+            try {
+                System.setOut(casePS);
+                Runnable testCase = (Runnable) testClass.getDeclaredConstructor(String[].class)
+                        .newInstance((Object) rows[i]);
+                testCase.run();
+                cases[i] = true;
+            } catch (Throwable exc) {
+                Throwable error = exc instanceof InvocationTargetException ? exc.getCause() : exc;
+                if (error instanceof OutOfMemoryError) {
+                    // Fails the whole test, as memory limit exceeded.
+                    throw (OutOfMemoryError) error;
+                } else if (error instanceof AssertionError) {
+                    casePS.println(error.getMessage());
+                } else {
+                    error.printStackTrace(casePS);
+                }
+            } finally {
+                System.setOut(log);
+            }
+            casePS.flush();
+            if (!cases[i] && ++failed <= MAX_FAILED_CASES) {
+                log.printf("--------- Case %d: %s ---------%n%s%n", i + 1, String.join(", ", rows[i]), caseBaos);
+            }
+        }
+        if (failed > MAX_FAILED_CASES) {
+            log.printf("[... %d more failed cases ...]%n", failed - MAX_FAILED_CASES);
+        }
+    }
+
+    /**
+     * Runs one test on its own daemon thread and prints its JSON result line.
+     * Returns false if the test thread is still alive, i.e. this JVM is no longer clean.
+     */
+    private static boolean runTest(String className, String testcaseID, long timeout) {
+        ByteArrayOutputStream newBaos = new BoundedOutputStream(MAX_OUTPUT);
         PrintStream newPS = new PrintStream(newBaos);
-        PrintStream oldPS = System.out;
 
-        String className = System.getProperty("className");
-        String testcaseID = System.getProperty("testcaseID");
         String isExternal = System.getProperty("isExternal");
-        long timeout = getTimeout();
         boolean passed = false;
         String errorType = "";
         String errorMessage = "";
+        Thread thread = null;
+        // All rows of a parameterized test run in this one test, within its timeout.
+        String[][] rows = TestCode.params.get(className);
+        boolean[] cases = rows == null ? null : new boolean[rows.length];
 
         try {
-            ExecutorService service = Executors.newSingleThreadExecutor((Runnable r) -> {
-                Thread t = new Thread(r);
-                t.setDaemon(true);
-                return t;
-            });
             System.setOut(newPS);
-            Runnable testCase = (Runnable) Class.forName(className).getDeclaredConstructor().newInstance();
-            Future<?> future = service.submit(testCase);
+            Class<?> testClass = Class.forName(className);
+            Runnable testCase = rows == null
+                    ? (Runnable) testClass.getDeclaredConstructor().newInstance()
+                    : () -> runCases(testClass, rows, cases, newPS);
+            FutureTask<?> future = new FutureTask<>(testCase, null);
+            thread = new Thread(future);
+            thread.setDaemon(true);
+            thread.start();
             future.get(timeout, TimeUnit.MILLISECONDS);
             passed = true;
+            for (int i = 0; cases != null && i < cases.length; i++) {
+                passed = passed && cases[i];
+            }
         } catch (Throwable exc) {
             Throwable error = exc instanceof ExecutionException ? exc.getCause() : exc;
             errorType = error.getClass().getCanonicalName();
@@ -95,10 +196,25 @@ public class Executor {
                 newPS.println(msg);
             } else if (error instanceof AssertionError) {
                 newPS.println(error.getMessage());
+            } else if (error instanceof OutOfMemoryError) {
+                newPS.println("Memory limit exceeded.");
+                error.printStackTrace(newPS);
             } else {
                 error.printStackTrace(newPS);
             }
         } finally {
+            System.setOut(STDOUT);
+            String casesJson = "";
+            if (cases != null) {
+                StringBuilder sb = new StringBuilder();
+                int numPassed = 0;
+                for (boolean p : cases) {
+                    sb.append(sb.length() == 0 ? "" : ", ").append(p);
+                    numPassed += p ? 1 : 0;
+                }
+                newPS.printf("%d of %d cases passed.%n", numPassed, cases.length);
+                casesJson = String.format(", \"cases\": [%s]", sb);
+            }
             newPS.flush();
             String log = String.format("--------- Output ---------%n%s", newBaos.toString());
             String code = TestCode.data.get(className);
@@ -112,17 +228,63 @@ public class Executor {
 
             String line;
             if (isExternal == null) {
-                line = String.format("{\"id\": \"%s\", \"passed\": %s, \"log\": \"%s\"}",
-                        testcaseID, passed, escapeString(log));
+                line = String.format("{\"id\": \"%s\", \"passed\": %s, \"log\": \"%s\"%s}",
+                        testcaseID, passed, escapeString(log), casesJson);
             } else {
+                String limitExceeded = "java.lang.OutOfMemoryError".equals(errorType)
+                        ? ", \"limit_exceeded\": \"memory\"" : "";
                 line = String.format("{\"id\": \"%s\", \"passed\": %s, \"log\": \"%s\", " +
-                                "\"timeout\": %d, " + "\"error_type\": \"%s\", \"error_message\": \"%s\"}",
+                                "\"timeout\": %d, " + "\"error_type\": \"%s\", \"error_message\": \"%s\"%s%s}",
                         testcaseID, passed, escapeString(log), timeout,
-                        errorType, escapeString(errorMessage));
+                        errorType, escapeString(errorMessage), limitExceeded, casesJson);
             }
-            oldPS.println(line);
-            oldPS.flush();
+            STDOUT.println(line);
+            STDOUT.flush();
         }
 
+        if (thread == null || !thread.isAlive()) {
+            return true;
+        }
+        thread.interrupt();
+        try {
+            thread.join(STOP_WAIT);
+        } catch (InterruptedException e) {
+            // ignore
+        }
+        return !thread.isAlive();
+    }
+
+    /**
+     * Runs every test listed in the batch file in this JVM. Each line of the file is
+     * "className<TAB>testcaseID<TAB>timeout". If a timed out test leaves a thread behind
+     * that cannot be stopped, the JVM prints RESTART_LINE after the test's result and
+     * exits with RESTART_STATUS at once, and run-external runs the remaining tests in
+     * a fresh JVM with -DbatchStart set to the next test.
+     */
+    private static void runBatch(String batchFile) throws IOException {
+        List<String> lines = Files.readAllLines(Paths.get(batchFile));
+        int start = Integer.parseInt(System.getProperty("batchStart", "0"));
+        for (int i = start; i < lines.size(); i++) {
+            String[] fields = lines.get(i).split("\t");
+            if (fields.length < 3) {
+                continue;
+            }
+            boolean isClean = runTest(fields[0], fields[1], Long.parseLong(fields[2].trim()));
+            if (!isClean && i + 1 < lines.size()) {
+                STDOUT.println(RESTART_LINE);
+                STDOUT.flush();
+                // halt rather than exit, so that shutdown hooks cannot hold it up.
+                Runtime.getRuntime().halt(RESTART_STATUS);
+            }
+        }
+    }
+
+    public static void main(String[] args) throws IOException, InterruptedException {
+        String batchFile = System.getProperty("batch");
+        if (batchFile != null) {
+            runBatch(batchFile);
+        } else {
+            runTest(System.getProperty("className"), System.getProperty("testcaseID"), getTimeout());
+        }
     }
 }
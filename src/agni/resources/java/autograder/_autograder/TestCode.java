@@ -9,9 +9,13 @@ public class TestCode {
 
     static HashMap<String, String> data = new HashMap<>();
 
+    // Rows of arguments of parameterized tests by class name.
+    static HashMap<String, String[][]> params = new HashMap<>();
+
     static {
         for (String[] row : _data) {
             data.put(row[0], row[1]);
         }
+        //_replace_params_
     }
 }
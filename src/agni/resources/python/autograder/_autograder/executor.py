@@ -5,16 +5,58 @@ import sys
 from contextlib import redirect_stdout, redirect_stderr
 from io import StringIO
 import json
+from . import testinfo
+from .proc_util import limit_exceeded, limit_message
 
 
-def main():
+# Characters of test output kept in the log; the rest is counted and dropped.
+MAX_OUTPUT = 2 ** 16
+
+# Failed cases of a parameterized test that are logged, and characters of each
+# case's arguments shown.
+MAX_FAILED_CASES = 10
+MAX_CASE_TEXT = 200
+
+
+class CappedIO(StringIO):
+    """StringIO that keeps at most limit characters and counts the ones dropped."""
+
+    def __init__(self, limit=MAX_OUTPUT):
+        super().__init__()
+        self.limit = limit
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, s):
+        room = max(0, self.limit - self.size)
+        if len(s) > room:
+            self.dropped += len(s) - room
+            s = s[:room]
+        self.size += len(s)
+        return super().write(s)
+
+    def getvalue(self):
+        value = super().getvalue()
+        if self.dropped:
+            value += f"\n[... {self.dropped} characters of output truncated ...]\n"
+        return value
+
+
+def test_limits(module_dotted_name):
+    """Resource limits of a test: [autograder.limits] updated by the test's [limits]."""
+    info = testinfo.data.get(module_dotted_name, {})
+    return {**testinfo.limits, **info.get("limits", {})}
+
+
+def _capture(module_dotted_name, fn, limits):
+    """Call fn with its output captured; returns (passed, log, limit)."""
     log = []
     passed = False
-    out = StringIO()
+    limit = ""
+    out = CappedIO()
     try:
-        module_dotted_name = sys.argv[1]
         with redirect_stdout(out), redirect_stderr(out):
-            importlib.import_module(module_dotted_name)
+            fn()
         log.append(out.getvalue())
         passed = True
     except ImportError:
@@ -25,23 +67,93 @@ def main():
     except AssertionError as e:
         log.append(out.getvalue())
         log.append(f"[Feedback] {e}\n")
-    except Exception:
+    except Exception as e:
         log.append(out.getvalue())
+        limit = limit_exceeded(limits, exc=e)
+        if limit:
+            log.append(f"[Feedback] {limit_message(limit, limits)}\n")
         exc_lines = itertools.dropwhile(
             lambda x: module_dotted_name.replace(".", "/") not in x,
             traceback.format_exception(*sys.exc_info()),
         )
         log.append("".join(exc_lines))
+    return passed, log, limit
+
 
+def _describe(row):
+    if isinstance(row, dict):
+        text = ", ".join(f"{k}={v!r}" for k, v in row.items())
+    else:
+        text = ", ".join(repr(v) for v in row)
+    return text if len(text) <= MAX_CASE_TEXT else f"{text[:MAX_CASE_TEXT]}..."
+
+
+def _run_cases(module_dotted_name, params, limits):
+    """Call test() of the imported module once per row of params.
+
+    Rows are lists of positional or tables of keyword arguments. Only failed cases
+    are logged, up to MAX_FAILED_CASES of them.
+    """
+    test = getattr(sys.modules[module_dotted_name], "test", None)
+    if not callable(test):
+        log = f"[Autograder Error] {module_dotted_name} has params but no test().\n"
+        return False, [log], "", []
+    log = []
+    cases = []
+    limit = ""
+    for i, row in enumerate(params, 1):
+        args, kwargs = ([], row) if isinstance(row, dict) else (row, {})
+        passed, case_log, limit = _capture(
+            module_dotted_name, lambda: test(*args, **kwargs), limits
+        )
+        cases.append(passed)
+        if not passed and cases.count(False) <= MAX_FAILED_CASES:
+            log.append(f"[Case {i}] {_describe(row)}\n")
+            log.extend(case_log)
+        if limit:
+            # The process may be out of memory or time; give up on the rest.
+            break
+    failed = len(params) - sum(cases)
+    if failed > MAX_FAILED_CASES:
+        log.append(f"[... {failed - MAX_FAILED_CASES} more failed cases ...]\n")
+    log.append(f"{sum(cases)} of {len(params)} cases passed.\n")
+    return failed == 0, log, limit, cases
+
+
+def run(module_dotted_name, limits=None):
+    passed, log, limit = _capture(
+        module_dotted_name,
+        lambda: importlib.import_module(module_dotted_name),
+        limits,
+    )
+    params = testinfo.data.get(module_dotted_name, {}).get("params")
+    cases = None
+    if passed and params is not None:
+        passed, case_log, limit, cases = _run_cases(
+            module_dotted_name, params, limits
+        )
+        log.extend(case_log)
+    result = {"passed": passed, "log": "\n".join(log)}
+    if cases is not None:
+        result["cases"] = cases
+    if limit:
+        result["limit_exceeded"] = limit
+    return result
+
+
+def to_json(result):
     try:
-        print(json.dumps({"passed": passed, "log": "\n".join(log)}))
+        return json.dumps(result)
     except Exception:
-        print(
-            json.dumps(
-                {"passed": False, "log": f"[Autograder Error] {traceback.format_exc()}"}
-            )
+        return json.dumps(
+            {"passed": False, "log": f"[Autograder Error] {traceback.format_exc()}"}
         )
 
 
+def main():
+    module_dotted_name = sys.argv[1]
+    print(to_json(run(module_dotted_name, test_limits(module_dotted_name))))
+
+
 if __name__ == "__main__":
     main()
@@ -1,63 +1,239 @@
 from . import testinfo
-from .proc_util import run_process
+from .proc_util import run_process, concurrent, limit_message, ProcessResult
+from .pool import WorkerPool, is_supported
+from .executor import test_limits
+from .prerequisites import levels, skip_message
 import json
 import os
 import asyncio
+import hashlib
+import shutil
+import sys
+import tempfile
+import zipfile
 
 
 DEFAULT_TIMEOUT = 5
 
+# Bytes of output kept from a test process. The executor caps the test log well
+# below this, so only a process that writes to the real stdout can exceed it.
+MAX_OUTPUT = 2 ** 20
 
-async def _main(fout, is_json):
-    for module, info in testinfo.data.items():
-        proc_result = await run_process(
-            ["python3", "-m", "_autograder.executor", module],
-            timeout=info.get("timeout", DEFAULT_TIMEOUT),
-        )
-        if proc_result.is_timeout:
-            result = {
-                "passed": False,
-                "log": (
-                    f"Timeout after {proc_result.timeout} seconds. "
-                    "Please check if there is an infinite loop.\n"
-                ),
-            }
-        elif proc_result.error:
+
+def _test_id(module: str) -> str:
+    # The id in the metadata, with the --prefix of bundle-python; requires and
+    # timeouts refer to tests by it.
+    return testinfo.data[module]["testcaseID"]
+
+
+def _selected_tests():
+    tests = list(testinfo.data.items())
+    testspath = os.environ.get("AGNI_TESTS")
+    if testspath:
+        with open(testspath) as fin:
+            selected = set(line.strip() for line in fin)
+        tests = [(mod, info) for mod, info in tests if _test_id(mod) in selected]
+    return tests
+
+
+def _timeouts() -> dict:
+    # Timeouts in seconds by test id, e.g. set by agni calibrate.
+    timeoutspath = os.environ.get("AGNI_TIMEOUTS")
+    if not timeoutspath:
+        return {}
+    with open(timeoutspath) as fin:
+        return json.load(fin)
+
+
+def _make_result(module: str, info: dict, proc_result: ProcessResult) -> dict:
+    if proc_result.is_timeout:
+        result = {
+            "passed": False,
+            "log": (
+                f"Timeout after {proc_result.timeout} seconds. "
+                "Please check if there is an infinite loop.\n"
+            ),
+        }
+    elif proc_result.limit_exceeded:
+        limit = proc_result.limit_exceeded
+        result = {
+            "passed": False,
+            "log": f"{limit_message(limit, test_limits(module))}\n",
+            "limit_exceeded": limit,
+        }
+    elif proc_result.error:
+        result = {
+            "passed": False,
+            "log": f"Autograder Error (please contact TA):\n{proc_result.error}",
+        }
+    else:
+        try:
+            result = json.loads(proc_result.stdout)
+        except ValueError:
             result = {
                 "passed": False,
-                "log": f"Autograder Error (please contact TA):\n{proc_result.error}",
+                "log": "Autograder Error (please contact TA):\n"
+                f"Could not read the test result.\n{proc_result.stderr}",
             }
-        else:
-            result = json.loads(proc_result.stdout)
 
-        prefix, category, test = module.split(".")
-        result["id"] = f"[{prefix}] {category}_@_{test}"
-
-        code = info.get("code")
-        if code:
-            lines = [
-                f"{'-'*9} Test Code {'-'*9}",
-                code,
-                f"\n{'-'*9} Output {'-'*9}",
-                result["log"],
-            ]
-            result["log"] = "\n".join(lines)
-
-        status = "[PASSED]" if result["passed"] else "[FAILED]"
-        result["log"] = "********* {} ********* {}\n{}\n\n\n".format(
-            result["id"].replace("_@_", " : "), status, result["log"]
+    result["duration"] = round(proc_result.duration, 3)
+    result["peak_rss_kb"] = proc_result.peak_rss_kb
+    result["is_timeout"] = proc_result.is_timeout
+    return _add_header(module, info, result)
+
+
+def _skipped_result(module: str, info: dict, failed: list) -> dict:
+    result = {"passed": False, "log": f"{skip_message(failed)}\n", "skipped": True}
+    return _add_header(module, info, result)
+
+
+def _add_header(module: str, info: dict, result: dict) -> dict:
+    result["id"] = _test_id(module)
+    code = info.get("code")
+    if code:
+        lines = [
+            f"{'-'*9} Test Code {'-'*9}",
+            code,
+            f"\n{'-'*9} Output {'-'*9}",
+            result["log"],
+        ]
+        result["log"] = "\n".join(lines)
+
+    status = "[PASSED]" if result["passed"] else "[FAILED]"
+    result["log"] = "********* {} ********* {}\n{}\n\n\n".format(
+        result["id"].replace("_@_", " : "), status, result["log"]
+    )
+    return result
+
+
+def _write_result(fout, is_json, result: dict):
+    if is_json:
+        keys = (
+            "id",
+            "passed",
+            "log",
+            "limit_exceeded",
+            "duration",
+            "peak_rss_kb",
+            "is_timeout",
+            "skipped",
+            "cases",
         )
+        line = json.dumps({k: result[k] for k in keys if k in result})
+        fout.write(f"{line}\n")
+    else:
+        fout.write(result["log"])
+    fout.flush()
+
+
+async def _run_test(workers, module: str, info: dict, timeouts: dict) -> ProcessResult:
+    timeout = timeouts.get(_test_id(module), info.get("timeout", DEFAULT_TIMEOUT))
+    limits = test_limits(module)
+    if workers:
+        return await workers.run(module, timeout, limits)
+    return await run_process(
+        ["python3", "-m", "_autograder.executor", module],
+        timeout=timeout,
+        max_output=MAX_OUTPUT,
+        limits=limits,
+    )
+
+
+def _num_parallel():
+    # Timeouts are wall-clock, so running more tests than there are CPUs
+    # would make tests time out that pass when run alone.
+    value = os.environ.get("AGNI_PARALLEL", "1")
+    try:
+        requested = int(value)
+    except ValueError:
+        print(f"AGNI_PARALLEL={value!r} is not a number, running one test at a time.")
+        requested = 1
+    return max(1, min(requested, os.cpu_count() or 1))
+
+
+async def _main(fout, is_json):
+    num = _num_parallel()
+    use_pool = is_supported() and os.environ.get("AGNI_POOL", "1") != "0"
+    workers = WorkerPool(num) if use_pool else None
+    if workers:
+        await workers.start()
+    try:
+        tests = _selected_tests()
+        timeouts = _timeouts()
+        selected = {_test_id(module) for module, _ in tests}
+        requires = {
+            _test_id(module): [t for t in info.get("requires", []) if t in selected]
+            for module, info in tests
+        }
+        # Tests start in this order, so a test waiting for its prerequisites never
+        # holds up one of them.
+        level = levels(requires)
+        order = sorted(range(len(tests)), key=lambda i: level[_test_id(tests[i][0])])
+        passed = {tid: asyncio.get_running_loop().create_future() for tid in selected}
+
+        async def run(module: str, info: dict) -> dict:
+            test_id = _test_id(module)
+            result = {"passed": False}
+            try:
+                failed = [tid for tid in requires[test_id] if not await passed[tid]]
+                if failed:
+                    result = _skipped_result(module, info, failed)
+                else:
+                    proc_result = await _run_test(workers, module, info, timeouts)
+                    result = _make_result(module, info, proc_result)
+                return result
+            finally:
+                passed[test_id].set_result(result["passed"])
+
+        coros = (run(*tests[i]) for i in order)
+        # Results arrive in completion order but are written in testinfo order.
+        pending = {}
+        next_index = 0
+        async for k, result in concurrent(coros, num):
+            pending[order[k]] = result
+            while next_index in pending:
+                _write_result(fout, is_json, pending.pop(next_index))
+                next_index += 1
+    finally:
+        if workers:
+            await workers.close()
+
+
+def _unpack():
+    """Extract the bundle to AGNI_UNPACK_DIR once and import from there.
 
-        if is_json:
-            line = json.dumps({k: result[k] for k in ("id", "passed", "log")})
-            fout.write(f"{line}\n")
-            fout.flush()
-        else:
-            fout.write(result["log"])
-            fout.flush()
+    Extracted bundles are kept by content hash, so later runs skip zipimport and
+    can keep the bytecode Python caches in __pycache__.
+    """
+    unpack_dir = os.environ.get("AGNI_UNPACK_DIR")
+    archive = getattr(__loader__, "archive", None)
+    if not unpack_dir or not archive:
+        return
+    try:
+        with open(archive, "rb") as fin:
+            digest = hashlib.sha256(fin.read()).hexdigest()[:16]
+        target = os.path.join(unpack_dir, digest)
+        if not os.path.isdir(target):
+            os.makedirs(unpack_dir, exist_ok=True)
+            tmpdir = tempfile.mkdtemp(dir=unpack_dir)
+            with zipfile.ZipFile(archive) as z:
+                z.extractall(tmpdir)
+            try:
+                os.rename(tmpdir, target)
+            except OSError:
+                # Another run extracted it first.
+                shutil.rmtree(tmpdir)
+    except OSError:
+        return
+    # In place of the archive, so that student modules in the cwd still come first.
+    index = sys.path.index(archive) if archive in sys.path else len(sys.path)
+    sys.path.insert(index, target)
+    pythonpath = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = os.pathsep.join(p for p in (target, pythonpath) if p)
 
 
 def main():
+    _unpack()
     outputpath = os.environ.get("AGNI_OUTPUTPATH")
     is_json = True
     if not outputpath:
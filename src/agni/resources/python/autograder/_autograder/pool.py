@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import sys
+import traceback
+from typing import Optional
+from .proc_util import ProcessResult
+
+
+# Seconds allowed for a worker to import the student solution.
+STARTUP_TIMEOUT = 10
+# Extra seconds a worker gets beyond the test timeout to report back.
+GRACE_PERIOD = 5
+# Test logs are sent back as a single line.
+LINE_LIMIT = 2 ** 27
+
+
+def is_supported():
+    return sys.platform != "win32" and hasattr(os, "fork")
+
+
+def _kill(proc):
+    if proc.returncode is None:
+        proc.kill()
+
+
+async def _spawn(preload=True):
+    command = ["python3", "-m", "_autograder.worker"]
+    if not preload:
+        command.append("--no-preload")
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=LINE_LIMIT,
+    )
+    try:
+        line = await asyncio.wait_for(proc.stdout.readline(), timeout=STARTUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        line = b""
+    if line.strip() == b"ready":
+        return proc
+
+    _kill(proc)
+    await proc.wait()
+    if preload:
+        # Student code hangs or crashes on import; let each test report it.
+        return await _spawn(preload=False)
+    raise RuntimeError("Could not start autograder worker.")
+
+
+async def _respawn():
+    # None keeps the place of the worker, so that the next test tries again.
+    try:
+        return await _spawn()
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+class WorkerPool:
+    """Pool of warm workers, each running one test at a time in a forked child."""
+
+    def __init__(self, size: int = 1):
+        self.size = size
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    async def start(self):
+        for _ in range(self.size):
+            self._idle.put_nowait(await _spawn())
+
+    async def close(self):
+        while not self._idle.empty():
+            proc = self._idle.get_nowait()
+            if proc is None:
+                continue
+            proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=GRACE_PERIOD)
+            except asyncio.TimeoutError:
+                _kill(proc)
+                await proc.wait()
+
+    async def run(
+        self, module: str, timeout: Optional[int] = None, limits: Optional[dict] = None
+    ) -> ProcessResult:
+        proc = await self._idle.get()
+        try:
+            if proc is None:
+                proc = await _spawn()
+            request = json.dumps(
+                {"module": module, "timeout": timeout, "limits": limits}
+            )
+            proc.stdin.write(f"{request}\n".encode())
+            await proc.stdin.drain()
+            line = await asyncio.wait_for(
+                proc.stdout.readline(),
+                timeout=None if timeout is None else timeout + GRACE_PERIOD,
+            )
+            if not line:
+                raise EOFError("Autograder worker exited unexpectedly.")
+            return ProcessResult(**json.loads(line))
+        except Exception:
+            error = traceback.format_exc()
+            if proc is not None:
+                _kill(proc)
+                await proc.wait()
+                proc = await _respawn()
+            return ProcessResult(timeout=timeout, error=error)
+        finally:
+            self._idle.put_nowait(proc)
@@ -0,0 +1,34 @@
+"""Order and skip tests by their prerequisites; see agni/prerequisites.py."""
+from typing import Dict, List
+
+
+def levels(requires: Dict[str, List[str]]) -> Dict[str, int]:
+    """Level of each test: 0 without prerequisites, else 1 + that of the highest.
+
+    Running tests by level runs every test after its prerequisites.
+    """
+    result: Dict[str, int] = {}
+    visiting = set()
+
+    def level(test_id: str) -> int:
+        if test_id not in result:
+            if test_id in visiting:
+                raise ValueError(f"{test_id} requires itself through other tests.")
+            visiting.add(test_id)
+            result[test_id] = 1 + max(
+                (level(tid) for tid in requires.get(test_id, [])), default=-1
+            )
+            visiting.discard(test_id)
+        return result[test_id]
+
+    for test_id in requires:
+        level(test_id)
+    return result
+
+
+def skip_message(failed: List[str]) -> str:
+    names = ", ".join(tid.replace("_@_", " : ") for tid in failed)
+    return (
+        f"Not run because it depends on {names}, which did not pass. "
+        "Please fix that first."
+    )
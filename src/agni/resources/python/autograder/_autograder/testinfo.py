@@ -1 +1,3 @@
 data = _replace_me_
+preload = _replace_preload_
+limits = _replace_limits_
@@ -0,0 +1,153 @@
+"""Warm test worker used by WorkerPool.
+
+The worker imports the student solution once, unless it prints on import, and
+then forks a fresh child for every test it is asked to run, so each test still
+gets an isolated interpreter state without paying interpreter startup again.
+
+Protocol (one JSON object per line):
+    -> "ready" once startup is done
+    <- {"module": "exposed.category.test", "timeout": 5, "limits": {"cpu": 2}}
+    -> {"is_timeout": false, "timeout": 5, "error": "", "stdout": "...",
+        "limit_exceeded": "", "duration": 0.12, "peak_rss_kb": 10240}
+"""
+import importlib
+import json
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from . import executor
+from .proc_util import limit_exceeded, set_limits
+from . import testinfo
+
+
+def _preload(modules):
+    """Import the student modules that import cleanly and print nothing.
+
+    A forked test gets preloaded modules from sys.modules, so output printed at
+    import time would be missing from its log. Other modules are unloaded again,
+    so that each test imports them itself, as without the pool.
+    """
+    for name in modules:
+        loaded = set(sys.modules)
+        out = executor.CappedIO(limit=1)
+        failed = False
+        try:
+            with redirect_stdout(out), redirect_stderr(out):
+                importlib.import_module(name)
+        except BaseException:
+            # The test itself will import the module again and report the error.
+            failed = True
+        if failed or out.size or out.dropped:
+            for added in set(sys.modules) - loaded:
+                del sys.modules[added]
+
+
+def _child(module, wfd, protocol_fds, limits):
+    try:
+        for fd in protocol_fds:
+            os.close(fd)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        set_limits(limits)
+        line = executor.to_json(executor.run(module, limits))
+        with os.fdopen(wfd, "wt") as fout:
+            fout.write(line)
+    finally:
+        os._exit(0)
+
+
+def _peak_rss_kb(rusage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def run_forked(module, timeout, protocol_fds=(), limits=None):
+    start = time.monotonic()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        _child(module, wfd, protocol_fds, limits)
+    os.close(wfd)
+
+    chunks = []
+    is_timeout = False
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                is_timeout = True
+                break
+            ready, _, _ = select.select([rfd], [], [], remaining)
+            if not ready:
+                is_timeout = True
+                break
+            chunk = os.read(rfd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(rfd)
+        if is_timeout:
+            os.kill(pid, signal.SIGKILL)
+        _, status, rusage = os.wait4(pid, 0)
+
+    reply = {
+        "timeout": timeout,
+        "duration": time.monotonic() - start,
+        "peak_rss_kb": _peak_rss_kb(rusage),
+    }
+    if is_timeout:
+        return {**reply, "is_timeout": True}
+    if not chunks and os.WIFSIGNALED(status):
+        limit = limit_exceeded(limits, returncode=-os.WTERMSIG(status))
+        if limit:
+            return {**reply, "limit_exceeded": limit}
+    # Without output, the result cannot be read, as for a test run without the pool.
+    return {**reply, "stdout": b"".join(chunks).decode()}
+
+
+def serve(preload=True):
+    # Keep private copies of the protocol pipes so that nothing printed by
+    # student code (here or in forked children) can corrupt them.
+    fin = os.fdopen(os.dup(0), "rt")
+    fout = os.fdopen(os.dup(1), "wt")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+
+    if preload:
+        _preload(getattr(testinfo, "preload", []))
+
+    protocol_fds = (fin.fileno(), fout.fileno())
+    fout.write("ready\n")
+    fout.flush()
+    for line in fin:
+        request = json.loads(line)
+        try:
+            reply = run_forked(
+                request["module"],
+                request.get("timeout"),
+                protocol_fds,
+                request.get("limits"),
+            )
+        except Exception:
+            reply = {"timeout": request.get("timeout"), "error": traceback.format_exc()}
+        fout.write(json.dumps(reply) + "\n")
+        fout.flush()
+
+
+def main():
+    serve(preload="--no-preload" not in sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
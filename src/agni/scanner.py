@@ -0,0 +1,126 @@
+"""Reading config blocks, test code, package and imports from test files.
+
+Each file is scanned once, with string searches instead of backtracking regular
+expressions, and files are read in a thread pool, so that bundling thousands of
+generated tests is bound by reading the files.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple
+
+_PACKAGE = re.compile(r"\s*package")
+_IMPORT = re.compile(r"\s*import")
+_PUBLIC_CLASS = re.compile(r"\n\s*public\s+class")
+_QUOTES = ('"""', "'''")
+
+
+@dataclass
+class ScannedFile:
+    # Text of the config block, or None if there is none.
+    config: Optional[str] = None
+    # Text between the code markers, or None if there are none.
+    code: Optional[str] = None
+    # The file without its config block(s).
+    without_config: str = ""
+    # [Java] The package line, the import lines and the other lines, with the
+    # public class made package-private, for putting tests into one file.
+    package: str = ""
+    imports: List[str] = field(default_factory=list)
+    body: List[str] = field(default_factory=list)
+
+
+def _marked(text: str, begin: str, end: str) -> Optional[Tuple[int, int]]:
+    """Span of the lines after the line of begin, up to the line of the last end.
+
+    The same as the group of f"{begin}.*?\\n(.*\\n).*?{end}" with re.DOTALL.
+    """
+    b = text.find(begin)
+    if b < 0:
+        return None
+    start = text.find("\n", b) + 1
+    if start == 0:
+        return None
+    e = text.rfind(end, start)
+    if e < 0:
+        return None
+    stop = text.rfind("\n", start, e) + 1
+    if stop == 0:
+        return None
+    return start, stop
+
+
+def scan_python(text: str) -> ScannedFile:
+    scanned = ScannedFile(without_config=text)
+    span = _marked(text, "_begin_config_", "_end_config_")
+    if span:
+        scanned.config = text[span[0] : span[1]]
+        # Drop the string holding the config block, with its quotes.
+        before = text[: text.find("_begin_config_")].rstrip()
+        e = text.rfind("_end_config_") + len("_end_config_")
+        after = text[e:].lstrip()
+        if before.endswith(_QUOTES) and after.startswith(_QUOTES):
+            scanned.without_config = before[:-3] + after[3:]
+    span = _marked(text, "_begin_code_", "_end_code_")
+    if span:
+        scanned.code = text[span[0] : span[1]]
+    return scanned
+
+
+def _java_configs(text: str) -> List[Tuple[int, int, int, int]]:
+    """Start and end of each /* config ... */ comment and of the config in it."""
+    spans = []
+    i = text.find("/*")
+    while i >= 0:
+        j = i + 2
+        while j < len(text) and text[j].isspace():
+            j += 1
+        if not text.startswith("config", j):
+            i = text.find("/*", i + 1)
+            continue
+        j += len("config")
+        while j < len(text) and text[j].isspace():
+            j += 1
+        k = text.find("*/", j)
+        if k < 0:
+            break
+        spans.append((i, k + 2, j, k))
+        i = text.find("/*", k + 2)
+    return spans
+
+
+def scan_java(text: str) -> ScannedFile:
+    scanned = ScannedFile()
+    configs = _java_configs(text)
+    if configs:
+        scanned.config = text[configs[0][2] : configs[0][3]]
+    parts = []
+    last = 0
+    for start, stop, _, _ in configs:
+        parts.append(text[last:start])
+        last = stop
+    parts.append(text[last:])
+    scanned.without_config = "".join(parts)
+
+    span = _marked(text, "begin_code", "end_code")
+    if span:
+        scanned.code = text[span[0] : span[1]]
+
+    for line in _PUBLIC_CLASS.sub("\nclass", scanned.without_config).splitlines():
+        if _PACKAGE.match(line):
+            scanned.package = scanned.package or line
+        elif _IMPORT.match(line):
+            scanned.imports.append(line)
+        else:
+            scanned.body.append(line)
+    return scanned
+
+
+def scan_files(
+    paths: Iterable[Path], scan: Callable[[str], ScannedFile]
+) -> List[Tuple[Path, ScannedFile]]:
+    """Read and scan the files in a thread pool; results are in the order of paths."""
+    paths = list(paths)
+    with ThreadPoolExecutor() as pool:
+        return list(zip(paths, pool.map(lambda p: scan(p.read_text()), paths)))
@@ -0,0 +1,61 @@
+import json
+import math
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, List, Optional, TextIO
+
+
+# File written next to outputs/ by run-external and read by grading-report.
+FILENAME = "telemetry.jsonl"
+
+_fout: Optional[TextIO] = None
+_forward: Optional[Callable[[dict], None]] = None
+
+
+@contextmanager
+def recording(path: Path):
+    """Write events recorded inside this block to path, one JSON object per line."""
+    global _fout
+    with open(path, "at") as fout:
+        _fout = fout
+        try:
+            yield
+        finally:
+            _fout = None
+
+
+@contextmanager
+def forwarding(forward: Callable[[dict], None]):
+    """Pass events recorded inside this block to forward, e.g. to send them away."""
+    global _forward
+    _forward = forward
+    try:
+        yield
+    finally:
+        _forward = None
+
+
+def record(kind: str, **fields):
+    """Record an event, e.g. record("test", student=..., test=..., duration=...).
+
+    Does nothing outside a recording() or forwarding() block.
+    """
+    event = {"kind": kind, "time": time.time(), **fields}
+    if _forward is not None:
+        _forward(event)
+    else:
+        write(event)
+
+
+def write(event: dict):
+    """Write an event, e.g. one forwarded by a grade-worker, if recording."""
+    if _fout is None:
+        return
+    _fout.write(json.dumps(event) + "\n")
+    _fout.flush()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values, which must be sorted."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+import pytest
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from agni import config  # noqa: E402
+
+STUDENTS = ["alice", "bob", "carol", "dave", "erin"]
+
+
+def _run_agni(*args, cwd: Path, **kwargs):
+    env = {**os.environ, "PYTHONPATH": str(SRC)}
+    return subprocess.Popen(
+        [sys.executable, "-u", "-m", "agni", *args], cwd=str(cwd), env=env, **kwargs
+    )
+
+
+@pytest.fixture
+def run_agni():
+    """Start an agni command in a subprocess, e.g. run_agni("grade-worker", cwd=...)."""
+    return _run_agni
+
+
+@pytest.fixture
+def assignment(tmp_path):
+    """A Python assignment with a bundle and a submission per student."""
+    (tmp_path / "config.toml").write_text(
+        textwrap.dedent(
+            f"""\
+            language = "python"
+            default_timeout = 10
+            run_command = "{sys.executable}"
+            filenames = ["parity.py"]
+            """
+        )
+    )
+    category = tmp_path / "src" / "testcases" / "exposed" / "basic"
+    category.mkdir(parents=True)
+    (category.parent / "__init__.py").write_text("")
+    (category / "__init__.py").write_text("")
+    (category / "even_test.py").write_text(
+        textwrap.dedent(
+            '''\
+            """ _begin_config_
+            points = 1
+            _end_config_ """
+            from parity import is_even
+            assert is_even(10)
+            '''
+        )
+    )
+    for i, student in enumerate(STUDENTS):
+        subdir = tmp_path / "submissions" / f"{student}__1__{i}"
+        subdir.mkdir(parents=True)
+        # bob's code is wrong, so that results tell the students apart.
+        result = "n % 2 == 1" if student == "bob" else "n % 2 == 0"
+        (subdir / "parity.py").write_text(f"def is_even(n):\n    return {result}\n")
+    (tmp_path / "bundle").mkdir()
+    _run_agni(
+        "bundle-python", "src/testcases/exposed", "bundle/a1", cwd=tmp_path
+    ).wait()
+    config.load(tmp_path / "config.toml")
+    return tmp_path
+
+
@@ -0,0 +1,33 @@
+import click
+import pytest
+from agni.commands.bundle_java import _check_limits, _source_of, _with_dependents
+
+
+def test_source_of_nested_classes():
+    assert _source_of("a1/Cat_Test1.class") == "a1/Cat_Test1.java"
+    assert _source_of("a1/Cat_Test1$Inner$1.class") == "a1/Cat_Test1.java"
+
+
+def test_dependents_are_found_transitively(tmp_path):
+    sources = {
+        "a1/Cat_A.java": "public class Cat_A {}",
+        "a1/Cat_B.java": "public class Cat_B { Cat_A a; }",
+        "a1/Cat_C.java": "public class Cat_C { Cat_B b; }",
+        "a1/Cat_AB.java": "public class Cat_AB {}",
+    }
+    for rel, text in sources.items():
+        (tmp_path / rel).parent.mkdir(exist_ok=True)
+        (tmp_path / rel).write_text(text)
+    tests = sorted(sources)
+    assert _with_dependents(tmp_path, ["a1/Cat_A.java"], tests) == [
+        "a1/Cat_A.java",
+        "a1/Cat_B.java",
+        "a1/Cat_C.java",
+    ]
+    assert _with_dependents(tmp_path, ["a1/Cat_C.java"], tests) == ["a1/Cat_C.java"]
+
+
+def test_process_limit_is_rejected_for_java():
+    _check_limits({"memory": 512, "cpu": 10}, "IsPrime_Test")
+    with pytest.raises(click.ClickException, match="processes"):
+        _check_limits({"processes": 256}, "IsPrime_Test")
@@ -0,0 +1,13 @@
+import click
+import pytest
+from agni.commands.bundle_python import get_test_metadata
+
+
+def test_mixed_type_params_are_reported(tmp_path):
+    test = tmp_path / "misc" / "mixed_test.py"
+    test.parent.mkdir()
+    test.write_text(
+        '""" _begin_config_\npoints = 1\nparams = [[2, true]]\n_end_config_ """\n'
+    )
+    with pytest.raises(click.ClickException, match="as tables"):
+        get_test_metadata(tmp_path, [test], "")
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import socket
+import subprocess
+import pytest
+from agni import distributed, telemetry
+from agni.commands import run_external
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def workers(assignment, run_agni):
+    procs = []
+    addresses = []
+    for _ in range(2):
+        port = _free_port()
+        proc = run_agni(
+            "grade-worker", "--port", str(port), cwd=assignment, stdout=subprocess.PIPE
+        )
+        proc.stdout.readline()  # Waiting for run-external --workers on ...
+        procs.append(proc)
+        addresses.append(f"127.0.0.1:{port}")
+    yield addresses
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+
+async def _hanging_worker(shards: list):
+    """A worker that gets ready, takes a shard and then never answers."""
+
+    async def handle(reader, writer):
+        await reader.readline()
+        writer.write(b'{"type": "ready"}\n')
+        await writer.drain()
+        shards.append(await reader.readline())
+        await asyncio.sleep(3600)
+
+    server = await asyncio.start_server(
+        handle, "127.0.0.1", 0, limit=distributed.LINE_LIMIT
+    )
+    return server, f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+def test_workers_grade_all_and_hanging_shard_is_reassigned(assignment, workers):
+    bundle_dir = assignment / "bundle" / "a1"
+    subdirs = sorted((assignment / "submissions").iterdir())
+    outdir = assignment / "outputs"
+    outdir.mkdir()
+    hung_shards = []
+
+    async def run():
+        server, address = await _hanging_worker(hung_shards)
+        async with server:
+            await distributed.coordinate(
+                [address, *workers],
+                subdirs,
+                bundle_dir,
+                run_external.load_commands(bundle_dir),
+                outdir,
+                num_procs=1,
+                jvm_reuse=False,
+                shard_size=1,
+                worker_timeout=2,
+            )
+
+    with telemetry.recording(assignment / telemetry.FILENAME):
+        asyncio.run(run())
+
+    assert hung_shards
+    for subdir in subdirs:
+        lines = (outdir / f"{subdir.name}.json").read_text().splitlines()
+        passed = [json.loads(line)["passed"] for line in lines]
+        assert passed == [not subdir.name.startswith("bob")]
+
+    events = [
+        json.loads(line)
+        for line in (assignment / telemetry.FILENAME).read_text().splitlines()
+    ]
+    students = [event for event in events if event["kind"] == "student"]
+    assert sorted(event["student"] for event in students) == [
+        subdir.name for subdir in subdirs
+    ]
+    assert {event["worker"] for event in students} <= set(workers)
@@ -0,0 +1,126 @@
+"""download-submissions against a local stand-in for the Codepost API."""
+import json
+from types import SimpleNamespace
+
+from agni.commands import download_submissions
+
+
+class FakeFile:
+    """A submission file that counts how often its code is read."""
+
+    def __init__(self, name, code, created):
+        self.name = name
+        self._code = code
+        self.created = created
+        self.reads = 0
+
+    @property
+    def code(self):
+        self.reads += 1
+        return self._code
+
+
+class FakeAssignment:
+    def __init__(self, submissions):
+        self.id = 7
+        self.submissions = submissions
+
+    def list_submissions(self, student=None):
+        if student is None:
+            return list(self.submissions)
+        return [s for s in self.submissions if student in s.students]
+
+
+class FailingSubmission:
+    """A submission whose files cannot be fetched, like a dropped connection."""
+
+    def __init__(self, submission):
+        self.id = submission.id
+        self.students = submission.students
+
+    @property
+    def files(self):
+        raise ConnectionError("connection reset")
+
+
+def _submission(id, student, *files):
+    return SimpleNamespace(id=id, students=[student], files=list(files))
+
+
+def _download(assignment, tmp_path, jobs=None):
+    if jobs is None:
+        jobs = [dict(submission=s) for s in assignment.list_submissions()]
+    return download_submissions.download(
+        assignment,
+        jobs,
+        ["a.py"],
+        tmp_path / "submissions",
+        tmp_path / download_submissions.MANIFEST_NAME,
+        num_threads=4,
+    )
+
+
+def test_latest_file_of_each_name(tmp_path):
+    old = FakeFile("a.py", "old", "2020-01-01T10:00:00")
+    new = FakeFile("a.py", "new", "2020-01-02T10:00:00")
+    later_same_time = FakeFile("a.py", "newer", "2020-01-02T10:00:00")
+    other = FakeFile("b.py", "b", "2020-01-01T10:00:00")
+    latest = download_submissions.latest_files([new, old, other, later_same_time])
+    assert latest == {"a.py": later_same_time, "b.py": other}
+
+    (tmp_path / "submissions").mkdir()
+    sub = _submission(1, "alice@x", old, new, other)
+    assert _download(FakeAssignment([sub]), tmp_path) == 0
+    path = tmp_path / "submissions" / "alice@x__7__1" / "a.py"
+    assert path.read_text() == "new"
+    assert not (path.parent / "b.py").exists()
+
+
+def test_unchanged_files_are_skipped(tmp_path, capsys):
+    (tmp_path / "submissions").mkdir()
+    files = [FakeFile("a.py", f"code {i}", "2020-01-01") for i in range(3)]
+    subs = [_submission(i, f"s{i}@x", f) for i, f in enumerate(files)]
+    assignment = FakeAssignment(subs)
+    assert _download(assignment, tmp_path) == 0
+    assert [f.reads for f in files] == [1, 1, 1]
+
+    capsys.readouterr()
+    assert _download(assignment, tmp_path) == 0
+    assert [f.reads for f in files] == [1, 1, 1]
+    assert capsys.readouterr().out.count("Skipping") == 3
+
+    # A new version of a file, or a file deleted on disk, is downloaded again.
+    subs[0].files.append(FakeFile("a.py", "fixed", "2020-01-05"))
+    (tmp_path / "submissions" / "s1@x__7__1" / "a.py").unlink()
+    assert _download(assignment, tmp_path) == 0
+    assert (tmp_path / "submissions" / "s0@x__7__0" / "a.py").read_text() == "fixed"
+    assert (tmp_path / "submissions" / "s1@x__7__1" / "a.py").read_text() == "code 1"
+    assert files[2].reads == 1
+
+
+def test_interrupted_download_resumes(tmp_path):
+    (tmp_path / "submissions").mkdir()
+    files = [FakeFile("a.py", f"code {i}", "2020-01-01") for i in range(4)]
+    subs = [_submission(i, f"s{i}@x", f) for i, f in enumerate(files)]
+
+    failing = [FailingSubmission(s) if s.id in (1, 3) else s for s in subs]
+    assert _download(FakeAssignment(failing), tmp_path) == 2
+    manifest = json.loads((tmp_path / download_submissions.MANIFEST_NAME).read_text())
+    assert sorted(manifest) == ["0", "2"]
+    assert [f.reads for f in files] == [1, 0, 1, 0]
+
+    assert _download(FakeAssignment(subs), tmp_path) == 0
+    assert [f.reads for f in files] == [1, 1, 1, 1]
+    manifest = json.loads((tmp_path / download_submissions.MANIFEST_NAME).read_text())
+    assert sorted(manifest) == ["0", "1", "2", "3"]
+
+
+def test_download_by_student(tmp_path):
+    (tmp_path / "submissions").mkdir()
+    subs = [
+        _submission(i, f"s{i}@x", FakeFile("a.py", str(i), "2020-01-01"))
+        for i in range(3)
+    ]
+    jobs = [dict(student="s2@x")]
+    assert _download(FakeAssignment(subs), tmp_path, jobs) == 0
+    assert [p.name for p in (tmp_path / "submissions").iterdir()] == ["s2@x__7__2"]
@@ -0,0 +1,33 @@
+import asyncio
+from agni import javac_server
+from agni.proc_util import ProcessResult
+
+
+class DeadServer:
+    async def compile(self, args):
+        return ProcessResult(error="ConnectionRefusedError")
+
+
+def test_run_javac_falls_back_to_javac_when_the_server_fails(monkeypatch):
+    calls = []
+
+    async def run_process(cmd, cwd=None):
+        calls.append(cmd)
+        return ProcessResult(returncode=0)
+
+    monkeypatch.setattr(javac_server, "_server", DeadServer())
+    monkeypatch.setattr(javac_server, "run_process", run_process)
+    proc_result = asyncio.run(javac_server.run_javac(["@args.txt"]))
+    assert proc_result.returncode == 0 and not proc_result.error
+    assert calls == [["javac", "@args.txt"]]
+
+
+def test_server_that_exits_at_startup_is_not_used(tmp_path, monkeypatch, capsys):
+    # Like CompileServer on a JRE without a system compiler.
+    java = tmp_path / "java"
+    java.write_text("#!/bin/sh\necho 'No system Java compiler found.' >&2\nexit 1\n")
+    java.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:/usr/bin:/bin")
+    with javac_server.javac_server():
+        assert javac_server._server is None
+    assert "using javac directly" in capsys.readouterr().out
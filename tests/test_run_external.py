@@ -0,0 +1,212 @@
+import asyncio
+import json
+import sys
+import tempfile
+from pathlib import Path
+import pytest
+from agni.cache import hash_tests
+from agni.commands import run_external
+from agni.proc_util import ProcessResult
+
+
+def test_hash_tests_changes_only_for_the_tests_affected():
+    entries = {
+        "t/A.class": b"A",
+        "t/A$1.class": b"A inner",
+        "t/B.class": b"B calls t/A",
+        "t/C.class": b"C",
+        "h/Helper.class": b"helper",
+    }
+    paths = {"a": "t/A", "b": "t/B", "c": "t/C"}
+    infos = {"a": {}, "b": {"timeout": 1}, "c": {"requires": ["a"]}}
+
+    base = hash_tests(entries, paths, infos)
+
+    def changed(entries=entries, infos=infos, **settings):
+        hashes = hash_tests(entries, paths, infos, **settings)
+        return sorted(tid for tid in paths if hashes[tid] != base[tid])
+
+    assert changed() == []
+    # b mentions A, and c requires a.
+    assert changed(entries={**entries, "t/A$1.class": b"A changed"}) == ["a", "b", "c"]
+    assert changed(entries={**entries, "t/C.class": b"C changed"}) == ["c"]
+    assert changed(entries={**entries, "h/Helper.class": b"h"}) == ["a", "b", "c"]
+    assert changed(infos={**infos, "b": {"timeout": 2}}) == ["b"]
+    assert changed(jvm_reuse=True) == ["a", "b", "c"]
+
+
+def test_changing_a_test_runs_only_that_test(assignment, run_agni, monkeypatch):
+    runs = assignment / "runs.txt"
+    monkeypatch.setenv("RUNS_FILE", str(runs))
+    category = assignment / "src" / "testcases" / "exposed" / "basic"
+    for name in ("first", "second"):
+        (category / f"{name}_test.py").write_text(
+            f"import os\nopen(os.environ['RUNS_FILE'], 'a').write('{name}\\n')\n"
+        )
+
+    bundle_dir = assignment / "bundle" / "a1"
+    outdir = assignment / "outputs"
+    outdir.mkdir()
+    subdir = assignment / "submissions" / "alice__1__0"
+
+    def grade():
+        args = ("bundle-python", "src/testcases/exposed", "bundle/a1")
+        run_agni(*args, cwd=assignment).wait()
+        commands = run_external.load_commands(bundle_dir)
+        asyncio.run(
+            run_external.grade(
+                [subdir], bundle_dir, commands, outdir, num_procs=1, use_cache=True
+            )
+        )
+        output = (outdir / f"{subdir.name}.json").read_text().splitlines()
+        assert len(output) == 3
+        return runs.read_text().split()
+
+    assert sorted(grade()) == ["first", "second"]
+    assert sorted(grade()) == ["first", "second"]
+    with open(category / "second_test.py", "a") as f:
+        f.write("# changed\n")
+    assert sorted(grade()) == ["first", "second", "second"]
+
+
+def test_cached_results_are_not_reused_with_other_timeouts(assignment, monkeypatch):
+    runs = assignment / "runs.txt"
+    monkeypatch.setenv("RUNS_FILE", str(runs))
+    subdir = next((assignment / "submissions").glob("alice__*"))
+    with open(subdir / "parity.py", "a") as f:
+        f.write("import os\nopen(os.environ['RUNS_FILE'], 'a').write('run\\n')\n")
+
+    bundle_dir = assignment / "bundle" / "a1"
+    commands = run_external.load_commands(bundle_dir)
+    outdir = assignment / "outputs"
+    outdir.mkdir()
+
+    def grade(timeouts):
+        asyncio.run(
+            run_external.grade(
+                [subdir],
+                bundle_dir,
+                commands,
+                outdir,
+                num_procs=1,
+                use_cache=True,
+                timeouts=timeouts,
+            )
+        )
+        output = (outdir / f"{subdir.name}.json").read_text().splitlines()
+        assert [json.loads(line)["passed"] for line in output] == [True]
+        return len(runs.read_text().splitlines())
+
+    assert grade({}) == 1
+    assert grade({}) == 1
+    (test_id,) = commands
+    assert grade({test_id: 5}) == 2
+    assert grade({test_id: 5}) == 2
+
+
+def test_custom_prefix_keeps_requires_and_timeouts(assignment, run_agni):
+    category = assignment / "src" / "testcases" / "exposed" / "basic"
+    (category / "odd_test.py").write_text(
+        '""" _begin_config_\npoints = 1\nrequires = ["even_test"]\n_end_config_ """\n'
+        "import time\ntime.sleep(2)\n"
+    )
+    run_agni(
+        "bundle-python",
+        "--prefix",
+        "Part 1 ",
+        "src/testcases/exposed",
+        "bundle/a1",
+        cwd=assignment,
+    ).wait()
+    bundle_dir = assignment / "bundle" / "a1"
+    commands = run_external.load_commands(bundle_dir)
+    assert sorted(commands) == ["Part 1 basic_@_even_test", "Part 1 basic_@_odd_test"]
+    outdir = assignment / "outputs"
+    outdir.mkdir()
+    subdirs = sorted((assignment / "submissions").glob("*"))[:2]  # alice, bob
+    timeouts = {"Part 1 basic_@_odd_test": 0.5}
+    asyncio.run(
+        run_external.grade(
+            subdirs, bundle_dir, commands, outdir, num_procs=1, timeouts=timeouts
+        )
+    )
+    results = {}
+    for subdir in subdirs:
+        for line in (outdir / f"{subdir.name}.json").read_text().splitlines():
+            result = json.loads(line)
+            results[subdir.name.split("__")[0], result["id"]] = result
+    # alice passes even_test, so odd_test runs and hits the calibrated timeout.
+    assert results["alice", "Part 1 basic_@_odd_test"]["is_timeout"]
+    # bob fails even_test, so odd_test is skipped.
+    assert results["bob", "Part 1 basic_@_odd_test"]["skipped"]
+
+
+def test_only_compile_errors_of_the_code_are_cached(assignment, monkeypatch):
+    subdir = assignment / "submissions" / "alice__1__0"
+    (subdir / "Main.java").write_text("class Main {}\n")
+    replies = [
+        ProcessResult(error="ConnectionRefusedError"),
+        ProcessResult(returncode=3, stdout="javac: internal error"),
+        ProcessResult(returncode=1, stdout="Main.java:1: error: ';' expected"),
+    ]
+    calls = []
+
+    async def run_javac(args, cwd=None):
+        calls.append(args)
+        return replies.pop(0)
+
+    monkeypatch.setattr(run_external, "run_javac", run_javac)
+
+    def build():
+        with tempfile.TemporaryDirectory() as t:
+            return asyncio.run(run_external._build_java(subdir, Path(t)))
+
+    with pytest.raises(run_external.JavacError, match="ConnectionRefusedError"):
+        build()
+    with pytest.raises(run_external.JavacError, match="exited with 3"):
+        build()
+    assert "';' expected" in build()
+    assert "';' expected" in build()
+    assert len(calls) == 3
+
+
+FAKE_BATCH_JVM = """#!{python}
+import json, sys
+props = dict(a[2:].split("=", 1) for a in sys.argv[1:] if a.startswith("-D"))
+lines = open(props["batch"]).read().splitlines()
+with open(props["log"], "a") as log:
+    log.write(props.get("batchStart", "0") + "\\n")
+for i in range(int(props.get("batchStart", 0)), len(lines)):
+    tid = lines[i]
+    if tid == "exits":
+        sys.exit(0)
+    print(json.dumps({{"id": tid, "passed": True, "log": ""}}), flush=True)
+    if tid == "leaves_thread":
+        print("_agni_restart_", flush=True)
+        sys.exit(75)
+"""
+
+
+def test_batch_continues_in_a_new_jvm(tmp_path):
+    java = tmp_path / "java"
+    java.write_text(FAKE_BATCH_JVM.format(python=sys.executable))
+    java.chmod(0o755)
+    test_ids = ["t0", "leaves_thread", "t2", "exits", "t4"]
+    batchfile = tmp_path / "batch.txt"
+    batchfile.write_text("".join(f"{tid}\n" for tid in test_ids))
+    starts = tmp_path / "starts.txt"
+    cmd = [str(java), f"-Dbatch={batchfile}", f"-Dlog={starts}", "Executor"]
+    results = {}
+    with open(tmp_path / "out.json", "w") as fout:
+        asyncio.run(run_external._run_batch(cmd, test_ids, fout, results, {}, "a"))
+
+    assert starts.read_text().split() == ["0", "2", "4"]
+    assert list(results) == test_ids
+    assert [json.loads(results[tid])["passed"] for tid in test_ids] == [
+        True,
+        True,
+        True,
+        False,
+        True,
+    ]
+    assert "_agni_restart_" not in (tmp_path / "out.json").read_text()
@@ -0,0 +1,270 @@
+"""test-results --update against a local mock of the Codepost API."""
+import json
+import sys
+import threading
+import types
+import urllib.error
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from agni import codepost_client
+from agni.commands import test_results
+
+
+class APIError(Exception):
+    """Like codepost's errors, which carry the HTTP status code."""
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class MockCodepost:
+    """HTTP server for submission tests that fails requests as scripted.
+
+    failures maps "submission:testCase" to the statuses of its first requests.
+    """
+
+    def __init__(self):
+        self.failures = {}
+        self.requests = Counter()
+        self.created = []
+        self.updated = []
+        self.lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self, saved):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                key = f"{body['submission']}:{body['testCase']}"
+                with mock.lock:
+                    mock.requests[key] += 1
+                    statuses = mock.failures.get(key, [])
+                    status = statuses.pop(0) if statuses else 201
+                    if status < 300:
+                        saved.append(body)
+                        body.setdefault("id", 1000 + len(mock.created))
+                reply = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def do_POST(self):
+                self._handle(mock.created)
+
+            def do_PATCH(self):
+                self._handle(mock.updated)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def client(self):
+        """A stand-in for the codepost package that talks to this server."""
+
+        def request(method, path, job):
+            data = json.dumps(job).encode()
+            req = urllib.request.Request(f"{self.url}{path}", data, method=method)
+            req.add_header("Content-Type", "application/json")
+            try:
+                with urllib.request.urlopen(req, timeout=5) as resp:
+                    return types.SimpleNamespace(**json.loads(resp.read()))
+            except urllib.error.HTTPError as exc:
+                raise APIError(exc.code)
+
+        submission_test = types.SimpleNamespace(
+            create=lambda **job: request("POST", "/submissionTests/", job),
+            update=lambda **job: request(
+                "PATCH", f"/submissionTests/{job['id']}/", job
+            ),
+        )
+        return types.SimpleNamespace(submission_test=submission_test)
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    mock = MockCodepost()
+    monkeypatch.setitem(sys.modules, "codepost", mock.client())
+    monkeypatch.setattr(codepost_client, "RETRY_BACKOFF", 0.01)
+    yield mock
+    mock.server.shutdown()
+    mock.server.server_close()
+
+
+def _job(submission, test, **extra):
+    job = {"submission": submission, "testCase": test, "passed": True, "logs": "ok"}
+    return {**job, **extra}
+
+
+def test_is_transient():
+    assert codepost_client.is_transient(APIError(503))
+    assert codepost_client.is_transient(APIError(429), idempotent=False)
+    assert not codepost_client.is_transient(APIError(503), idempotent=False)
+    assert not codepost_client.is_transient(APIError(400))
+    assert not codepost_client.is_transient(APIError(404))
+    assert not codepost_client.is_transient(KeyError("id"))
+    assert codepost_client.is_transient(ConnectionResetError())
+    assert not codepost_client.is_transient(ConnectionResetError(), idempotent=False)
+    assert codepost_client.is_transient(ConnectionRefusedError(), idempotent=False)
+
+
+def _uploaded(manifest):
+    return test_results._load_manifest(manifest)
+
+
+def test_transient_failures_are_retried(mock, tmp_path):
+    mock.failures = {
+        "1:10": [503, 502],  # update: retried after server errors
+        "2:10": [429],  # create: retried after rate limiting
+        "3:10": [500],  # create: may have been made, not retried
+        "4:10": [400, 400],  # bad request: never retried
+    }
+    jobs = [_job(1, 10, id=99), _job(2, 10), _job(3, 10), _job(4, 10), _job(5, 10)]
+    test_results._upload(jobs, tmp_path / "uploaded.json", 4, dry_run=False)
+
+    assert mock.requests == {"1:10": 3, "2:10": 2, "3:10": 1, "4:10": 1, "5:10": 1}
+    assert [job["submission"] for job in mock.updated] == [1]
+    assert sorted(job["submission"] for job in mock.created) == [2, 5]
+    uploaded = _uploaded(tmp_path / "uploaded.json")
+    assert uploaded[(1, 10)] == (99, True, test_results._log_hash("ok"))
+    # Failed creates are recorded without an id, as they may have been made.
+    assert {k[0] for k, record in uploaded.items() if record[0] is None} == {3, 4}
+    assert {k[0] for k, record in uploaded.items() if record[0]} == {1, 2, 5}
+
+
+def test_upload_resumes_from_checkpoint(mock, tmp_path):
+    checkpoint = tmp_path / "uploaded.json"
+    jobs = [_job(s, t) for s in range(1, 6) for t in (10, 11)]
+    mock.failures = {"2:11": [400], "4:10": [400]}
+    test_results._upload(jobs, checkpoint, 4, dry_run=False)
+    assert len(mock.created) == 8
+
+    test_results._upload(jobs, checkpoint, 4, dry_run=False)
+    assert len(mock.created) == 10
+    assert mock.requests["2:11"] == 2 and mock.requests["1:10"] == 1
+    uploaded = _uploaded(checkpoint)
+    assert sorted(uploaded) == [(job["submission"], job["testCase"]) for job in jobs]
+    assert all(record[0] for record in uploaded.values())
+
+
+def test_dry_run_sends_nothing(mock, tmp_path, capsys):
+    jobs = [_job(s, 10) for s in range(20)]
+    test_results._upload(jobs, tmp_path / "uploaded.json", 4, dry_run=True)
+    assert not mock.requests
+    assert not (tmp_path / "uploaded.json").read_text()
+    assert "Built 20 requests" in capsys.readouterr().out
+
+
+def test_existing_results_are_fetched_together(monkeypatch):
+    results = {
+        100 + i: types.SimpleNamespace(
+            id=100 + i, submission=i // 2, testCase=10 + i % 2, passed=True, logs="ok"
+        )
+        for i in range(6)
+    }
+    fetched = []
+
+    def retrieve(id):
+        fetched.append(id)
+        return results[id]
+
+    submission_test = types.SimpleNamespace(retrieve=retrieve)
+    monkeypatch.setitem(
+        sys.modules, "codepost", types.SimpleNamespace(submission_test=submission_test)
+    )
+    submissions = [
+        types.SimpleNamespace(
+            id=s,
+            students=[f"s{s}@x"],
+            tests=[types.SimpleNamespace(id=100 + 2 * s + t) for t in (0, 1)],
+        )
+        for s in range(3)
+    ]
+    assignment = types.SimpleNamespace(list_submissions=lambda: submissions)
+
+    existing = test_results._existing_results(assignment, {0, 2}, 4)
+    assert sorted(fetched) == [100, 101, 104, 105]
+    assert existing[(2, 11)] == (105, True, test_results._log_hash("ok"))
+
+    jobs = [_job(0, 10), _job(0, 11, logs="changed"), _job(1, 10)]
+    changed = test_results._changed_jobs(jobs, existing)
+    assert changed == [_job(0, 11, logs="changed", id=101), _job(1, 10)]
+
+
+def test_upsert_diffs_against_the_manifest(mock, tmp_path, monkeypatch):
+    outdir = tmp_path / "outputs"
+    outdir.mkdir()
+    bundle_dir = tmp_path / "bundle" / "a1"
+    bundle_dir.mkdir(parents=True)
+    (bundle_dir / "a1_metadata.json").write_text(
+        json.dumps({"t": {"testcaseID": "t1"}, "u": {"testcaseID": "t2"}})
+    )
+    tests = {"t1": {"id": 10}, "t2": {"id": 11}}
+    monkeypatch.setattr(codepost_client, "get_assignment", lambda: None)
+    monkeypatch.setattr(codepost_client, "get_tests", lambda assignment: tests)
+    monkeypatch.setattr("builtins.input", lambda prompt: "yes")
+    on_codepost = [{**_job(3, 10), "id": 7}]
+    fetched = []
+
+    def existing_results(assignment, submission_ids, num_threads):
+        fetched.append(sorted(submission_ids))
+        return {
+            (j["submission"], j["testCase"]): (j["id"], j["passed"], "")
+            for j in on_codepost + mock.created
+            if j["submission"] in submission_ids
+        }
+
+    monkeypatch.setattr(test_results, "_log_hash", lambda logs: "")
+    monkeypatch.setattr(test_results, "_existing_results", existing_results)
+
+    def grade(passed):
+        for s in (1, 2, 3):
+            lines = [
+                json.dumps({"id": tid, "passed": passed[s], "log": "ok"})
+                for tid in tests
+            ]
+            (outdir / f"st{s}__1__{s}.json").write_text("\n".join(lines))
+
+    def update():
+        students = ["st1", "st2", "st3"]
+        test_results.update_results(students, outdir, bundle_dir, 4, upsert=True)
+        return sorted((j["submission"], j["testCase"]) for j in mock.created)
+
+    mock.failures = {"2:11": [400]}
+    grade({1: True, 2: True, 3: True})
+    assert update() == [(1, 10), (1, 11), (2, 10), (3, 11)]
+    assert fetched == [[1, 2, 3]]
+
+    grade({1: False, 2: True, 3: True})
+    assert update() == [(1, 10), (1, 11), (2, 10), (2, 11), (3, 11)]
+    # Only submission 2, with a create that failed, is fetched again.
+    assert fetched == [[1, 2, 3], [2]]
+    created_ids = sorted(j["id"] for j in mock.created if j["submission"] == 1)
+    assert sorted(j["id"] for j in mock.updated) == created_ids
+
+    mock.updated.clear()
+    assert len(update()) == 5
+    assert fetched == [[1, 2, 3], [2]]
+    assert not mock.updated
+
+
+def test_upsert_sends_changed_results_uploaded_before(mock, tmp_path):
+    checkpoint = tmp_path / "uploaded.json"
+    checkpoint.write_text(
+        json.dumps(
+            {"submission": 1, "testCase": 10, "id": 5, "passed": True, "log_hash": ""}
+        )
+        + "\n"
+    )
+    job = _job(1, 10, id=5, logs="changed")
+    test_results._upload([job], checkpoint, 4, dry_run=False)
+    assert not mock.updated
+    test_results._upload([job], checkpoint, 4, dry_run=False, resume=False)
+    assert [j["logs"] for j in mock.updated] == ["changed"]
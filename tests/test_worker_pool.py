@@ -0,0 +1,58 @@
+import asyncio
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+RUNTIME = SRC / "agni" / "resources" / "python" / "autograder"
+sys.path.insert(0, str(RUNTIME))
+
+from _autograder import pool  # noqa: E402
+
+
+class ExitedWorker:
+    """A worker process that exits as soon as it gets a test."""
+
+    def __init__(self):
+        self.returncode = None
+        self.stdin = self
+        self.stdout = self
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    async def readline(self):
+        return b""
+
+    def kill(self):
+        self.returncode = -9
+
+    async def wait(self):
+        return self.returncode
+
+
+def test_failed_respawn_gives_error_results_and_is_retried(monkeypatch):
+    spawned = []
+
+    async def spawn(preload=True):
+        if spawned:
+            raise RuntimeError("Could not start autograder worker.")
+        spawned.append(ExitedWorker())
+        return spawned[-1]
+
+    monkeypatch.setattr(pool, "_spawn", spawn)
+
+    async def run():
+        workers = pool.WorkerPool(1)
+        await workers.start()
+        first = await asyncio.wait_for(workers.run("exposed.a.t1", 5), 5)
+        second = await asyncio.wait_for(workers.run("exposed.a.t2", 5), 5)
+        await workers.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert "exited unexpectedly" in first.error
+    assert "Could not start autograder worker" in second.error
+    assert spawned[0].returncode == -9